@@ -1,5 +1,4 @@
 import torch
-import cv2
 import numpy
 import os
 import json
@@ -9,6 +8,7 @@ import tagilmo.utils.mission_builder as mb
 from mcdemoaux.agenttools.agent import TAgent
 import logging
 from mcdemoaux.vision.vis import Visualizer
+from utils.frames import FrameSpec, center_window
 
 
 import sys
@@ -25,20 +25,18 @@ from fem.goodpoint import GoodPoint
 SCALE = 4
 NUM_OBS = 1
 
-def process_pixel_data(pixels, resize, scale):
-    img_data = numpy.frombuffer(pixels, dtype=numpy.uint8)
-    img_data = img_data.reshape((240 * scale, 320 * scale, 3))
-    if resize != 1:
-        height, width, _ = img_data.shape
-        img_data = cv2.resize(img_data, (int(width * resize), int(height * resize)),
-            fx=resize, fy=resize, interpolation=cv2.INTER_NEAREST)
+# windows are taken from frames rendered at SCALE times 320x240 and upscaled by SCALE
+FRAME_SPEC = FrameSpec(320 * SCALE, 240 * SCALE)
+
 
-    return img_data
+def process_pixel_data(pixels, spec=FRAME_SPEC):
+    img_data = numpy.frombuffer(pixels, dtype=numpy.uint8)
+    return img_data.reshape(spec.source + (spec.channels,))
 
 
-def get_image(img_frame, resize, scale):
+def get_image(img_frame, spec=FRAME_SPEC):
     if img_frame is not None:
-        return process_pixel_data(img_frame.pixels, resize, scale)
+        return process_pixel_data(img_frame.pixels, spec)
     return None
 
 
@@ -66,16 +64,14 @@ class BlockGPDescAnalyzer:
 
     def _getLocalDscr(self):
         wnd_thr = 5
-        img = get_image(self.rob.getCachedObserve('getImageFrame'), SCALE, SCALE)
+        img = get_image(self.rob.getCachedObserve('getImageFrame'))
         # print(torch.cuda.is_available())
         wnd_thr = 100
-        height, width, channels = img.shape
-        y = height // 2
-        x = width // 2
         y1 = wnd_thr
         x1 = wnd_thr
         points2 = numpy.asarray([[y1, x1]])
-        crop_img = img[y - wnd_thr:y + wnd_thr, x - wnd_thr:x + wnd_thr, 0:3]
+        # only the window is upscaled
+        crop_img = center_window(img[:, :, 0:3], wnd_thr, SCALE)
         descriptors = self.gp.get_descriptors(crop_img, points2)
         return descriptors.cpu().detach().numpy(), crop_img
 
@@ -184,7 +180,7 @@ if __name__ == '__main__':
     setup_logger()
     visualizer = Visualizer()
     visualizer.start()
-    video_producer = mb.VideoProducer(width=320 * SCALE, height=240 * SCALE, want_depth=False)
+    video_producer = FRAME_SPEC.video_producer()
     agent_handlers = mb.AgentHandlers(video_producer=video_producer)
     miss = mb.MissionXML(agentSections=[mb.AgentSection(name='Cristina',
              agenthandlers=agent_handlers,)])
@@ -7,25 +7,24 @@ import tagilmo.utils.mission_builder as mb
 from mcdemoaux.agenttools.agent import TAgent
 import logging
 from mcdemoaux.vision.vis import Visualizer
+from utils.frames import FrameSpec, center_window
 
 
 SCALE = 4
 
 
-def process_pixel_data(pixels, resize, scale):
-    img_data = numpy.frombuffer(pixels, dtype=numpy.uint8)
-    img_data = img_data.reshape((240 * scale, 320 * scale, 3))
-    if resize != 1:
-        height, width, _ = img_data.shape
-        img_data = cv2.resize(img_data, (int(width * resize), int(height * resize)),
-            fx=resize, fy=resize, interpolation=cv2.INTER_NEAREST)
+# windows are taken from frames rendered at SCALE times 320x240 and upscaled by SCALE
+FRAME_SPEC = FrameSpec(320 * SCALE, 240 * SCALE)
+
 
-    return img_data
+def process_pixel_data(pixels, spec=FRAME_SPEC):
+    img_data = numpy.frombuffer(pixels, dtype=numpy.uint8)
+    return img_data.reshape(spec.source + (spec.channels,))
 
 
-def get_image(img_frame, resize, scale):
+def get_image(img_frame, spec=FRAME_SPEC):
     if img_frame is not None:
-        return process_pixel_data(img_frame.pixels, resize, scale)
+        return process_pixel_data(img_frame.pixels, spec)
     return None
 
 
@@ -38,14 +37,11 @@ class BlockHueAnalyzer:
 
     def _getLocalHue(self):
         wnd_thr = 5
-        img = get_image(self.rob.getCachedObserve('getImageFrame'), SCALE, SCALE)
-        bgr = img[:, :, 0:3]
+        img = get_image(self.rob.getCachedObserve('getImageFrame'))
+        # only the window is upscaled and converted
+        bgr = numpy.ascontiguousarray(center_window(img[:, :, 0:3], wnd_thr, SCALE))
         hsv = cv2.cvtColor(bgr, cv2.COLOR_BGR2HSV)
-        h, s, v = cv2.split(hsv)
-        height, width, channels = img.shape
-        y = height//2
-        x = width//2
-        crop_img = h[y-wnd_thr:y+wnd_thr, x-wnd_thr:x+wnd_thr]
+        crop_img, s, v = cv2.split(hsv)
         avg = numpy.mean(crop_img)
         return avg
 
@@ -141,7 +137,7 @@ if __name__ == '__main__':
     setup_logger()
     visualizer = Visualizer()
     visualizer.start()
-    video_producer = mb.VideoProducer(width=320 * SCALE, height=240 * SCALE, want_depth=False)
+    video_producer = FRAME_SPEC.video_producer()
     agent_handlers = mb.AgentHandlers(video_producer=video_producer)
     miss = mb.MissionXML(agentSections=[mb.AgentSection(name='Cristina',
              agenthandlers=agent_handlers,)])
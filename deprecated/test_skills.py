@@ -1,11 +1,15 @@
 from utils.log import setup_logger
+from utils.learner import BackgroundLearner
+from utils.checkpoint import CheckpointManager
+from utils.schedule import UpdateScheduler
 import torch
 
+import contextlib
 import logging
 import time
 
 
-def train_agent(agent, Trainer, save_path, train=True):
+def train_agent(agent, Trainer, save_path, train=True, background=False, update_ratio=None):
     num_repeats = 2200
     eps = 0.36
     eps_start = eps
@@ -22,8 +26,33 @@ def train_agent(agent, Trainer, save_path, train=True):
 #                                  weight_decay=0.01)
 #
 
+    scheduler = None
+    if update_ratio is not None:
+        # gradient steps follow collected data instead of a constant per episode
+        scheduler = UpdateScheduler(ratio=update_ratio)
+    # noise of the augmentation has its own random generator
+    bank = getattr(getattr(agent, 'transform', None), 'bank', None)
+
+    checkpoints = CheckpointManager(save_path + '.checkpoints', weights_path=save_path)
+    start = 0
+    resumed = checkpoints.load_latest(agent, optimizer)
+    if resumed is not None:
+        start = resumed['step'] + 1
+        extra = resumed['extra']
+        eps = extra.get('eps', eps)
+        if scheduler is not None and 'scheduler' in extra:
+            scheduler.load_state_dict(extra['scheduler'])
+        if bank is not None and 'noise' in extra:
+            bank.set_state(extra['noise'])
+
+    learner = None
+    if background and train:
+        # learner keeps the optimized network, so it has to be on the final device
+        agent.to('cuda' if torch.cuda.is_available() else 'cpu')
+        learner = BackgroundLearner(agent, optimizer)
+
     mc = None
-    for i in range(0, num_repeats):
+    for i in range(start, num_repeats):
         mc = Trainer.init_mission(i, mc)
 
         logging.debug("\nMission %d of %d:" % (i + 1, num_repeats))
@@ -31,6 +60,11 @@ def train_agent(agent, Trainer, save_path, train=True):
 
         # -- run the agent in the world -- #
         trainer = Trainer(agent, mc, optimizer, eps, i > 15 and train)
+        trainer.scheduler = scheduler
+        if learner is not None and i > 15:
+            if not learner.is_alive():
+                learner.start()
+            trainer.learner = learner
         comulative_reward, steps, solved = trainer.run_episode()
         logging.info('episode %i: solved %i: comulative reward: %f', i, solved, comulative_reward)
         logging.debug("eps: %f", eps)
@@ -40,7 +74,16 @@ def train_agent(agent, Trainer, save_path, train=True):
         time.sleep(0.5)  # (let the Mod reset)
 
         if i % 14 == 0:
-            torch.save(agent.state_dict(), save_path, _use_new_zipfile_serialization=False)
+            extra = dict(eps=eps)
+            if scheduler is not None:
+                extra['scheduler'] = scheduler.state_dict()
+            if bank is not None:
+                extra['noise'] = bank.get_state()
+            # weights and optimizer state of the same gradient step
+            with learner.paused() if learner is not None else contextlib.nullcontext():
+                state = agent.state_dict() if learner is None else learner.state_dict()
+                checkpoints.save(i, state, optimizer, memory=agent.memory, **extra)
+    checkpoints.close()
 
 
 def train_cliff():
@@ -105,6 +148,40 @@ def train_dig_v1():
     agent = load_agent(path)
     train_agent(agent, Trainer, path, False)
 
+def train_dig_v1_vec(n_envs=4, n_ticks=200000):
+    """
+    dig_v1 agent acting in n_envs missions at once, one running game
+    client per mission, learning in background
+    """
+    from trainable.dig_v1 import load_agent, Trainer, DigEnv
+    from utils.vec_actor import VecActor
+    path = 'agent_dig.pth'
+    agent = load_agent(path)
+    optimizer = torch.optim.RMSprop(agent.parameters(),
+                                    lr=0.0001,
+                                    weight_decay=0.01)
+    agent.to('cuda' if torch.cuda.is_available() else 'cpu')
+    learner = BackgroundLearner(agent, optimizer)
+    checkpoints = CheckpointManager(path + '.checkpoints', weights_path=path)
+    envs = []
+    for i in range(n_envs):
+        mc = Trainer.init_mission(i, None)
+        mc.safeStart()
+        envs.append(DigEnv(Trainer(agent, mc, optimizer, 0.1, True)))
+    actor = VecActor(agent, envs, epsilon=0.1)
+    learner.start()
+    try:
+        for i in range(0, n_ticks, 1000):
+            actor.run(1000)
+            logging.info('tick %i: episodes %i', i + 1000, len(actor.finished))
+            with learner.paused():
+                checkpoints.save(i + 1000, learner.state_dict(), optimizer, memory=agent.memory)
+    finally:
+        learner.stop()
+        actor.close()
+        checkpoints.close()
+
+
 if __name__ == '__main__':
     setup_logger('train.log')
     #train_tree_v3()
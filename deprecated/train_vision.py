@@ -3,6 +3,7 @@ import random
 import os
 import torch
 from utils import common
+from utils.noise import rasterize_points
 from math import sin, cos
 import numpy
 import cv2
@@ -163,10 +164,12 @@ def rotation_matrix(roll, pitch, yaw):
 def transform_item(item):
     image, points, depth = item
     height, width = depth.shape
-    label_tensor = torch.zeros((len(common.visible_blocks) + 1, height, width), dtype=torch.uint8)
-    for (label, (x, z)) in points:
-        label_tensor[label, z, x] = 1
-    return image, label_tensor, depth
+    labels = numpy.asarray([label for (label, _) in points], dtype=numpy.int64)
+    # (x, z) to (row, column)
+    coords = numpy.asarray([(z, x) for (_, (x, z)) in points]).reshape(-1, 2)
+    label_tensor = rasterize_points(coords, height, width, labels=labels,
+                                    n_classes=len(common.visible_blocks) + 1)[0]
+    return image, torch.from_numpy(label_tensor), depth
 
 
 def add_episode(data_set, ep):
@@ -1,44 +1,14 @@
 """
 Train neural network on pairs of rgb and segmented images
 """
-import random
 import torch
 import os.path
 import numpy
 import cv2
 from tagilmo.utils import segment_mapping
-from utils.dataset import MinecraftSegmentation
-
-
-def random_transformer(x, transformers=[]):
-    orig_shape = x.shape
-    assert (len(orig_shape) == 3)
-    assert (orig_shape[2] <= orig_shape[0])
-    assert (orig_shape[2] <= orig_shape[1])
-
-    x = x.transpose(2, 0, 1)
-    for transform in transformers:
-        assert 'resize' not in str(transform.__class__).lower()
-        if random.random() < 0.2:
-            x_std = x.std()
-            if x_std < 0.01:
-                continue
-            new_x = transform(x)
-            if new_x.std() < 0.1 * x_std:
-                print("{0} decreased std to {1} from {2}".format(transform, new_x.std(), x_std))
-                continue
-            x = new_x
-    x = x.astype(numpy.float32)
-    x = x.transpose(1, 2, 0)
-    return x
-
-
-class RandomTransformer:
-    def __init__(self, transformers):
-        self.transformers = transformers
-
-    def __call__(self, x):
-        return random_transformer(x, self.transformers)
+from utils.dataset import MinecraftSegmentation, VariantCache
+from utils.transform import FCompose, JointResize, JointRareClassCrop
+from utils.pipeline import compile_pipeline
 
 
 reverse_map = {v: k for k, v in segment_mapping.items()}
@@ -57,6 +27,10 @@ to_train = ['log/oak', 'leaves/oak', 'coal_ore', 'stone/stone']
 train_id = [reverse_map[k] for k in to_train]
 
 RESIZE = 1/4
+# crop size for crops focused on rare blocks, None disables cropping
+CROP_SIZE = None
+# crop sampling weights for None + to_train classes
+CROP_WEIGHTS = [0, 1, 1, 4, 1]
 
 
 def replace(segm, to_merge):
@@ -81,31 +55,31 @@ def transform_item_1channel(item):
 
 
 def make_noisy_transformers():
-    from utils.noise import AdditiveGaussian, RandomBrightness, AdditiveShade, MotionBlur, SaltPepper, RandomContrast
     # ColorInversion doesn't seem to be usefull on most datasets
-    transformer = [
-                   AdditiveGaussian(var=30),
-                   RandomBrightness(range=(-50, 50)),
-                   AdditiveShade(kernel_size_range=[45, 85],
-                                 transparency_range=(-0.25, .45)),
-                   SaltPepper(),
-                   MotionBlur(max_kernel_size=5),
-                   RandomContrast([0.6, 1.05])
-                   ]
-    return RandomTransformer(transformer)
+    ops = [dict(name='additive_gaussian', var=30),
+           dict(name='random_brightness', range=(-50, 50)),
+           dict(name='additive_shade', kernel_size_range=[45, 85],
+                transparency_range=(-0.25, .45)),
+           dict(name='salt_and_pepper'),
+           dict(name='motion_blur', max_kernel_size=5),
+           dict(name='random_contrast', strength_range=[0.6, 1.05])]
+    for op in ops:
+        op['p'] = 0.2
+    # HWC float32 images, shade and blur run in CHW
+    return compile_pipeline(ops)
 
 random_t = make_noisy_transformers()
+# geometric transforms, image and segmentation are processed together
+joint_t = FCompose([JointResize(scale=RESIZE, interpolation=cv2.INTER_NEAREST)])
+crop_t = JointRareClassCrop(CROP_SIZE, CROP_WEIGHTS, uniform_ratio=0.3,
+                            class_map=lambda mask: mask.argmax(axis=2))
 
 def transform_item_nchannel(item):
     image, segm_image = item
 
     height, width, _ = image.shape
     assert height == 240 * 4
-    image = cv2.resize(image, (int(width * RESIZE), int(height * RESIZE)),
-                fx=RESIZE, fy=RESIZE, interpolation=cv2.INTER_NEAREST)
-
-    segm_image = cv2.resize(segm_image, (int(width * RESIZE), int(height * RESIZE)),
-                fx=RESIZE, fy=RESIZE, interpolation=cv2.INTER_NEAREST)
+    image, segm_image = joint_t(data=image, target=segm_image)
 
     height, width, _ = image.shape
     segm_image1 = replace(segm_image.copy(), to_merge)
@@ -113,6 +87,8 @@ def transform_item_nchannel(item):
     for i, t in enumerate(to_train):
         mask[:, :, i + 1] = numpy.all(segm_image1 == reverse_map[to_train[i]], axis=2)
     mask[:, :, 0] = ~ (mask[:, :, 1:].sum(2) > 0)
+    if CROP_SIZE is not None:
+        image, mask = crop_t(data=image, target=mask)
 
     image1 = random_t(image)
     # cv2.imshow('transformed', image1.astype(numpy.uint8))
@@ -130,9 +106,14 @@ if __name__ == '__main__':
     train = True
     n_epochs = 100
     batch_size = 22
+    # number of augmented variants stored per image, 0 disables the cache
+    n_variants = 4
 
     data_set = MinecraftSegmentation(imagedir='train',
                                      transform=transform_item_nchannel)
+    if n_variants:
+        data_set = VariantCache(data_set, 'train_cache', k=n_variants)
+        data_set.start_refresh()
     loader = DataLoader(data_set, batch_size=batch_size, shuffle=True)
     # +1 for None
     net = GoodPoint(8, len(to_train) + 1, n_channels=3, depth=train_depth, batchnorm=False).to(device)
@@ -1,7 +1,6 @@
 """
 cliff-walking environment and agent
 """
-import cv2
 import logging
 import random
 import time
@@ -15,6 +14,10 @@ from collections import deque
 import tagilmo.utils.mission_builder as mb
 from tagilmo.utils.vereya_wrapper import MCConnector
 from utils import common
+from utils import dqn
+from utils import embed
+from utils import inference
+from utils import replay
 from utils.common import stop_motion
 from mcdemoaux.vision.network import QVisualNetwork
 
@@ -22,10 +25,13 @@ BLOCK_TYPE = 0
 HEIGHT = 2
 DIST = -1
 
-class QVisualNetworkV2(QVisualNetwork):
+class QVisualNetworkV2(inference.InferenceMixin, QVisualNetwork):
     def __init__(self, n_prev_images, *args, **kwargs):
         super().__init__(*args, **kwargs)
+        self.init_inference()
         self.n_prev_images = n_prev_images
+        # yaws + dists + heights + actions
+        self.state_embed = embed.StateEmbed(angles=(0, 3), dists=(3, 6), rest=(6, None))
         num = kwargs.get('num', 128)
         num1 = num * 2
         # fully connected
@@ -40,7 +46,7 @@ class QVisualNetworkV2(QVisualNetwork):
         self.residual = False
 
 
-    def forward(self, data):
+    def q_forward(self, data):
         """
 
         Parameters:
@@ -55,23 +61,17 @@ class QVisualNetworkV2(QVisualNetwork):
         # images are stacked along channel dimention,
         # they need to be translated to batch dimention
         B, T, C, H, W = x.shape
-        x = self.vgg(x.view(-1, C, H, W))
-        visual_data = self.pooling(x).view(B, T, -1)
+        visual_data = self.encode_stacked(x, data.get('frame_ids'))
 
         state = data['state']
         if len(state.shape) == 1:
             state = state.unsqueeze(0)
 
         state_data = state.to(next(self.conv1a.parameters()))
-        # yaws + dists + heights + actions
-        angle_emb = common.angle_embed(state_data[:, :3])
-        dist_emb = common.dist_embed(state_data[:, 3:6])
-        state_data = torch.cat([angle_emb, dist_emb, state_data[:, 6:]], dim=1)
-        state_emb = self.pos_emb(state_data)
+        state_emb = self.pos_emb(self.state_embed(state_data))
         visual_pos_emb = torch.cat([visual_data.view(B, -1), state_emb], dim=1)
         result = self.q_value(visual_pos_emb)
-        if torch.isnan(result).any().item():
-            import pdb;pdb.set_trace()
+        self.nan_check(result)
 
         return result
 
@@ -144,9 +144,18 @@ def load_agent(path):
     policy_net = QVisualNetworkV2(3, actionSet, 0, 32,  n_channels=3, activation=nn.LeakyReLU(), batchnorm=False, num=256)
     target_net = QVisualNetworkV2(3, actionSet, 0, 32,  n_channels=3, activation=nn.LeakyReLU(), batchnorm=False, num=256)
     batch_size = 18
+    if not torch.cuda.is_available():
+        # choose the fastest acting configuration for this cpu
+        inference.benchmark(policy_net, dict(images=torch.zeros(3, 3, 240, 320),
+                                             state=torch.zeros(5)))
 
     transformer = common.make_noisy_transformers()
-    my_simple_agent = network.DQN(policy_net, target_net, 0.99, batch_size, 450, capacity=7000, transform=transformer)
+    # target features of replayed frames are reused until the next target sync
+    target_net.enable_target_cache(7000 * 3)
+    my_simple_agent = dqn.PrioritizedDQN(policy_net, target_net, 0.99, batch_size, 450, capacity=7000,
+                                         transform=transformer,
+                                         memory=replay.PrioritizedReplayMemory(7000, 'replay_dig'),
+                                         prefetch=4)
     location = 'cuda' if torch.cuda.is_available() else 'cpu'
     if os.path.exists(path):
         logging.info('loading model from %s', path)
@@ -171,6 +180,8 @@ def inverse_priority_sample(weights: numpy.array):
 
 class Trainer(common.Trainer):
     want_depth = False
+    # existing checkpoints were trained on frames rendered at 1280x960 and downscaled
+    supersample = 4
 
     def __init__(self, agent, mc, optimizer, eps, train=True):
         super().__init__(train)
@@ -183,6 +194,7 @@ class Trainer(common.Trainer):
         self.eps = eps
         self.img_num = 0
         self.state_queue = deque(maxlen=2)
+        self.preprocess = self.frame_spec().preprocessor()
 
     def _random_turn(self):
         turn = numpy.random.random() * random.choice([-1, 1])
@@ -204,18 +216,14 @@ class Trainer(common.Trainer):
 
     def collect_state(self):
         mc = self.mc
-        mc.observeProc()
-        aPos = mc.getAgentPos()
-        img_data = self.mc.getImage()
-        logging.debug(aPos)
-        while aPos is None or (img_data is None):
-            time.sleep(0.05)
-            mc.observeProc()
-            aPos = mc.getAgentPos()
-            img_data = self.mc.getImage()
+
+        def check_alive():
             if not all(mc.isAlive):
                 raise DeadException()
 
+        aPos, img_data = self.wait_observations(check_alive)
+        logging.debug(aPos)
+
         # target
         xpos, ypos, zpos = aPos[0:3]
         logging.debug("%.2f %.2f %.2f ", xpos, ypos, zpos)
@@ -223,28 +231,32 @@ class Trainer(common.Trainer):
         ypos = 30 - aPos[1]
         data = dict()
 
-        img_data = img_data.reshape((240 * 4, 320 * 4, 3 + self.want_depth))
-        img_data = cv2.resize(img_data, (320, 240))
-        img = img_data.reshape((240, 320, 3 + self.want_depth)).transpose(2, 0, 1) / 255.
-        img = torch.as_tensor(img).float()
+        img = self.preprocess(img_data)
         data['image'] = img
+        # identifies the frame for the policy's feature cache
+        frame_id = self.next_frame_id()
 
         actions = []
         imgs = [torch.as_tensor(img)]
+        frame_ids = [frame_id]
         heights = [torch.as_tensor(ypos)]
         # first prev, then prev_prev etc..
         for item in reversed(self.state_queue):
             actions.append(item['action'])
             imgs.append(item['image'])
+            frame_ids.append(int(item['frame_id']))
             heights.append(item['ypos'])
         while len(imgs) < 3:
             imgs.append(img.to(img))
+            frame_ids.append(frame_id)
             actions.append(torch.as_tensor(-1).to(img))
             heights.append(torch.as_tensor(ypos).to(img))
         state = torch.as_tensor(heights + actions)
         data.update(dict(state=state,
                          images=torch.stack(imgs),
                          image=img,
+                         frame_id=torch.as_tensor(frame_id),
+                         frame_ids=torch.as_tensor(frame_ids),
                          ypos=torch.as_tensor(ypos)
                          ))
 
@@ -257,11 +269,63 @@ class Trainer(common.Trainer):
                 assert not torch.isnan(value).any()
         return data
 
-    def _end(self):
-        mean_loss = numpy.mean([self.learn(self.agent, self.optimizer) for _ in range(5)])
+    def _end(self, t):
+        mean_loss = self.learn_episode(t, 5)
         logging.info('mean loss %f', mean_loss)
 
 
+    def step_reward(self, data, life, prev_life):
+        """
+        shaped reward for the transition from the last state in state_queue to data
+        """
+        reward = 0
+        if 'visible' in self.state_queue[-1]:
+            prev_action = self.agent.policy_net.actions[0].to_string(self.state_queue[-1]['action'])
+            prev_item = self.state_queue[-1]['visible']
+            logging.debug(prev_item)
+            prev_dist = prev_item[DIST]
+            prev_block = prev_item[BLOCK_TYPE]
+            if prev_block in ('water', 'lava', 'flowing_lava'):
+                reward -= 2
+            if prev_action == 'attack 1':
+                h_target = 24
+                if prev_dist <= 4:
+                    reward += 0.5
+                else:
+                    reward -= 1
+                if 'visible' in data:
+                    current_dist = data['visible'][-1]
+                    # if block is removed visible would change
+                    if (0.1 < (current_dist - prev_dist)):
+                        logging.debug('distance is more than before!')
+                        reward += 1
+                        if prev_block in ('double_plant', 'tallgrass'):
+                            reward -= 0.5
+                        tmp = ((30 - h_target) - abs(prev_item[HEIGHT] - h_target))
+                        logging.info('tmp dist %f', tmp)
+                        tmp = max(tmp, 0) ** 2
+                        if h_target < prev_item[HEIGHT]:
+                            tmp /= 3
+                        reward += tmp
+                        if prev_block not in ('dirt', 'grass', 'stone', 'double_plant', 'tallgrass', 'leaves', 'log'):
+                            reward += 25
+                    else:
+                        # give small reward for removing block under self
+                        prev_height = 30 - self.state_queue[-1]['ypos']
+                        curr_height = 30 - data['ypos']
+                        if curr_height < prev_height:
+                            tmp = ((30 - h_target) - abs(prev_height - h_target))
+                            logging.debug('removed block!')
+                            logging.debug('tmp dist %f', tmp)
+                            reward += max(tmp, 0) ** 2 / 2
+        else:
+            if 'visible' not in data:
+                logging.debug('not visible')
+                reward -= 1
+        reward -= 1
+        reward += (life - prev_life) * 2
+        return reward
+
     def run_episode(self):
         """ Deep Q-Learning episode
         """
@@ -294,6 +358,8 @@ class Trainer(common.Trainer):
 
         while True:
             t += 1
+            if self.learner is not None:
+                self.learner.maybe_pull()
             logging.debug('\n\n\nstep %i', t)
             # target = search4blocks(mc, ['lapis_block'], run=False)
             reward = 0
@@ -317,57 +383,14 @@ class Trainer(common.Trainer):
                         self.agent.push_final(reward)
                     self.learn(self.agent, self.optimizer)
                     break
-                if 'visible' in self.state_queue[-1]:
-                    prev_action = self.agent.policy_net.actions[0].to_string(self.state_queue[-1]['action'])
-                    prev_item = self.state_queue[-1]['visible']
-                    logging.debug(prev_item)
-                    prev_dist = prev_item[DIST]
-                    prev_block = prev_item[BLOCK_TYPE]
-                    if prev_block in ('water', 'lava', 'flowing_lava'):
-                        reward -= 2
-                    if prev_action == 'attack 1':
-                        h_target = 24
-                        if prev_dist <= 4:
-                            reward += 0.5
-                        else:
-                            reward -= 1
-                        if 'visible' in data:
-                            current_dist = data['visible'][-1]
-                            # if block is removed visible would change
-                            if (0.1 < (current_dist - prev_dist)):
-                                logging.debug('distance is more than before!')
-                                reward += 1
-                                if prev_block in ('double_plant', 'tallgrass'):
-                                    reward -= 0.5
-                                tmp = ((30 - h_target) - abs(prev_item[HEIGHT] - h_target))
-                                logging.info('tmp dist %f', tmp)
-                                tmp = max(tmp, 0) ** 2
-                                if h_target < prev_item[HEIGHT]:
-                                    tmp /= 3
-                                reward += tmp
-                                if prev_block not in ('dirt', 'grass', 'stone', 'double_plant', 'tallgrass', 'leaves', 'log'):
-                                    reward += 25
-                            else:
-                                # give small reward for removing block under self
-                                prev_height = 30 - self.state_queue[-1]['ypos']
-                                curr_height = 30 - data['ypos']
-                                if curr_height < prev_height:
-                                    tmp = ((30 - h_target) - abs(prev_height - h_target))
-                                    logging.debug('removed block!')
-                                    logging.debug('tmp dist %f', tmp)
-                                    reward += max(tmp, 0) ** 2 / 2
-                else:
-                    if 'visible' not in data:
-                        logging.debug('not visible')
-                        reward -= 1
-                reward -= 1
-                reward += (life - prev_life) * 2
+                reward = self.step_reward(data, life, prev_life)
                 prev_life = life
                 if not mc.is_mission_running():
                     logging.debug('failed in %i steps', t)
                     reward = -100
             logging.debug("current reward %f", reward)
-            new_actions = self.agent(data, reward=reward, epsilon=eps)
+            with inference.acting(self.agent.policy_net):
+                new_actions = self.agent(data, reward=reward, epsilon=eps)
             eps = max(eps * eps_decay, eps_end)
             logging.debug('epsilon %f', eps)
             data['action'] = self.agent.prev_action
@@ -393,7 +416,7 @@ class Trainer(common.Trainer):
         if aPos is not None and aPos[1] <= 25:
             solved = True
         logging.debug("Final reward: %f", reward)
-        self._end()
+        self._end(t)
         return total_reward, t, solved
 
     def act(self, actions):
@@ -409,7 +432,7 @@ class Trainer(common.Trainer):
     @classmethod
     def init_mission(cls, i, mc, start_x=None, start_y=None):
         miss = mb.MissionXML()
-        video_producer = mb.VideoProducer(width=320 * 4, height=240 * 4, want_depth=cls.want_depth)
+        video_producer = cls.frame_spec().video_producer()
 
         obs = mb.Observations()
 
@@ -451,3 +474,61 @@ class Trainer(common.Trainer):
             mc.setMissionXML(miss)
         return mc
 
+
+
+class DigEnv:
+    """
+    Environment for utils.vec_actor.VecActor on top of Trainer,
+    one instance per MCConnector
+    """
+    def __init__(self, trainer, max_t=250):
+        self.trainer = trainer
+        self.max_t = max_t
+        self.episode = 0
+        self.t = 0
+        self.prev_life = 20
+
+    def reset(self):
+        trainer = self.trainer
+        if self.episode:
+            trainer.mc = trainer.init_mission(self.episode, trainer.mc)
+            trainer.mc.safeStart()
+        self.episode += 1
+        self.t = 0
+        self.prev_life = 20
+        trainer.state_queue.clear()
+        trainer._random_turn()
+        try:
+            data = trainer.collect_state()
+        except DeadException:
+            return self.reset()
+        if data['ypos'] < 0:
+            return self.reset()
+        return data
+
+    def step(self, data, action, commands):
+        trainer = self.trainer
+        mc = trainer.mc
+        data['action'] = action
+        trainer.state_queue.append(copy.copy(data))
+        data.pop('visible', None)
+        trainer.act(commands)
+        time.sleep(0.4)
+        stop_motion(mc)
+        time.sleep(0.1)
+        self.t += 1
+        try:
+            next_data = trainer.collect_state()
+        except DeadException:
+            stop_motion(mc)
+            return None, -100, True
+        life = mc.getLife()
+        if life == 0 or not mc.is_mission_running():
+            stop_motion(mc)
+            return None, -100, True
+        reward = trainer.step_reward(next_data, life, self.prev_life)
+        self.prev_life = life
+        if self.t == self.max_t:
+            mc.sendCommand("quit")
+            return None, reward, True
+        return next_data, reward, False
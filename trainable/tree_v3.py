@@ -10,12 +10,15 @@ import os
 from mcdemoaux.vision import network
 from mcdemoaux.vision.network import QVisualNetwork
 import numpy
-import cv2
 from collections import deque
 
 import tagilmo.utils.mission_builder as mb
 from tagilmo.utils.vereya_wrapper import MCConnector
 from utils import common
+from utils import dqn
+from utils import embed
+from utils import inference
+from utils import replay
 from utils.common import stop_motion
 from tagilmo.utils.mathutils import toRadAndNorm
 
@@ -33,10 +36,13 @@ class DeadException(RuntimeError):
         super().__init__("it's dead")
 
 
-class QVisualNetworkTree(QVisualNetwork):
+class QVisualNetworkTree(inference.InferenceMixin, QVisualNetwork):
     def __init__(self, n_prev_images, *args, **kwargs):
         super().__init__(*args, **kwargs)
+        self.init_inference()
         self.n_prev_images = n_prev_images
+        # yaws and pitches embedded, actions as is
+        self.state_embed = embed.StateEmbed(angles=(2, None), rest=(0, 2))
         num = kwargs.get('num', 128)
         num1 = num * 2
         # fully connected
@@ -51,7 +57,7 @@ class QVisualNetworkTree(QVisualNetwork):
         self.residual = False
         self.state_queue = deque(maxlen=2)
 
-    def forward(self, data):
+    def q_forward(self, data):
         """
 
         Parameters:
@@ -66,8 +72,7 @@ class QVisualNetworkTree(QVisualNetwork):
         # images are stacked along channel dimention,
         # they need to be translated to batch dimention
         B, T, C, H, W = x.shape
-        x = self.vgg(x.view(-1, C, H, W))
-        visual_data = self.pooling(x).view(B, T, -1)
+        visual_data = self.encode_stacked(x, data.get('frame_ids'))
 
         state = data['state']
         if len(state.shape) == 1:
@@ -75,15 +80,10 @@ class QVisualNetworkTree(QVisualNetwork):
 
         state_data = state.to(next(self.conv1a.parameters()))
 
-        # yaws + dists + heights + actions
-        angle_emb = common.angle_embed(state_data[:, 2:])
-        actions = state_data[:, :2]
-        state_data = torch.cat([angle_emb, actions], dim=1)
-        state_emb = self.pos_emb(state_data)
+        state_emb = self.pos_emb(self.state_embed(state_data))
         visual_pos_emb = torch.cat([visual_data.view(B, -1), state_emb], dim=1)
         result = self.q_value(visual_pos_emb)
-        if torch.isnan(result).any().item():
-            import pdb;pdb.set_trace()
+        self.nan_check(result)
 
         return result
 
@@ -107,10 +107,19 @@ def load_agent(path):
     policy_net = QVisualNetworkTree(1, actionSet, 0, 34,  n_channels=3, activation=nn.LeakyReLU(), batchnorm=False, num=256)
     target_net = QVisualNetworkTree(1, actionSet, 0, 34,  n_channels=3, activation=nn.LeakyReLU(), batchnorm=False, num=256)
 
+    if not torch.cuda.is_available():
+        # choose the fastest acting configuration for this cpu
+        inference.benchmark(policy_net, dict(images=torch.zeros(1, 3, 240, 320),
+                                             state=torch.zeros(6)))
+
+    # target features of replayed frames are reused until the next target sync
+    target_net.enable_target_cache(2000)
     batch_size = 20
-    my_simple_agent = network.DQN(policy_net, target_net, 0.9,
-                                  batch_size, 450, capacity=2000,
-                                  transform=transformer)
+    my_simple_agent = dqn.PrioritizedDQN(policy_net, target_net, 0.9,
+                                         batch_size, 450, capacity=2000,
+                                         transform=transformer,
+                                         memory=replay.PrioritizedReplayMemory(2000, 'replay_tree'),
+                                         prefetch=4)
 
     if os.path.exists('agent_tree.pth'):
         location = 'cuda' if torch.cuda.is_available() else 'cpu'
@@ -123,6 +132,8 @@ def load_agent(path):
 
 class Trainer(common.Trainer):
     want_depth = False
+    # agent_tree.pth was trained on frames rendered at 1280x960 and downscaled
+    supersample = 4
 
     def __init__(self, agent, mc, optimizer, eps, train=True):
         super().__init__(train)
@@ -132,6 +143,7 @@ class Trainer(common.Trainer):
         self.eps = eps
         self.agent.to(self.device)
         self.state_queue = deque(maxlen=2)
+        self.preprocess = self.frame_spec().preprocessor()
 
     def is_tree_visible(self):
         logging.debug(self.mc.getLineOfSight('type'))
@@ -161,28 +173,18 @@ class Trainer(common.Trainer):
             pitch, prev_pitch,
             yaw - prev_yaw, prev_yaw - prev_prev_yaw
         """
-        mc = self.mc
-        mc.observeProc()
-        aPos = mc.getAgentPos()
-        img_data = self.mc.getImage()
+        aPos, img_data = self.wait_observations()
         logging.debug(aPos)
-        while aPos is None or (img_data is None):
-            time.sleep(0.05)
-            mc.observeProc()
-            aPos = mc.getAgentPos()
-            img_data = self.mc.getImage()
         height = aPos[1]
         if height < 30: # avoid ponds and holes
             raise DeadException()
         pitch = aPos[3]
         yaw = aPos[4]
         data = dict()
-        img_data = img_data.reshape((240 * 4, 320 * 4, 3 + self.want_depth))
-        img_data = cv2.resize(img_data, (320, 240))
-        img = img_data.reshape((240, 320, 3 + self.want_depth)).transpose(2, 0, 1) / 255.
-
-        img = torch.as_tensor(img).float()
+        img = self.preprocess(img_data)
         data['image'] = img
+        # identifies the frame for the target network's feature cache
+        frame_id = self.next_frame_id()
         actions = []
 
         imgs = [torch.as_tensor(img)]
@@ -206,6 +208,8 @@ class Trainer(common.Trainer):
         data.update(dict(state=state,
                          images=torch.stack(imgs),
                          image=img,
+                         frame_id=torch.as_tensor(frame_id),
+                         frame_ids=torch.as_tensor([frame_id]),
                          reward=torch.as_tensor(0),
                          yaw=torch.as_tensor(yaw),
                          pitch=torch.as_tensor(pitch)
@@ -249,6 +253,8 @@ class Trainer(common.Trainer):
 
         while True:
             t += 1
+            if self.learner is not None:
+                self.learner.maybe_pull()
             reward = -0.2
             try:
                 data = self.collect_state()
@@ -312,7 +318,8 @@ class Trainer(common.Trainer):
                 #    self.agent.push_final(reward)
                 #    break
             logging.debug('reward %f', reward)
-            new_actions = self.agent(data, reward=reward, epsilon=eps)
+            with inference.acting(self.agent.policy_net):
+                new_actions = self.agent(data, reward=reward, epsilon=eps)
             data['action'] = self.agent.prev_action
             eps = max(eps * eps_decay, eps_end)
             logging.debug('epsilon %f', eps)
@@ -335,7 +342,7 @@ class Trainer(common.Trainer):
         total_reward += reward
         logging.info("Final reward: %f" % reward)
 
-        mean_loss = numpy.mean([self.learn(self.agent, self.optimizer) for _ in range(3)])
+        mean_loss = self.learn_episode(t, 3)
         logging.info('loss %f', mean_loss)
         return total_reward, t, solved
 
@@ -374,7 +381,7 @@ class Trainer(common.Trainer):
     @classmethod
     def init_mission(cls, i, mc):
         miss = mb.MissionXML()
-        video_producer = mb.VideoProducer(width=320 * 4, height=240 * 4, want_depth=cls.want_depth)
+        video_producer = cls.frame_spec().video_producer()
 
         obs = mb.Observations()
         agent_handlers = mb.AgentHandlers(observations=obs,
@@ -31,6 +31,8 @@ class Trainer(tree.Trainer):
 
     def __init__(self, agent, mc, optimizer, eps, train=True):
         super().__init__(agent, mc, optimizer, eps, train)
+        # frames are kept in episode data, so every frame gets its own tensor
+        self.preprocess = self.frame_spec().preprocessor(ring=0)
 
     def _random_turn(self):
         turn = numpy.random.random() * random.choice([-1, 1])
@@ -133,36 +135,29 @@ class Trainer(tree.Trainer):
         return episode_data
 
     def collect_state(self):
-        while True:
-            self.mc.observeProc()
-            data = self.mc.getImage()
-            aPos = self.mc.getAgentPos()
-
-            if not any(x is None for x in (data, aPos)):
-                pitch_raw = degree2rad(aPos[3])
-                yaw_raw = degree2rad(aPos[4])
-                self_pitch = toRadAndNorm(aPos[3])
-                self_yaw = toRadAndNorm(aPos[4])
-
-                data = data.reshape((240, 320, 3 + self.want_depth)).transpose(2, 0, 1) / 255.
-                pitch_yaw = torch.as_tensor([self_pitch, self_yaw])
-                pitch_yaw_raw = torch.as_tensor([pitch_raw, yaw_raw])
-                height = 1.6025
-                x, y, z = aPos[0:3]
-                y += height
-                visible = self.observe_by_line()
-                return dict(image=torch.as_tensor(data).float(),
-                            pitch_yaw=pitch_yaw,
-                            pitch_yaw_raw=pitch_yaw_raw,
-                            coordinates=[x, y, z],
-                            visible=visible)
-            else:
-                time.sleep(0.05)
+        aPos, data = self.wait_observations()
+        pitch_raw = degree2rad(aPos[3])
+        yaw_raw = degree2rad(aPos[4])
+        self_pitch = toRadAndNorm(aPos[3])
+        self_yaw = toRadAndNorm(aPos[4])
+
+        data = self.preprocess(data)
+        pitch_yaw = torch.as_tensor([self_pitch, self_yaw])
+        pitch_yaw_raw = torch.as_tensor([pitch_raw, yaw_raw])
+        height = 1.6025
+        x, y, z = aPos[0:3]
+        y += height
+        visible = self.observe_by_line()
+        return dict(image=data,
+                    pitch_yaw=pitch_yaw,
+                    pitch_yaw_raw=pitch_yaw_raw,
+                    coordinates=[x, y, z],
+                    visible=visible)
 
     @classmethod
     def init_mission(cls, i, mc):
         miss = mb.MissionXML()
-        video_producer = mb.VideoProducer(width=320, height=240, want_depth=cls.want_depth)
+        video_producer = cls.frame_spec().video_producer()
 
         obs = mb.Observations()
         agent_handlers = mb.AgentHandlers(observations=obs,
@@ -0,0 +1,164 @@
+"""
+Checkpoints of training state written in background
+
+State is copied on the training thread, which takes a few milliseconds,
+serialization and disk writes run in a background thread one checkpoint
+after another. Every file is written to a temporary name and renamed, so
+a killed run leaves either the old or the new checkpoint, never a partial one.
+"""
+import copy
+import glob
+import logging
+import os
+import random
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy
+import torch
+
+
+def _to_cpu(obj):
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return {key: _to_cpu(value) for key, value in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(_to_cpu(value) for value in obj)
+    return copy.deepcopy(obj)
+
+
+def rng_state():
+    state = dict(python=random.getstate(),
+                 numpy=numpy.random.get_state(),
+                 torch=torch.get_rng_state())
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    random.setstate(state['python'])
+    numpy.random.set_state(state['numpy'])
+    torch.set_rng_state(state['torch'])
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
+def atomic_save(obj, path):
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        torch.save(obj, f, _use_new_zipfile_serialization=False)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+class CheckpointManager:
+    """
+    Rotating checkpoints of agent, optimizer, RNG and replay memory
+
+    Parameters
+    ----------
+    directory: str
+        directory for checkpoint files
+    keep: int
+        number of latest checkpoints to keep
+    weights_path: str
+        optional path where agent state dict alone is saved as well,
+        in the format expected by load_agent functions
+    """
+    def __init__(self, directory, keep=3, weights_path=None):
+        self.directory = directory
+        self.keep = keep
+        self.weights_path = weights_path
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        # one writer thread, checkpoints are written and rotated in order
+        self._pool = ThreadPoolExecutor(max_workers=1)
+        self._pending = []
+
+    def _path(self, step):
+        return os.path.join(self.directory, 'checkpoint_{0:07d}.pth'.format(step))
+
+    def checkpoints(self):
+        return sorted(glob.glob(os.path.join(self.directory, 'checkpoint_*.pth')))
+
+    def save(self, step, agent_state, optimizer=None, memory=None, **extra):
+        """
+        Snapshot training state and write it in background
+
+        Parameters
+        ----------
+        step: int
+            e.g. episode number, identifies checkpoint
+        agent_state: dict
+            state dict of the agent
+        optimizer: torch.optim.Optimizer
+        memory: utils.replay.FrameReplayMemory
+            replay memory with path, its positions and priorities are taken
+            now and the memory is flushed in background
+        extra:
+            other picklable values, e.g. epsilon
+        """
+        snapshot = dict(step=step,
+                        agent=_to_cpu(agent_state),
+                        rng=rng_state(),
+                        extra=copy.deepcopy(extra))
+        if optimizer is not None:
+            snapshot['optimizer'] = _to_cpu(optimizer.state_dict())
+        memory_snapshot = None
+        if memory is not None and hasattr(memory, 'snapshot'):
+            memory_snapshot = memory.snapshot()
+        self._pending = [f for f in self._pending if not f.done()]
+        self._pending.append(self._pool.submit(self._write, snapshot, memory, memory_snapshot))
+
+    def _write(self, snapshot, memory, memory_snapshot):
+        try:
+            if memory_snapshot is not None:
+                memory.flush(memory_snapshot)
+            atomic_save(snapshot, self._path(snapshot['step']))
+            if self.weights_path is not None:
+                atomic_save(snapshot['agent'], self.weights_path)
+            for path in self.checkpoints()[:-self.keep]:
+                os.remove(path)
+            logging.debug('saved checkpoint %i', snapshot['step'])
+        except Exception:
+            logging.exception('failed to save checkpoint %i', snapshot['step'])
+            raise
+
+    def wait(self):
+        """
+        wait until all saved checkpoints are written
+        """
+        for future in self._pending:
+            try:
+                future.result()
+            except Exception:
+                # logged by _write, training goes on without this checkpoint
+                pass
+        self._pending = []
+
+    def load_latest(self, agent=None, optimizer=None, map_location=None):
+        """
+        Restore the latest checkpoint, returns its dict or None if there are no checkpoints
+
+        Agent and optimizer state and RNG state are restored,
+        values passed as extra to save() are in result['extra'].
+        Keys of the agent state must match, RuntimeError is raised otherwise.
+        """
+        paths = self.checkpoints()
+        if not paths:
+            return None
+        # own files, they hold rng state which is not plain tensors
+        result = torch.load(paths[-1], map_location=map_location, weights_only=False)
+        if agent is not None:
+            agent.load_state_dict(result['agent'])
+        if optimizer is not None and 'optimizer' in result:
+            optimizer.load_state_dict(result['optimizer'])
+        set_rng_state(result['rng'])
+        logging.info('resumed from checkpoint %s', paths[-1])
+        return result
+
+    def close(self):
+        self.wait()
+        self._pool.shutdown()
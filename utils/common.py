@@ -5,10 +5,12 @@ try:
     import torch
 except ImportError:
     pass
+import itertools
 import math
+import threading
 import numpy
 import numpy.linalg
-from time import sleep
+from time import sleep, time_ns
 from tagilmo.utils.mathutils import normAngle, degree2rad
 
 logger = logging.getLogger()
@@ -81,20 +83,80 @@ block_id_cliff_walking = {'air': 0,
 max_id_blocks_walking = max(block_id_cliff_walking.values())
 
 
+class GridEncoder:
+    """
+    Encoder of getNearGrid observations, block names are mapped to ids
+    with a list of dict lookups, features are computed by table lookup
+
+    Parameters
+    ----------
+    vocabulary: dict
+        block name -> id, ids are in range [0, max id]
+    unknown: int
+        id of blocks missing in vocabulary, None adds a separate id max id + 1
+    """
+    def __init__(self, vocabulary, unknown=None):
+        self.vocabulary = dict(vocabulary)
+        max_id = max(self.vocabulary.values())
+        self.n_ids = max_id + 1 if unknown is not None else max_id + 2
+        self.unknown = unknown if unknown is not None else max_id + 1
+        self.reported = set()
+        step = 2 / (max_id + 1)
+        self.one_hot_table = numpy.eye(self.n_ids)
+        self.real_table = -1. + numpy.arange(self.n_ids) * step + 0.5 * step
+
+    def _id(self, name):
+        idx = self.vocabulary.get(name)
+        if idx is None:
+            if name not in self.reported:
+                self.reported.add(name)
+                logging.warning('unknown block %s encoded as id %i', name, self.unknown)
+            idx = self.unknown
+        return idx
+
+    def _ids(self, names):
+        get = self.vocabulary.get
+        ids = [get(name, -1) for name in names]
+        if -1 in ids:
+            ids = [self._id(name) for name in names]
+        return ids
+
+    def _index(self, grids):
+        # a list of ids indexes tables directly, without a conversion to array
+        if not len(grids) or isinstance(grids[0], str):
+            return self._ids(grids)
+        ids = self._ids([name for grid in grids for name in grid])
+        return numpy.asarray(ids, dtype=numpy.int64).reshape(len(grids), -1)
+
+    def ids(self, grids):
+        """
+        ids of blocks for a grid (N,) or a batch of grids (B, N)
+        """
+        return numpy.asarray(self._index(grids), dtype=numpy.int64)
+
+    def one_hot(self, grids):
+        """
+        (N,) -> (N, n_ids) or (B, N) -> (B, N, n_ids)
+        """
+        return self.one_hot_table[self._index(grids)]
+
+    def real(self, grids):
+        """
+        id of every block mapped to the middle of its bin in [-1, 1]
+        """
+        return self.real_table[self._index(grids)]
+
+
+# unknown blocks are treated as solid
+walking_encoder = GridEncoder(block_id_cliff_walking, unknown=max_id_blocks_walking)
+
+
 def grid_to_vec_walking(block_list):
-    codes = numpy.zeros((len(block_list), max_id_blocks_walking + 1))
-    for i,item in enumerate(block_list):
-        codes[i][block_id_cliff_walking[item]] = 1
-    return codes
+    return walking_encoder.one_hot(block_list)
 
 
 def grid_to_real_feature_vec_walking(block_list):
-    codes = numpy.zeros(len(block_list))
-    feature_step = 2/(max_id_blocks_walking + 1)
-    for i,item in enumerate(block_list):
-        feature_val = -1.+block_id_cliff_walking[item]*feature_step+0.5*feature_step
-        codes[i] = feature_val
-    return codes
+    return walking_encoder.real(block_list)
 
 
 def rotation_matrix(roll, pitch, yaw):
@@ -165,37 +227,74 @@ def stop_motion(mc):
     mc.sendCommand('jump 0')
 
 
-def learn(agent, optimizer):
-    losses = []
-    means = []
-    means1 = []
-    means_change = []
-    for i in range(40):
+def learn(agent, optimizer, n_steps=40, probe_every=0):
+    """
+    Run n_steps optimization steps on minibatches sampled by agent
+
+    Diagnostic metrics are accumulated on the device and copied
+    to host once per call.
+
+    Parameters
+    ----------
+    n_steps: int
+        number of minibatches
+    probe_every: int
+        measure change of conv1a weights every probe_every-th step, 0 disables the probe
+    """
+    policy_net = agent.policy_net
+    params = [p for p in policy_net.parameters() if p.requires_grad]
+    metrics = []
+    changes = []
+    for i in range(n_steps):
         optimizer.zero_grad()
         loss = agent.compute_loss()
         if loss is not None:
             # Optimize the model
             loss.backward()
             # torch.nn.utils.clip_grad_norm_(agent.parameters(), 2)
-            for param in agent.policy_net.parameters():
-                param.grad.data.clamp_(-1, 1)
-            weights1 = agent.policy_net.conv1a.weight.clone()
+            # multi-tensor clamp of all gradients
+            torch.nn.utils.clip_grad_value_(params, 1)
+            probe = probe_every and i % probe_every == 0
+            if probe:
+                weights1 = policy_net.conv1a.weight.detach().clone()
             optimizer.step()
-            weights2 = agent.policy_net.conv1a.weight.clone()
-            means1.append(agent.policy_net.q_value[0].weight.grad.abs().mean().cpu().detach())
-            means_change.append((weights2 - weights1).abs().mean().cpu().detach())
-            means.append(agent.policy_net.conv1a.weight.grad.abs().mean().cpu().detach())
-            losses.append(loss.cpu().detach())
-    if losses:
-        logging.debug('optimizing')
-        logging.debug('loss %f', numpy.mean(losses))
-        logging.debug('mean conv1a %f', numpy.mean(means))
-        logging.debug('mean change conv1a %f', numpy.mean(means_change))
-        logging.debug('mean qvalue.0 %f', numpy.mean(means1))
-    return numpy.mean(losses)
+            if probe:
+                changes.append((policy_net.conv1a.weight.detach() - weights1).abs().mean())
+            metrics.append(torch.stack([loss.detach().reshape(()),
+                                        policy_net.conv1a.weight.grad.abs().mean(),
+                                        policy_net.q_value[0].weight.grad.abs().mean()]))
+    if not metrics:
+        return numpy.nan
+    values = torch.stack(metrics).mean(dim=0)
+    if changes:
+        values = torch.cat([values, torch.stack(changes).mean().reshape(1)])
+    # single host sync
+    values = values.tolist()
+    logging.debug('optimizing')
+    logging.debug('loss %f', values[0])
+    logging.debug('mean conv1a %f', values[1])
+    if changes:
+        logging.debug('mean change conv1a %f', values[3])
+    logging.debug('mean qvalue.0 %f', values[2])
+    return values[0]
+
+
+# replay memory is persisted between runs, so ids start from current time;
+# trainers acting together share a replay memory and feature caches
+_frame_ids = itertools.count(time_ns() // 1000)
+_frame_id_lock = threading.Lock()
 
 
 class Trainer:
+    # utils.learner.BackgroundLearner, if set learning runs in background
+    learner = None
+    # utils.schedule.UpdateScheduler, if set it decides how much to learn after episode
+    scheduler = None
+    # frames used by the trainer, see frame_spec()
+    frame_size = (320, 240)
+    want_depth = False
+    supersample = 1
+
     def __init__(self, train=True):
         self.train = train
         if not self.train:
@@ -203,6 +302,43 @@ class Trainer:
         self.device = 'cuda' if torch.cuda.is_available() else 'cpu'
         logging.info('using device {0}'.format(self.device))
 
+    def next_frame_id(self):
+        """
+        id of a new observed frame, used as a key of visual feature caches
+        and replay memory, unique among all trainers of the process
+        """
+        with _frame_id_lock:
+            return next(_frame_ids)
+
+    @classmethod
+    def frame_spec(cls):
+        """
+        utils.frames.FrameSpec, used for the video producer of the mission
+        and for preprocessing of received frames
+        """
+        from utils.frames import FrameSpec
+        width, height = cls.frame_size
+        return FrameSpec(width, height, depth=cls.want_depth, supersample=cls.supersample)
+
+    @property
+    def observations(self):
+        """
+        utils.observe.ObservationHub of the connector
+        """
+        from utils.observe import hub_for
+        return hub_for(self.mc)
+
+    def wait_observations(self, check=None):
+        """
+        agent position and the frame as returned by mc.getImage(),
+        polls the connector until both are received
+
+        check is called while they are missing, e.g. to raise if the agent died
+        """
+        from utils.observe import FRAME, POSE
+        img_data, aPos = self.observations.wait((FRAME, POSE), check=check)
+        return aPos, img_data
+
     def collect_state(self):
         raise NotImplementedError()
 
@@ -212,10 +348,27 @@ class Trainer:
         raise NotImplementedError()
 
     def learn(self, *args, **kwargs):
+        if self.learner is not None:
+            # learner runs in background, just refresh acting weights
+            self.learner.pull()
+            return self.learner.last_loss
         if self.train:
             return learn(*args, **kwargs)
         return 0
 
+    def learn_episode(self, env_steps, repeats):
+        """
+        learning after episode, returns mean loss
+
+        repeats: number of learn calls if there is no scheduler
+        """
+        if self.scheduler is None or self.learner is not None or not self.train:
+            losses = [self.learn(self.agent, self.optimizer) for _ in range(repeats)]
+        else:
+            self.scheduler.record_env_steps(env_steps)
+            losses = self.scheduler.run(lambda n: self.learn(self.agent, self.optimizer, n_steps=n))
+        return numpy.mean(losses) if losses else numpy.nan
+
     def act(self, actions):
         raise NotImplementedError()
 
@@ -231,7 +384,7 @@ def vectors_angle(vec1, vec2):
 
 
 def dist_embed(d, eps=1.00001):
-    d += eps
+    d = d + eps
     result = [d ** (1/2),
               d ** (1/3),
               d ** (1/4),
@@ -247,23 +400,33 @@ def angle_embed(d):
 
 
 
-def make_noisy_transformers():
+def make_noisy_transformers(profile=False):
     from torchvision.transforms import Compose
     from utils.transform import RandomTransformer, ToTensor
 
     from utils.noise import AdditiveGaussian, RandomBrightness, AdditiveShade, MotionBlur, SaltPepper, RandomContrast
+    from utils.noise import NoiseBank
     totensor = ToTensor()
+    # noise fields are allocated at the resolution of the first image
+    bank = NoiseBank()
     # ColorInversion doesn't seem to be usefull on most datasets
     transformer = [
-                   AdditiveGaussian(var=30),
+                   AdditiveGaussian(var=30, bank=bank),
                    RandomBrightness(range=(-50, 50)),
                    AdditiveShade(kernel_size_range=[45, 85],
                                  transparency_range=(-0.25, .45)),
-                   SaltPepper(),
+                   SaltPepper(bank=bank),
                    MotionBlur(max_kernel_size=5),
                    RandomContrast([0.6, 1.05])
                    ]
-    return Compose([RandomTransformer(transformer), totensor])
+    profiler = None
+    if profile:
+        from utils.profiler import TransformProfiler
+        profiler = TransformProfiler.for_transformers(transformer)
+    result = Compose([RandomTransformer(transformer, profiler=profiler), totensor])
+    # its random state is saved in checkpoints
+    result.bank = bank
+    return result
 
 # opengl perspective projection matrix as returned by
 # GlStateManager.getFloat(GL11.GL_PROJECTION_MATRIX, projection)
@@ -1,7 +1,11 @@
 import cv2
+import json
+import logging
+import multiprocessing
 import os
 import os.path
 import random
+import numpy
 from torch.utils.data import Dataset
 
 
@@ -63,3 +67,174 @@ class MinecraftSegmentation(Dataset):
     def __len__(self):
         return len(self.pairs)
 
+
+class VariantCache(Dataset):
+    """
+    Cache of K augmented variants per sample of the wrapped dataset
+
+    Variants are stored quantized to uint8 in memory-mapped files in cache_dir,
+    every __getitem__ returns a random stored variant, missing variants are
+    computed by the wrapped dataset and stored lazily. start_refresh() runs a
+    background process which keeps replacing random variants with fresh ones.
+    Variants stored in cache_dir by a previous run are reused if the number
+    of samples, k, scales and shapes and dtypes of outputs are the same.
+
+    Parameters
+    ----------
+    dataset: Dataset
+        dataset which returns tuple of augmented arrays, e.g. MinecraftSegmentation
+    cache_dir: str
+        directory for memory-mapped files
+    k: int
+        number of variants per sample
+    scales: tuple
+        stored value is round(value * scale), one scale per output,
+        255 for images in range [0, 1], 1 for labels
+    reset: bool
+        discard variants stored by a previous run, e.g. when the augmentation
+        of the wrapped dataset has changed
+    """
+    def __init__(self, dataset, cache_dir, k=4, scales=(255, 1), reset=False):
+        self.dataset = dataset
+        self.cache_dir = cache_dir
+        self.k = k
+        self.scales = scales
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        # shapes and dtypes are taken from the first sample
+        sample = dataset[0]
+        self.shapes = [numpy.shape(x) for x in sample]
+        self.dtypes = [numpy.asarray(x).dtype for x in sample]
+        self._pid = None
+        self._refresh = None
+        self._stop = None
+        # writers of all processes are serialized, readers don't lock
+        self._lock = multiprocessing.Lock()
+        meta = self._meta()
+        resume = False
+        if not reset and os.path.exists(self._path('meta.json')):
+            with open(self._path('meta.json')) as f:
+                resume = json.load(f) == meta
+        if resume:
+            self._open()
+            # variants of a killed writer are incomplete
+            self._versions[self._versions % 2 == 1] = 0
+            logging.info('reusing %i cached variants from %s', (self._versions > 0).sum(), cache_dir)
+        else:
+            self._open(mode='w+')
+            with open(self._path('meta.json'), 'w') as f:
+                json.dump(meta, f)
+        self._write(0, 0, sample, only_empty=True)
+
+    def _meta(self):
+        return dict(n=len(self.dataset), k=self.k, scales=list(self.scales),
+                    shapes=[list(shape) for shape in self.shapes],
+                    dtypes=[dtype.str for dtype in self.dtypes])
+
+    def _path(self, name):
+        return os.path.join(self.cache_dir, name)
+
+    def _open(self, mode='r+'):
+        n = len(self.dataset)
+        self._pid = os.getpid()
+        self._outputs = [numpy.memmap(self._path('out{0}.u8'.format(i)), dtype=numpy.uint8,
+                                      mode=mode, shape=(n, self.k) + tuple(shape))
+                         for i, shape in enumerate(self.shapes)]
+        # seqlock per variant: odd while variant is written, 0 if variant is empty
+        self._versions = numpy.memmap(self._path('versions.u32'), dtype=numpy.uint32,
+                                      mode=mode, shape=(n, self.k))
+
+    def _ensure_open(self):
+        # memmaps are reopened in dataloader workers instead of being pickled
+        if self._pid != os.getpid():
+            self._open()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for key in ('_outputs', '_versions', '_refresh', '_stop'):
+            state.pop(key, None)
+        state['_pid'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._refresh = None
+        self._stop = None
+
+    def _write(self, idx, k, sample, only_empty=False):
+        with self._lock:
+            versions = self._versions
+            if only_empty and versions[idx, k] != 0:
+                return
+            versions[idx, k] += 1
+            for out, scale, x in zip(self._outputs, self.scales, sample):
+                x = numpy.asarray(x) * scale
+                out[idx, k] = numpy.clip(numpy.rint(x), 0, 255)
+            versions[idx, k] += 1
+
+    def _read(self, idx, k):
+        v1 = self._versions[idx, k]
+        if v1 == 0 or v1 % 2:
+            return None
+        result = []
+        for out, scale, dtype in zip(self._outputs, self.scales, self.dtypes):
+            # a copy, the variant may be replaced after the check below
+            x = numpy.array(out[idx, k], dtype=dtype)
+            if scale != 1:
+                x = x / scale
+                if not numpy.issubdtype(dtype, numpy.floating):
+                    x = numpy.rint(x)
+                x = x.astype(dtype, copy=False)
+            result.append(x)
+        result = tuple(result)
+        if self._versions[idx, k] != v1:
+            # variant was replaced while reading
+            return None
+        return result
+
+    def __getitem__(self, idx):
+        self._ensure_open()
+        k = random.randrange(self.k)
+        result = self._read(idx, k)
+        if result is None:
+            result = self.dataset[idx]
+            if self._versions[idx, k] == 0:
+                self._write(idx, k, result, only_empty=True)
+        return result
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def start_refresh(self, interval=0.05):
+        """
+        start background process which regenerates variants,
+        interval: pause in seconds between two regenerated variants
+        """
+        if self._refresh is not None:
+            return
+        self._stop = multiprocessing.Event()
+        self._refresh = multiprocessing.Process(target=_refresh_variants,
+                                                args=(self, self._stop, interval),
+                                                daemon=True)
+        self._refresh.start()
+
+    def stop_refresh(self):
+        if self._refresh is not None:
+            self._stop.set()
+            self._refresh.join()
+            self._refresh = None
+
+
+def _refresh_variants(cache, stop, interval):
+    cache._ensure_open()
+    n = len(cache)
+    count = 0
+    while not stop.is_set():
+        idx = random.randrange(n)
+        k = random.randrange(cache.k)
+        cache._write(idx, k, cache.dataset[idx])
+        count += 1
+        if count % 1000 == 0:
+            logging.debug('regenerated %i variants', count)
+        if interval:
+            stop.wait(interval)
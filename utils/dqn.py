@@ -0,0 +1,101 @@
+"""
+DQN agent for prioritized replay
+
+network.DQN computes a mean loss over a uniformly sampled batch.
+PrioritizedDQN keeps its interface and replaces compute_loss with the
+same smooth L1 TD loss weighted per transition by importance weights of
+utils.replay.PrioritizedReplayMemory, TD errors of the batch become the
+new priorities of its transitions.
+"""
+import torch
+from mcdemoaux.vision import network
+
+from utils import replay
+
+
+class PrioritizedDQN(network.DQN):
+    """
+    network.DQN with a per-transition weighted loss
+
+    The target network is synced in compute_loss every target_update
+    gradient steps, unless sync_in_loss is cleared by the owner of the
+    training loop, e.g. utils.learner.BackgroundLearner, which calls
+    sync_target() itself.
+
+    Parameters
+    ----------
+    memory: utils.replay.FrameReplayMemory
+        replay memory, uniform memories have no weights
+    prefetch: int
+        number of batches prepared ahead by utils.replay.ReplayPrefetcher,
+        0 samples on the calling thread
+    workers: int
+        augmentation threads of the prefetcher
+
+    other parameters are the same as of network.DQN
+    """
+    def __init__(self, policy, target, gamma, batch_size, target_update, capacity=1000,
+                 transform=None, memory=None, prefetch=0, workers=2):
+        super().__init__(policy, target, gamma, batch_size, target_update,
+                         capacity=capacity, transform=transform)
+        self.gamma = gamma
+        self.batch_size = batch_size
+        self.target_update = target_update
+        self.transform = transform
+        if memory is not None:
+            self.memory = memory
+        self.prefetch = prefetch
+        self.workers = workers
+        self.prefetcher = None
+        self.sync_in_loss = True
+        self.loss_steps = 0
+
+    def _batch(self):
+        memory = self.memory
+        if len(memory) < self.batch_size:
+            return None
+        if not self.prefetch:
+            transitions, indices, weights = memory.sample_batch(self.batch_size)
+            if not transitions:
+                return None
+            if self.transform is not None:
+                replay.augment_frames(transitions, self.transform)
+            return replay.make_batch(transitions, indices, weights)
+        if self.prefetcher is None:
+            self.prefetcher = replay.ReplayPrefetcher(memory, self.batch_size, self.transform,
+                                                      k=self.prefetch, workers=self.workers)
+        return self.prefetcher.get()
+
+    def td_loss(self, batch):
+        """
+        mean of smooth L1 TD losses weighted by batch['weights'],
+        returns the loss and TD errors of the transitions
+        """
+        device = next(self.policy_net.parameters()).device
+        actions = batch['actions'].to(device)
+        rewards = batch['rewards'].to(device)
+        q = self.policy_net(batch['states']).gather(1, actions).view(-1)
+        next_q = torch.zeros_like(q)
+        if batch['next_states'] is not None:
+            with torch.no_grad():
+                next_q[batch['has_next']] = self.target_net(batch['next_states']).max(1)[0].float()
+        target = rewards + self.gamma * next_q
+        loss = torch.nn.functional.smooth_l1_loss(q, target, reduction='none')
+        if batch['weights'] is not None:
+            loss = batch['weights'].to(device) * loss
+        return loss.mean(), (target - q).detach()
+
+    def sync_target(self):
+        self.target_net.load_state_dict(self.policy_net.state_dict())
+
+    def compute_loss(self):
+        batch = self._batch()
+        if batch is None:
+            return None
+        loss, td = self.td_loss(batch)
+        if hasattr(self.memory, 'update_priorities'):
+            self.memory.update_priorities(batch['indices'], td.cpu().numpy())
+        self.loss_steps += 1
+        if self.sync_in_loss and self.loss_steps % self.target_update == 0:
+            self.sync_target()
+        return loss
@@ -0,0 +1,79 @@
+"""
+State vector embeddings as modules
+
+Same features as utils.common.angle_embed and utils.common.dist_embed,
+computed with one broadcasted op over precomputed buffers.
+Buffers are not persistent, so state dicts of networks don't change.
+"""
+import math
+
+import torch
+from torch import nn
+
+
+class AngleEmbed(nn.Module):
+    """
+    sin(d / p) for p in periods, then cos(d / p), cos is computed as shifted sin
+
+    (batch, n) -> (batch, 2 * len(periods) * n)
+    """
+    def __init__(self, periods=(2, 4, 6, 8)):
+        super().__init__()
+        freq = torch.as_tensor([1 / p for p in periods] * 2, dtype=torch.float32)
+        phase = torch.as_tensor([0.0] * len(periods) + [math.pi / 2] * len(periods))
+        self.register_buffer('freq', freq.view(-1, 1), persistent=False)
+        self.register_buffer('phase', phase.view(-1, 1), persistent=False)
+
+    def forward(self, d):
+        return torch.sin(d.unsqueeze(1) * self.freq + self.phase).flatten(1)
+
+
+class DistEmbed(nn.Module):
+    """
+    (d + eps) ** (1 / k) - 1 for k in roots
+
+    (batch, n) -> (batch, len(roots) * n)
+    """
+    def __init__(self, roots=(2, 3, 4, 5), eps=1.00001):
+        super().__init__()
+        self.eps = eps
+        exponents = torch.as_tensor([1 / k for k in roots], dtype=torch.float32)
+        self.register_buffer('exponents', exponents.view(-1, 1), persistent=False)
+
+    def forward(self, d):
+        return ((d + self.eps).unsqueeze(1) ** self.exponents).flatten(1) - 1
+
+
+class StateEmbed(nn.Module):
+    """
+    Embed slices of state vector: angles, distances and the rest as is,
+    the result is concatenated in this order and is the input of pos_emb
+
+    Slices are given as (start, end) of python slice semantics,
+    None disables the part.
+    """
+    def __init__(self, angles=None, dists=None, rest=None):
+        super().__init__()
+        self.parts = [part is not None for part in (angles, dists, rest)]
+        self.angles = _bounds(angles)
+        self.dists = _bounds(dists)
+        self.rest = _bounds(rest)
+        self.angle_embed = AngleEmbed()
+        self.dist_embed = DistEmbed()
+
+    def forward(self, state):
+        parts = []
+        if self.parts[0]:
+            parts.append(self.angle_embed(state[:, self.angles[0]:self.angles[1]]))
+        if self.parts[1]:
+            parts.append(self.dist_embed(state[:, self.dists[0]:self.dists[1]]))
+        if self.parts[2]:
+            parts.append(state[:, self.rest[0]:self.rest[1]])
+        return torch.cat(parts, dim=1)
+
+
+def _bounds(part):
+    if part is None:
+        return (0, 0)
+    start, end = part
+    return (int(start or 0), int(end) if end is not None else 2 ** 31 - 1)
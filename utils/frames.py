@@ -0,0 +1,154 @@
+"""
+Preprocessing of video frames received from the game
+
+Trainers and analyzers declare the frames they need with FrameSpec,
+mission setup requests the matching video producer and preprocessing
+is configured from the same spec.
+"""
+import logging
+import time
+from collections import namedtuple
+
+import cv2
+import numpy
+import torch
+
+
+class FramePreprocessor:
+    """
+    Resize uint8 frames and convert them to float CHW tensors in range [0, 1]
+
+    Resizing runs on uint8 into a preallocated buffer, dtype and layout are
+    converted in a single op into one of `ring` preallocated output tensors,
+    pinned if cuda is available.
+    An output tensor is overwritten after `ring` calls, so consumers which keep
+    frames longer, e.g. replay memory, must copy them.
+
+    Parameters
+    ----------
+    width: int
+    height: int
+        output size
+    channels: int
+        number of channels in the frames, 4 with depth
+    ring: int
+        number of output tensors, 0 allocates a new tensor for every frame
+    interpolation: int
+        cv2 interpolation, existing checkpoints were trained on cv2.INTER_LINEAR;
+        cv2.INTER_AREA doesn't alias when downscaling, but is slower for
+        factors above 2, e.g. 1.6 ms instead of 0.29 ms for 1280x960 -> 320x240,
+        and is an option for newly trained agents
+    log_every: int
+        log mean timings every log_every frames, 0 disables logging
+    source: tuple
+        default (height, width) of received frames
+    """
+    def __init__(self, width=320, height=240, channels=3, ring=8,
+                 interpolation=cv2.INTER_LINEAR, log_every=500, source=None):
+        self.width = width
+        self.height = height
+        self.channels = channels
+        self.source = source if source is not None else (height, width)
+        self.ring = ring
+        self.interpolation = interpolation
+        self.log_every = log_every
+        pin = torch.cuda.is_available()
+        self._resized = numpy.empty((height, width, channels), dtype=numpy.uint8)
+        self._outputs = [torch.empty((channels, height, width), dtype=torch.float32, pin_memory=pin)
+                         for _ in range(ring)]
+        self._next = 0
+        self.count = 0
+        self.resize_time = 0.0
+        self.convert_time = 0.0
+
+    def __call__(self, img_data, src_height=None, src_width=None):
+        """
+        img_data: uint8 array or bytes with src_height * src_width * channels values, HWC order
+        """
+        start = time.perf_counter()
+        if src_height is None:
+            src_height, src_width = self.source
+        if isinstance(img_data, (bytes, bytearray, memoryview)):
+            img_data = numpy.frombuffer(img_data, dtype=numpy.uint8)
+        src = numpy.asarray(img_data, dtype=numpy.uint8).reshape((src_height, src_width, self.channels))
+        if (src_height, src_width) == (self.height, self.width):
+            # frames from the connector are read-only views of received bytes
+            resized = self._resized
+            numpy.copyto(resized, src)
+        else:
+            resized = cv2.resize(src, (self.width, self.height), dst=self._resized,
+                                 interpolation=self.interpolation)
+            # cv2 drops the channel axis of single channel images
+            resized = resized.reshape(self._resized.shape)
+        mid = time.perf_counter()
+        if self.ring:
+            out = self._outputs[self._next]
+            self._next = (self._next + 1) % self.ring
+        else:
+            out = torch.empty((self.channels, self.height, self.width), dtype=torch.float32)
+        torch.div(torch.from_numpy(resized).permute(2, 0, 1), 255., out=out)
+        end = time.perf_counter()
+        self.count += 1
+        self.resize_time += mid - start
+        self.convert_time += end - mid
+        if self.log_every and self.count % self.log_every == 0:
+            logging.debug('frame preprocessing: %s', self.timings())
+        return out
+
+    def timings(self):
+        """
+        mean time per frame in milliseconds
+        """
+        n = max(self.count, 1)
+        return dict(resize_ms=self.resize_time * 1000 / n,
+                    convert_ms=self.convert_time * 1000 / n,
+                    frames=self.count)
+
+
+class FrameSpec(namedtuple('FrameSpec', ['width', 'height', 'depth', 'supersample'])):
+    """
+    Frames needed by a trainer or analyzer
+
+    width, height: resolution of frames used
+    depth: depth channel is needed
+    supersample: frames are rendered at supersample times higher resolution
+        and downscaled, 1 is the cheapest configuration
+    """
+    __slots__ = ()
+
+    def __new__(cls, width, height, depth=False, supersample=1):
+        return super().__new__(cls, width, height, bool(depth), supersample)
+
+    @property
+    def channels(self):
+        return 3 + self.depth
+
+    @property
+    def source(self):
+        """
+        (height, width) of frames requested from the game
+        """
+        return self.height * self.supersample, self.width * self.supersample
+
+    def video_producer(self):
+        import tagilmo.utils.mission_builder as mb
+        height, width = self.source
+        return mb.VideoProducer(width=width, height=height, want_depth=self.depth)
+
+    def preprocessor(self, **kwargs):
+        return FramePreprocessor(self.width, self.height, self.channels,
+                                 source=self.source, **kwargs)
+
+
+def center_window(img, half, resize=1):
+    """
+    Window of size 2 * half around the center of img upscaled by integer factor resize,
+    the same as cropping the result of cv2.resize with INTER_NEAREST,
+    but only the window is upscaled
+    """
+    height, width = img.shape[:2]
+    y = height * resize // 2
+    x = width * resize // 2
+    rows = numpy.arange(y - half, y + half) // resize
+    cols = numpy.arange(x - half, x + half) // resize
+    return img[rows[:, None], cols]
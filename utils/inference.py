@@ -0,0 +1,319 @@
+"""
+Fast acting path for policy networks
+
+Networks using InferenceMixin run their forward under torch.inference_mode
+while in acting mode, optionally with channels_last memory format,
+bfloat16 autocast and compiled visual trunk. Channels_last is applied to
+a copy of the visual trunk used only for acting, weights of the trained
+network keep their memory format. benchmark() measures
+available configurations on the current host and keeps the fastest one.
+"""
+import contextlib
+import copy
+import itertools
+import logging
+import time
+from collections import OrderedDict
+
+import torch
+
+
+class NanCheck:
+    """
+    Deferred NaN detection
+
+    NaN flags are accumulated without synchronization
+    and inspected every `every` calls
+    """
+    def __init__(self, every=50):
+        self.every = every
+        self.calls = 0
+        self.detected = 0
+        self._flag = None
+
+    def __call__(self, result):
+        flag = torch.isnan(result).any()
+        self._flag = flag if self._flag is None else self._flag | flag
+        self.calls += 1
+        if self.calls % self.every == 0:
+            self.flush()
+
+    def flush(self):
+        if self._flag is not None and self._flag.item():
+            self.detected += 1
+            logging.error('NaN in network output within last %i calls', self.every)
+        self._flag = None
+
+
+class InferenceMixin:
+    """
+    Mixin for networks with `vgg` and `pooling` visual trunk
+
+    Subclass implements q_forward(data) and calls self.encode_stacked(images, frame_ids)
+    or self.encode_frames(frames) for the visual part and self.nan_check(result) on the output.
+
+    In acting mode features of frames with known ids are kept in a small cache,
+    so stacked-frame policies encode only the newest frame on each step.
+    Target networks enable a large cache with enable_target_cache(), it holds
+    features of replayed frames between target syncs.
+    The cache is dropped when weights of the visual trunk change.
+    """
+    acting = False
+    channels_last = False
+    bf16 = False
+    compiled = None
+    target_cache = False
+
+    def init_inference(self, nan_check_every=50, frame_cache_size=8):
+        self.nan_check = NanCheck(nan_check_every)
+        self._compiled_trunk = None
+        self._acting_trunk = None
+        self._acting_trunk_version = None
+        self.frame_cache_size = frame_cache_size
+        self._frame_cache = OrderedDict()
+        self._frame_cache_version = None
+
+    def forward(self, data):
+        if self.acting:
+            return self.act_forward(data)
+        return self.q_forward(data)
+
+    def act_forward(self, data):
+        device_type = next(self.parameters()).device.type
+        with torch.inference_mode(), \
+                torch.autocast(device_type, dtype=torch.bfloat16, enabled=self.bf16):
+            result = self.q_forward(data).float()
+        # normal tensor, so it can be stored in replay memory and used in training
+        return result.clone()
+
+    def visual_trunk(self, frames):
+        return self.pooling(self.vgg(frames))
+
+    def encode_frames(self, frames):
+        """
+        visual features of frames (N, C, H, W)
+        """
+        if self.acting:
+            if self.channels_last:
+                frames = frames.contiguous(memory_format=torch.channels_last)
+                self._sync_acting_trunk()
+            if self._compiled_trunk is not None:
+                return self._compiled_trunk(frames)
+            if self.channels_last:
+                return self._acting_trunk(frames)
+        return self.visual_trunk(frames)
+
+    def _sync_acting_trunk(self):
+        # copy_ keeps channels_last format of the acting weights
+        version = self._trunk_version()
+        if version == self._acting_trunk_version:
+            return
+        trunk = torch.nn.Sequential(self.vgg, self.pooling)
+        with torch.no_grad():
+            for dst, src in zip(self._acting_trunk.state_dict().values(),
+                                trunk.state_dict().values()):
+                dst.copy_(src)
+        self._acting_trunk_version = version
+
+    def enable_target_cache(self, size):
+        """
+        Cache visual features of every frame with id, for target network only:
+        features are computed without gradient and reused until weights change,
+        i.e. until the next target sync. With augmentation of replayed states
+        the cached features are of the augmented frame first seen after the sync.
+
+        size: maximal number of cached frames, e.g. capacity of replay memory
+            multiplied by number of frames in a state
+        """
+        self.target_cache = True
+        self.frame_cache_size = size
+        self._frame_cache.clear()
+        return self
+
+    def _trunk_version(self):
+        # in-place updates by optimizer or weight copies increment tensor versions
+        return sum(p._version for p in self.vgg.parameters())
+
+    def encode_stacked(self, x, frame_ids=None):
+        """
+        visual features of stacked frames (B, T, C, H, W) as (B, T, features)
+
+        frame_ids: optional tensor (B, T) or (T,) of ids identifying frames,
+            features of known frames are reused while acting or in target network,
+            otherwise every frame repeated in the batch is encoded once
+        """
+        B, T, C, H, W = x.shape
+        if frame_ids is None:
+            return self.encode_frames(x.view(-1, C, H, W)).view(B, T, -1)
+        if not (self.acting or self.target_cache) or not self.frame_cache_size:
+            return self.encode_unique(x.view(-1, C, H, W), frame_ids).view(B, T, -1)
+        version = self._trunk_version()
+        if version != self._frame_cache_version:
+            self._frame_cache.clear()
+            self._frame_cache_version = version
+        frames = x.view(-1, C, H, W)
+        ids = torch.as_tensor(frame_ids).reshape(-1).tolist()
+        cache = self._frame_cache
+        missing = dict()
+        for i, frame_id in enumerate(ids):
+            if frame_id not in cache and frame_id not in missing:
+                missing[frame_id] = i
+        if missing:
+            with torch.no_grad():
+                features = self.encode_frames(frames[list(missing.values())])
+            for frame_id, feature in zip(missing, features):
+                cache[frame_id] = feature
+        result = torch.stack([cache[i] for i in ids]).view(B, T, -1)
+        for frame_id in ids:
+            cache.move_to_end(frame_id)
+        while len(cache) > self.frame_cache_size:
+            cache.popitem(last=False)
+        return result
+
+    def encode_unique(self, frames, frame_ids):
+        """
+        visual features of frames (N, C, H, W), frames with equal ids are encoded once
+
+        Stacked states of one episode share frames, so a minibatch usually
+        holds several copies of them. Gradient of every copy flows
+        to the single encoded frame.
+        """
+        ids = torch.as_tensor(frame_ids, device=frames.device).reshape(-1)
+        unique, inverse = torch.unique(ids, return_inverse=True)
+        if len(unique) == len(ids):
+            return self.encode_frames(frames)
+        positions = torch.arange(len(ids), device=frames.device)
+        first = torch.empty_like(unique).scatter_(0, inverse, positions)
+        return self.encode_frames(frames[first])[inverse]
+
+    def configure_inference(self, channels_last=False, bf16=False, compiled=None, example=None):
+        """
+        Parameters
+        ----------
+        channels_last: bool
+            use channels_last memory format for convolutions
+        bf16: bool
+            run acting forward under bfloat16 autocast
+        compiled: str
+            None, 'compile' for torch.compile or 'script' for TorchScript trace,
+            trace requires example frames
+        """
+        self.channels_last = channels_last
+        self.bf16 = bf16
+        self.compiled = compiled
+        self._frame_cache.clear()
+        self._compiled_trunk = None
+        trunk = torch.nn.Sequential(self.vgg, self.pooling)
+        acting_trunk = None
+        if channels_last:
+            acting_trunk = copy.deepcopy(trunk).requires_grad_(False)
+            acting_trunk.to(memory_format=torch.channels_last)
+            trunk = acting_trunk
+        # bypass module registration, the copy is not a part of the trained network
+        object.__setattr__(self, '_acting_trunk', acting_trunk)
+        self._acting_trunk_version = self._trunk_version()
+        if compiled == 'compile':
+            self._compiled_trunk = torch.compile(trunk)
+        elif compiled == 'script':
+            if channels_last:
+                example = example.contiguous(memory_format=torch.channels_last)
+            with torch.no_grad():
+                traced = torch.jit.trace(trunk, example, check_trace=False)
+            # bypass module registration, parameters are owned by the network or its acting copy
+            object.__setattr__(self, '_compiled_trunk', traced)
+        return self
+
+
+@contextlib.contextmanager
+def acting(net):
+    """
+    use fast acting path of net inside the block
+    """
+    prev = net.acting
+    net.acting = True
+    try:
+        yield net
+    finally:
+        net.acting = prev
+
+
+def _measure(net, data, repeats):
+    with acting(net):
+        # warm up, compiled modules are built on first call
+        result = net(data)
+        start = time.perf_counter()
+        for _ in range(repeats):
+            net(data)
+    return (time.perf_counter() - start) / repeats, result
+
+
+def _random_batch(data, n):
+    """
+    batch of n copies of the single state data with uniformly random images
+    """
+    batch = dict()
+    for key, value in data.items():
+        if key in ('frame_ids', 'frame_id'):
+            # random images must not be taken for cached frames
+            continue
+        if key == 'images':
+            batch[key] = torch.rand((n,) + tuple(value.shape), dtype=value.dtype)
+        elif torch.is_tensor(value):
+            batch[key] = value.expand((n,) + tuple(value.shape))
+        else:
+            batch[key] = value
+    return batch
+
+
+def benchmark(net, data, repeats=10, try_compile=False, n_check=16, min_agreement=0.9):
+    """
+    Measure acting configurations and keep the fastest one
+
+    Greedy actions of every configuration are compared with the default one
+    on a batch of random images, configurations which change more than
+    1 - min_agreement of them are skipped.
+
+    Parameters
+    ----------
+    net: InferenceMixin
+    data: dict
+        example input of network forward for a single state,
+        images of shape (T, C, H, W) in [0, 1]
+    repeats: int
+    try_compile: bool
+        also try torch.compile and TorchScript, it takes longer to start
+    n_check: int
+        number of random states to compare actions on
+    min_agreement: float
+        fraction of random states where a configuration must choose the same action
+    """
+    frames = data['images']
+    frames = frames.reshape((-1,) + tuple(frames.shape[-3:])).to(next(net.parameters()))
+    check = _random_batch(data, n_check)
+    compiled_options = [None, 'script', 'compile'] if try_compile else [None]
+    timings = []
+    reference = None
+    for compiled, channels_last, bf16 in itertools.product(compiled_options, (False, True), (False, True)):
+        config = dict(channels_last=channels_last, bf16=bf16, compiled=compiled)
+        try:
+            net.configure_inference(example=frames, **config)
+            elapsed, _ = _measure(net, data, repeats)
+            with acting(net):
+                actions = net(check).argmax(dim=-1)
+        except Exception as e:
+            logging.debug('inference config %s failed: %s', config, e)
+            continue
+        if reference is None:
+            reference = actions
+        else:
+            agreement = (actions == reference).float().mean().item()
+            if agreement < min_agreement:
+                logging.debug('inference config %s changes %.0f%% of actions, skipping',
+                              config, (1 - agreement) * 100)
+                continue
+        logging.debug('inference config %s: %.2f ms', config, elapsed * 1000)
+        timings.append((elapsed, config))
+    elapsed, config = min(timings, key=lambda x: x[0])
+    logging.info('using inference config %s: %.2f ms per step', config, elapsed * 1000)
+    net.configure_inference(example=frames, **config)
+    return config
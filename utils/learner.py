@@ -0,0 +1,166 @@
+"""
+Background learner for DQN agents
+
+The learner thread keeps sampling the replay memory of the agent and
+optimizing the policy network, while the acting loop uses a separate copy
+of the policy. The learner publishes weights to shared-memory tensors,
+the actor pulls them at a configurable interval.
+"""
+import contextlib
+import copy
+import logging
+import threading
+import time
+
+import torch
+
+from utils import common
+
+
+class BackgroundLearner(threading.Thread):
+    """
+    Actor/learner split for network.DQN agents
+
+    The optimizer must be built on agent parameters before the learner is created:
+    the learner keeps training the original policy network, the agent gets a copy
+    of it for acting. Replay memory and target network are shared.
+    Use learner.state_dict() to save the latest trained weights.
+
+    The learner owns the target update: every target_update gradient steps,
+    checked after each publication, it copies the trained policy to the target
+    network. Sync inside the loss of utils.dqn.PrioritizedDQN is disabled,
+    otherwise a DQN could sync the target from the acting copy.
+
+    Parameters
+    ----------
+    agent: network.DQN
+    optimizer: torch.optim.Optimizer
+    steps_per_publish: int
+        gradient steps between publications of weights
+    pull_interval: float
+        minimal time in seconds between two pulls in maybe_pull()
+    min_memory: int
+        learning starts when replay memory has at least this many transitions
+    target_update: int
+        gradient steps between syncs of the target network,
+        None takes target_update of the agent
+    """
+    def __init__(self, agent, optimizer, steps_per_publish=40, pull_interval=2.0, min_memory=100,
+                 target_update=None):
+        super().__init__(name='BackgroundLearner', daemon=True)
+        self.agent = agent
+        self.optimizer = optimizer
+        self.steps_per_publish = steps_per_publish
+        self.pull_interval = pull_interval
+        self.min_memory = min_memory
+        # learner view of the agent with its own module dict,
+        # so replacing policy_net in the agent doesn't affect it
+        self.learner_agent = copy.copy(agent)
+        self.learner_agent._modules = copy.copy(agent._modules)
+        acting_net = copy.deepcopy(agent.policy_net)
+        agent.policy_net = acting_net
+        self._acting = self._tensors(acting_net)
+        self._trained = self._tensors(self.learner_agent.policy_net)
+        self._staging = [t.detach().clone() for t in self._trained]
+        for t in self._staging:
+            if not t.is_cuda:
+                t.share_memory_()
+        self._lock = threading.Lock()
+        # held while optimizing, see paused()
+        self._learning = threading.Lock()
+        self._stop_event = threading.Event()
+        self._version = 0
+        self._pulled = 0
+        self._last_pull = time.time()
+        self.gradient_steps = 0
+        self.last_loss = 0
+        self.target_update = target_update or getattr(agent, 'target_update', 450)
+        self.target_syncs = 0
+        if hasattr(agent, 'sync_in_loss'):
+            agent.sync_in_loss = False
+            self.learner_agent.sync_in_loss = False
+        else:
+            logging.warning('%s may sync the target network itself', type(agent).__name__)
+
+    @staticmethod
+    def _tensors(net):
+        return list(net.parameters()) + list(net.buffers())
+
+    def run(self):
+        try:
+            while not self._stop_event.is_set():
+                if len(self.agent.memory) < self.min_memory:
+                    self._stop_event.wait(0.1)
+                    continue
+                with self._learning:
+                    self.last_loss = common.learn(self.learner_agent, self.optimizer,
+                                                  n_steps=self.steps_per_publish)
+                    self.gradient_steps += self.steps_per_publish
+                    self.publish()
+                    self.sync_target()
+        except Exception:
+            logging.exception('background learner failed')
+            raise
+
+    def publish(self):
+        with torch.no_grad(), self._lock:
+            for staging, trained in zip(self._staging, self._trained):
+                staging.copy_(trained)
+            self._version += 1
+
+    def sync_target(self):
+        """
+        copy the trained policy to the target network if target_update steps passed
+        """
+        if self.gradient_steps // self.target_update <= self.target_syncs:
+            return False
+        agent = self.learner_agent
+        with torch.no_grad():
+            agent.target_net.load_state_dict(agent.policy_net.state_dict())
+        self.target_syncs = self.gradient_steps // self.target_update
+        logging.debug('synced target network, gradient steps %i', self.gradient_steps)
+        return True
+
+    def pull(self):
+        """
+        copy last published weights to the acting network
+        """
+        self._last_pull = time.time()
+        if self._pulled == self._version:
+            return False
+        with torch.no_grad(), self._lock:
+            for acting, staging in zip(self._acting, self._staging):
+                acting.copy_(staging)
+            self._pulled = self._version
+        logging.debug('pulled weights version %i, gradient steps %i',
+                      self._pulled, self.gradient_steps)
+        return True
+
+    def maybe_pull(self):
+        """
+        pull weights if pull_interval passed since the last pull,
+        cheap enough to be called on every acting step
+        """
+        if time.time() - self._last_pull >= self.pull_interval:
+            return self.pull()
+        return False
+
+    @contextlib.contextmanager
+    def paused(self):
+        """
+        no optimizer steps run inside the block, e.g. weights and optimizer
+        state taken for a checkpoint are from the same gradient step
+        """
+        with self._learning:
+            yield
+
+    def stop(self):
+        self._stop_event.set()
+        if self.is_alive():
+            self.join()
+
+    def state_dict(self):
+        """
+        agent state with the latest trained policy network
+        """
+        return self.learner_agent.state_dict()
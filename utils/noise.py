@@ -1,3 +1,5 @@
+import os
+import threading
 import skimage.exposure
 
 from scipy import ndimage
@@ -16,6 +18,9 @@ def random_brightness(images, per_color=True, channel=0, range=(0, 70)):
         r = numpy.random.random(new_shape) * aligned_range + range[0]
     else:
         r = numpy.random.random() * aligned_range + range[0]
+    if numpy.issubdtype(images.dtype, numpy.floating):
+        # keep dtype of float images
+        r = numpy.asarray(r, dtype=images.dtype)
     res = images + r
     return numpy.clip(res, 0, 255)
 
@@ -32,10 +37,208 @@ class RandomBrightness:
                                  channel=self.channel,
                                  range=self.range)
 
+class NoiseBank:
+    """
+    Bank of pregenerated noise fields shared by noise transforms
+
+    Holds n_fields standard normal float32 fields at the working resolution
+    plus a margin. Every request returns a view taken at a random offset with
+    random flips, so no per-pixel random numbers are drawn on the hot path.
+    With max_scale > 1 the view is also taken from a smaller window, enlarged
+    by a random factor up to max_scale with nearest neighbour interpolation.
+    It makes the noise coarser, so it is off by default.
+    A daemon thread replaces one field and one index set of every
+    image size every refresh_interval seconds.
+
+    Salt and pepper noise touches only a few percent of pixels, thresholding
+    a full field costs more than drawing the coordinates. For it the bank keeps
+    n_fields sets of flat pixel indices per image size and amount, a request
+    returns one of them mapped by a random affine permutation
+    i -> (i * stride + shift) % size of the image pixels.
+
+    Parameters
+    ----------
+    shape: tuple
+        working resolution (channels, height, width), if None it is taken
+        from the first requested shape
+    n_fields: int
+        number of fields and of index sets per image size
+    margin: float
+        fraction of height and width added to the fields for random offsets
+    refresh_interval: float
+        seconds between field replacements, None disables refreshing
+    max_scale: float
+        largest enlargement of gaussian fields, 1 disables scaling
+    """
+    def __init__(self, shape=None, n_fields=8, margin=0.25, refresh_interval=5.0,
+                 max_scale=1.0):
+        self.shape = None if shape is None else tuple(shape)
+        self.n_fields = n_fields
+        self.margin = margin
+        self.refresh_interval = refresh_interval
+        self.max_scale = max_scale
+        self._init_process_state()
+
+    def _init_process_state(self):
+        self._pid = os.getpid()
+        self._rng = numpy.random.default_rng()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._gauss = []
+        self._indices = dict()
+        self._field_state = None
+        self._seed = None
+
+    def __getstate__(self):
+        # fields, lock and thread are recreated in the receiving process
+        return dict(shape=self.shape, n_fields=self.n_fields,
+                    margin=self.margin, refresh_interval=self.refresh_interval,
+                    max_scale=self.max_scale)
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._init_process_state()
+
+    def get_state(self):
+        """
+        shape, generator state the fields were generated from and current generator state,
+        fields and index sets replaced by the refresh thread are not restored
+        """
+        return dict(shape=self.shape, fields=self._field_state, seed=self._seed,
+                    rng=self._rng.bit_generator.state)
+
+    def set_state(self, state):
+        with self._lock:
+            self.shape = state['shape']
+            if state['fields'] is not None:
+                self._rng.bit_generator.state = state['fields']
+                self._generate()
+            self._seed = state['seed']
+            self._indices = dict()
+            self._rng.bit_generator.state = state['rng']
+
+    def _field_shape(self):
+        c, h, w = self.shape
+        return c, h + int(h * self.margin) + 1, w + int(w * self.margin) + 1
+
+    def _new_gauss(self, rng):
+        return rng.standard_normal(self._field_shape(), dtype=numpy.float32)
+
+    def _check_process(self):
+        if os.getpid() != self._pid:
+            # forked dataloader worker: don't share random stream with the parent
+            shape_ = self.shape
+            self._init_process_state()
+            self.shape = shape_
+
+    def _ensure_ready(self, shape):
+        self._check_process()
+        if self._gauss:
+            return
+        with self._lock:
+            if self._gauss:
+                return
+            if self.shape is None:
+                self.shape = tuple(shape) if len(shape) == 3 else (1,) + tuple(shape)
+            self._generate()
+
+    def _generate(self):
+        self._field_state = self._rng.bit_generator.state
+        self._gauss = [self._new_gauss(self._rng) for _ in range(self.n_fields)]
+        if self.refresh_interval is not None and self._thread is None:
+            self._thread = threading.Thread(target=self._refresh_loop,
+                                            name='NoiseBankRefresh',
+                                            daemon=True)
+            self._thread.start()
+
+    def _refresh_loop(self):
+        # own generator, sharing one with the sampling thread is not safe
+        rng = numpy.random.default_rng()
+        while not self._stop.wait(self.refresh_interval):
+            i = rng.integers(self.n_fields)
+            # replacing the list element is atomic, readers see either field
+            self._gauss[i] = self._new_gauss(rng)
+            for key, sets in list(self._indices.items()):
+                sets[rng.integers(self.n_fields)] = _new_indices(rng, *key)
+
+    def close(self):
+        self._stop.set()
+
+    def fits(self, shape):
+        if len(shape) not in (2, 3):
+            return False
+        self._ensure_ready(shape)
+        c, h, w = self.shape
+        if len(shape) == 3 and c < shape[0]:
+            return False
+        return shape[-2] <= h and shape[-1] <= w
+
+    def gaussian(self, shape):
+        """
+        Standard normal float32 field of given shape, None if shape doesn't fit the bank
+        """
+        if not self.fits(shape):
+            return None
+        field = self._gauss[self._rng.integers(self.n_fields)]
+        _, fh, fw = field.shape
+        h, w = shape[-2:]
+        c = shape[0] if len(shape) == 3 else 1
+        if self.max_scale > 1:
+            scale = self._rng.uniform(1, self.max_scale)
+            wh, ww = int(numpy.ceil(h / scale)), int(numpy.ceil(w / scale))
+        else:
+            wh, ww = h, w
+        top = self._rng.integers(fh - wh + 1)
+        left = self._rng.integers(fw - ww + 1)
+        view = field[:c, top: top + wh, left: left + ww]
+        flip = self._rng.integers(4)
+        if flip & 1:
+            view = view[:, ::-1]
+        if flip & 2:
+            view = view[:, :, ::-1]
+        if (wh, ww) != (h, w):
+            rows = numpy.arange(h) * wh // h
+            cols = numpy.arange(w) * ww // w
+            view = view[:, rows[:, None], cols]
+        return view.reshape(shape)
+
+    def salt_pepper(self, size, s_vs_p=0.5, amount=0.04):
+        """
+        Flat indices (salt, pepper) into an array of size elements,
+        the same number of pixels as the sparse path of snp
+        """
+        self._check_process()
+        if self._seed is None:
+            with self._lock:
+                if self._seed is None:
+                    # index sets are derived from it, so they don't depend on the order of requests
+                    self._seed = int(self._rng.integers(2 ** 62))
+        n_salt = int(numpy.ceil(amount * size * s_vs_p))
+        n_pepper = int(numpy.ceil(amount * size * (1. - s_vs_p)))
+        key = (size, n_salt, n_pepper)
+        sets = self._indices.get(key)
+        if sets is None:
+            rng = numpy.random.default_rng([self._seed, size, n_salt, n_pepper])
+            sets = [_new_indices(rng, *key) for _ in range(self.n_fields)]
+            self._indices[key] = sets
+        salt, pepper = sets[self._rng.integers(self.n_fields)]
+        stride = self._rng.integers(1, size) if size > 1 else 1
+        # a stride coprime with size makes the mapping a permutation
+        while numpy.gcd(stride, size) != 1:
+            stride = self._rng.integers(1, size)
+        shift = self._rng.integers(size)
+        return (salt * stride + shift) % size, (pepper * stride + shift) % size
+
+
+def _new_indices(rng, size, n_salt, n_pepper):
+    return rng.integers(0, size, n_salt), rng.integers(0, size, n_pepper)
+
+
 # noise adapted from
 # https://stackoverflow.com/questions/22937589/how-to-add-noise-gaussian-salt-and-pepper-etc-to-image-in-python-with-opencv
 
-def additive_gaussian(image, mean=0, var=None):
+def additive_gaussian(image, mean=0, var=None, bank=None):
     """
     Additive gaussian noise
     Parameters
@@ -45,45 +248,64 @@ def additive_gaussian(image, mean=0, var=None):
     mean: mean of gaussian
     var: variance of gaussian
         default value = image.var()
+    bank: NoiseBank
+        optional source of pregenerated noise
     """
     if var is None:
         var = image.var()
     sigma = var**0.5
-    gauss = numpy.random.normal(mean, sigma, image.shape)
+    gauss = None
+    if bank is not None:
+        gauss = bank.gaussian(image.shape)
+    if gauss is None:
+        gauss = numpy.random.normal(mean, sigma, image.shape)
+    else:
+        gauss = gauss * numpy.float32(sigma) + numpy.float32(mean)
     noisy = image + gauss
     return numpy.clip(noisy, 0, 255)
 
 
 class AdditiveGaussian:
-    def __init__(self, mean=0, var=None):
+    def __init__(self, mean=0, var=None, bank=None):
         self.mean = mean
         self.var = var
+        self.bank = bank
 
     def __call__(self, image):
-        return additive_gaussian(image, mean=self.mean, var=self.var)
+        return additive_gaussian(image, mean=self.mean, var=self.var, bank=self.bank)
 
 
 class SaltPepper:
-    def __init__(self, s_vs_p=0.5, amount=0.04):
+    def __init__(self, s_vs_p=0.5, amount=0.04, bank=None):
         self.s_vs_p = s_vs_p
         self.amount = amount
+        self.bank = bank
 
     def __call__(self, image):
-        return snp(image, s_vs_p=self.s_vs_p, amount=self.amount)
+        return snp(image, s_vs_p=self.s_vs_p, amount=self.amount, bank=self.bank)
 
 
-def snp(image, s_vs_p=0.5, amount=0.04):
+def snp(image, s_vs_p=0.5, amount=0.04, bank=None):
     """
     salt & papper noise, randomly sets pixels to 0 or 255
     Parameters
     ----------
     image: ndarray
+        input image, it is not modified
     s_vs_p: float
         ratio of salt noise, amount of papper noise is (1 - s_vs_p)
     amount: float
         ration of noisy pixes vs total number of pixes
+    bank: NoiseBank
+        optional source of pregenerated noise
     """
-    out = image
+    out = image.copy()
+    if bank is not None:
+        salt, pepper = bank.salt_pepper(image.size, s_vs_p=s_vs_p, amount=amount)
+        flat = out.reshape(-1)
+        flat[salt] = 255
+        flat[pepper] = 0
+        return out
     # Salt mode
     num_salt = numpy.ceil(amount * image.size * s_vs_p)
     coords = [numpy.random.randint(0, i - 1 if i != 1 else 1, int(num_salt))
@@ -99,14 +321,15 @@ def snp(image, s_vs_p=0.5, amount=0.04):
 
 
 class Speckle:
-    def __init__(self, var=0.125):
+    def __init__(self, var=0.125, bank=None):
         self.var = var
+        self.bank = bank
 
     def __call__(self, image):
-        return speckle(image, var=self.var)
+        return speckle(image, var=self.var, bank=self.bank)
 
 
-def speckle(image, var=0.125):
+def speckle(image, var=0.125, bank=None):
     """
     Speckle noise
     Parameters
@@ -114,9 +337,15 @@ def speckle(image, var=0.125):
     image: ndarray
     var: float
         variance of gaussian distribution
+    bank: NoiseBank
+        optional source of pregenerated noise
     """
-    gauss = numpy.random.randn(*image.shape) * var
-    noisy = image  + gauss * image
+    gauss = None
+    if bank is not None:
+        gauss = bank.gaussian(image.shape)
+    if gauss is None:
+        gauss = numpy.random.randn(*image.shape)
+    noisy = image  + gauss * var * image
     return numpy.clip(noisy, 0, 255)
 
 
@@ -274,15 +503,84 @@ def resize_keypoints_scipy(keypoints, size):
     return result
 
 
+def rasterize_points(points, height, width, labels=None, batch=None, batch_size=None,
+                     n_classes=None, scale=None, dtype=numpy.uint8):
+    """
+    Scatter sparse points of a whole batch into dense label planes
+
+    Parameters
+    ----------
+    points: numpy.array
+        (n, 2) array of (row, column) coordinates, may be float
+    height: int
+    width: int
+    labels: numpy.array
+        optional (n,) class ids, required for one-hot output
+    batch: numpy.array
+        optional (n,) index of sample in batch for each point
+    batch_size: int
+        number of samples, default batch.max() + 1
+    n_classes: int
+        if given output is one-hot (batch, n_classes, height, width),
+        otherwise (batch, height, width) with 1 at every point
+    scale: tuple
+        (row_factor, column_factor) applied to coordinates before rounding,
+        used to rasterize points at different resolution
+    dtype: numpy.dtype
+        dtype of the result
+
+    Returns
+    -------
+    numpy.array of shape (batch, [n_classes], height, width)
+
+    Raises IndexError if a rounded point is outside of the plane
+    """
+    points = numpy.asarray(points, dtype=numpy.float64).reshape(-1, 2)
+    if scale is not None:
+        points = points * numpy.asarray(scale, dtype=numpy.float64)
+    rows = numpy.rint(points[:, 0]).astype(numpy.int64)
+    cols = numpy.rint(points[:, 1]).astype(numpy.int64)
+    outside = (rows < 0) | (rows >= height) | (cols < 0) | (cols >= width)
+    if outside.any():
+        raise IndexError('{0} of {1} points are outside of {2}x{3} plane'.format(
+            outside.sum(), len(points), height, width))
+    if batch is None:
+        batch = numpy.zeros(len(points), dtype=numpy.int64)
+    if batch_size is None:
+        batch_size = int(batch.max()) + 1 if len(batch) else 1
+    if n_classes is None:
+        result = numpy.zeros((batch_size, height, width), dtype=dtype)
+        result[batch, rows, cols] = 1
+    else:
+        result = numpy.zeros((batch_size, n_classes, height, width), dtype=dtype)
+        result[batch, labels, rows, cols] = 1
+    return result
+
+
+def rasterize_batch(points_list, height, width, labels_list=None, n_classes=None,
+                    scale=None, dtype=numpy.uint8):
+    """
+    rasterize_points for a list of per-sample point arrays
+    """
+    counts = [len(p) for p in points_list]
+    batch = numpy.repeat(numpy.arange(len(points_list)), counts)
+    points = numpy.concatenate([numpy.asarray(p, dtype=numpy.float64).reshape(-1, 2)
+                                for p in points_list]) if points_list else numpy.zeros((0, 2))
+    labels = None
+    if labels_list is not None:
+        labels = numpy.concatenate([numpy.asarray(l, dtype=numpy.int64) for l in labels_list])
+    return rasterize_points(points, height, width, labels=labels, batch=batch,
+                            batch_size=len(points_list), n_classes=n_classes,
+                            scale=scale, dtype=dtype)
+
+
 def resize_keypoints(keypoints, size):
     assert len(keypoints.shape) == 2
     h = size[1] / keypoints.shape[0]
     w = size[0] / keypoints.shape[1]
-    coords = numpy.nonzero(keypoints)
-    new_coords = tuple(numpy.rint(x).astype(numpy.int) for x in (coords[0] * h, coords[1] * w))
-    result = numpy.zeros((size[1], size[0]))
-    result[new_coords] = 1
-    return result
+    coords = numpy.stack(numpy.nonzero(keypoints), axis=1)
+    return rasterize_points(coords, size[1], size[0], scale=(h, w),
+                            dtype=numpy.float64)[0]
 
 
 class Threshold:
@@ -353,6 +651,246 @@ class RandomCropTransform:
         return img
 
 
+def inverse_frequency_weights(counts, power=1.0):
+    """
+    class weights inversely proportional to pixel counts of classes,
+    classes with zero count get zero weight
+    """
+    counts = numpy.asarray(counts, dtype=numpy.float64)
+    weights = numpy.zeros_like(counts)
+    present = counts > 0
+    weights[present] = (counts[present].sum() / counts[present]) ** power
+    return weights / weights.sum()
+
+
+class ClassLocationIndex:
+    """
+    Pixel locations of a class map grouped by class
+
+    Built once per sample, then a pixel of a class is sampled in O(1)
+    """
+    def __init__(self, class_map, n_classes=None):
+        flat = numpy.asarray(class_map).ravel()
+        self.width = class_map.shape[1]
+        self.order = numpy.argsort(flat, kind='stable')
+        self.counts = numpy.bincount(flat, minlength=n_classes or 0)
+        self.offsets = numpy.concatenate([[0], numpy.cumsum(self.counts)])
+
+    def sample(self, class_weights):
+        """
+        Sample (row, column) of a pixel, class is chosen with probability
+        proportional to class_weights among present classes, None if no class has weight
+        """
+        weights = numpy.zeros(len(self.counts))
+        n = min(len(weights), len(class_weights))
+        weights[:n] = numpy.asarray(class_weights)[:n]
+        weights *= self.counts > 0
+        total = weights.sum()
+        if total <= 0:
+            return None
+        c = numpy.searchsorted(numpy.cumsum(weights), numpy.random.random() * total, side='right')
+        pos = self.order[self.offsets[c] + numpy.random.randint(self.counts[c])]
+        return divmod(pos, self.width)
+
+
+def sample_class_pixel(class_map, class_weights):
+    """
+    Same as ClassLocationIndex.sample, but without building the index,
+    cheaper when class map is used once
+    """
+    flat = numpy.asarray(class_map).ravel()
+    counts = numpy.bincount(flat, minlength=len(class_weights))
+    weights = numpy.zeros(len(counts))
+    weights[:len(class_weights)] = class_weights
+    weights *= counts > 0
+    total = weights.sum()
+    if total <= 0:
+        return None
+    c = numpy.searchsorted(numpy.cumsum(weights), numpy.random.random() * total, side='right')
+    locations = numpy.flatnonzero(flat == c)
+    pos = locations[numpy.random.randint(len(locations))]
+    return divmod(pos, class_map.shape[1])
+
+
+class RareClassCropTransform(RandomCropTransform):
+    """
+    Random crop centered on pixels of rare classes
+
+    With probability uniform_ratio crop position is uniform as in RandomCropTransform,
+    otherwise a pixel is sampled by class_weights and crop is centered on it
+    (shifted to stay inside the image).
+
+    Parameters
+    ----------
+    size: int
+        crop size
+    class_weights: sequence
+        weight per class id, e.g. from inverse_frequency_weights
+    uniform_ratio: float
+        fraction of uniform crops
+    beta: int
+        random size jitter as in RandomCropTransform
+    """
+    def __init__(self, size, class_weights, uniform_ratio=0.3, beta=0):
+        super().__init__(size, beta=beta)
+        self.class_weights = numpy.asarray(class_weights, dtype=numpy.float64)
+        self.uniform_ratio = uniform_ratio
+
+    def sample_pos(self, classes, height, width):
+        """
+        classes: class map (height, width) or ClassLocationIndex
+        returns (top, left, size)
+        """
+        size = self.size
+        if self.beta:
+            size = self.size + int(numpy.random.random() * self.beta * 2) - self.beta
+        center = None
+        if numpy.random.random() >= self.uniform_ratio:
+            if isinstance(classes, ClassLocationIndex):
+                center = classes.sample(self.class_weights)
+            else:
+                center = sample_class_pixel(classes, self.class_weights)
+        max_top = max(height - size, 0)
+        max_left = max(width - size, 0)
+        if center is None:
+            top = numpy.random.randint(0, max_top) if max_top else 0
+            left = numpy.random.randint(0, max_left) if max_left else 0
+        else:
+            top = min(max(center[0] - size // 2, 0), max_top)
+            left = min(max(center[1] - size // 2, 0), max_left)
+        return top, left, size
+
+    def __call__(self, data, classes, return_pos=False):
+        """
+        data: image in (height, width, channels) or (channels, height, width) layout
+        classes: class map (height, width) or ClassLocationIndex
+        """
+        chw = numpy.argmin(data.shape) == 0
+        height, width = data.shape[1:3] if chw else data.shape[:2]
+        top, left, size = self.sample_pos(classes, height, width)
+        if chw:
+            img = data[:, top: top + size, left: left + size]
+        else:
+            img = data[top: top + size, left: left + size]
+        if return_pos:
+            return img, (top, left)
+        return img
+
+
+def calculate_h_batch(pts_init, pts_pert):
+    """
+    Solve for homographies mapping pts_init to pts_pert
+
+    Parameters
+    ----------
+    pts_init: numpy.array
+        (batch, 4, 2) points in (x, y) order
+    pts_pert: numpy.array
+        (batch, 4, 2) perturbed points
+
+    Returns
+    -------
+    tuple of (batch, 3, 3) arrays H and H_inv
+    """
+    pts_init = numpy.asarray(pts_init, dtype=numpy.float64)
+    pts_pert = numpy.asarray(pts_pert, dtype=numpy.float64)
+    B = pts_init.shape[0]
+    x, y = pts_init[..., 0], pts_init[..., 1]
+    u, v = pts_pert[..., 0], pts_pert[..., 1]
+    zeros = numpy.zeros_like(x)
+    ones = numpy.ones_like(x)
+    rows_u = numpy.stack([x, y, ones, zeros, zeros, zeros, -u * x, -u * y], axis=-1)
+    rows_v = numpy.stack([zeros, zeros, zeros, x, y, ones, -v * x, -v * y], axis=-1)
+    A = numpy.concatenate([rows_u, rows_v], axis=1)
+    b = numpy.concatenate([u, v], axis=1)
+    h = numpy.linalg.solve(A, b[..., numpy.newaxis])[..., 0]
+    H = numpy.concatenate([h, numpy.ones((B, 1))], axis=1).reshape(B, 3, 3)
+    return H, numpy.linalg.inv(H)
+
+
+def calculate_h(pts_init, pts_pert):
+    """
+    Homography mapping four points pts_init (4, 2) to pts_pert (4, 2)
+
+    Returns
+    -------
+    H, H_inv: numpy.array of shape (3, 3)
+    """
+    H, H_inv = calculate_h_batch(numpy.asarray(pts_init)[numpy.newaxis],
+                                 numpy.asarray(pts_pert)[numpy.newaxis])
+    return H[0], H_inv[0]
+
+
+def warp_image(image, H, w, h, interpolation=cv2.INTER_LINEAR):
+    """
+    Warp image so that pixel x of the result is image(H x)
+
+    Parameters
+    ----------
+    image: numpy.array
+        image of shape (height, width) or (height, width, channels)
+    H: numpy.array
+        homography 3x3
+    w: int
+        width of the result
+    h: int
+        height of the result
+    """
+    shape = image.shape
+    if len(shape) == 3 and shape[2] > 4:
+        # opencv is limited in number of channels, warp them in chunks
+        return numpy.concatenate([warp_image(image[:, :, i: i + 4], H, w, h, interpolation)
+                                  for i in range(0, shape[2], 4)], axis=2)
+    res = cv2.warpPerspective(image, numpy.asarray(H, dtype=numpy.float64), (w, h),
+                              flags=interpolation | cv2.WARP_INVERSE_MAP,
+                              borderMode=cv2.BORDER_CONSTANT, borderValue=0)
+    return res.reshape((h, w) + shape[2:])
+
+
+def bilinear_sampling(image, H, w, h):
+    return warp_image(image, H, w, h, interpolation=cv2.INTER_LINEAR)
+
+
+def nearest_sampling(image, H, w, h):
+    return warp_image(image, H, w, h, interpolation=cv2.INTER_NEAREST)
+
+
+def warp_batch(images, H, mode='bilinear'):
+    """
+    Warp batch of images with per-image homographies by grid_sample
+
+    Parameters
+    ----------
+    images: torch.Tensor
+        tensor of shape (batch, channels, height, width)
+    H: torch.Tensor or numpy.array
+        homographies (batch, 3, 3), pixel x of the result is sampled at H x
+    mode: str
+        'bilinear' for images, 'nearest' for labels
+
+    Returns
+    -------
+    tensor of the same shape as images
+    """
+    import torch
+    import torch.nn.functional
+    B, C, height, width = images.shape
+    dtype = images.dtype if images.is_floating_point() else torch.float32
+    H = torch.as_tensor(H, device=images.device).to(torch.float64)
+    ys, xs = torch.meshgrid(torch.arange(height, device=images.device, dtype=torch.float64),
+                            torch.arange(width, device=images.device, dtype=torch.float64),
+                            indexing='ij')
+    pts = torch.stack([xs, ys, torch.ones_like(xs)], dim=-1).view(1, -1, 3)
+    warped = pts @ H.transpose(1, 2)
+    warped = warped[..., :2] / warped[..., 2:]
+    # to [-1, 1] range expected by grid_sample
+    scale = torch.as_tensor([width - 1, height - 1], device=images.device, dtype=torch.float64)
+    grid = (warped / scale * 2 - 1).view(B, height, width, 2).to(dtype)
+    res = torch.nn.functional.grid_sample(images.to(dtype), grid, mode=mode,
+                                          padding_mode='zeros', align_corners=True)
+    return res.to(images.dtype)
+
+
 class HomographySample:
     HEIGHT = 1
     WIDTH = 0
@@ -389,7 +927,7 @@ class HomographySample:
         self.random_scale_range = random_scale_range
         self.perspective = perspective
 
-    def __call__(self, image):
+    def __call__(self, image, label=None):
         assert numpy.argmin(image.shape) != 0
         h, w = image.shape[:2]
 
@@ -408,13 +946,52 @@ class HomographySample:
             H, H_inv = self.H, self.H_inv
 
         img_template = bilinear_sampling(image, H, w, h)
-        mask = bilinear_sampling(numpy.ones(image.shape, dtype=numpy.float32) * 255.0, H, w, h)
-        mask = (mask > 0.5).astype(numpy.float32)
+        mask = nearest_sampling(numpy.ones(image.shape[:2], dtype=numpy.uint8), H, w, h)
+        mask = mask.astype(numpy.float32)
+        if len(image.shape) == 3:
+            mask = numpy.broadcast_to(mask[..., numpy.newaxis], image.shape)
         sample = {'input_img': image,
                   'template_img': img_template.reshape(image.shape),
                   'p': H,
                   'p_inv': H_inv,
                   'mask': mask}
+        if label is not None:
+            # labels are class ids, they must not be interpolated
+            sample['template_label'] = nearest_sampling(label, H, w, h)
+        return sample
+
+    def batch(self, images, labels=None):
+        """
+        Warp batch of images and optionally labels with independent homographies
+
+        Parameters
+        ----------
+        images: torch.Tensor
+            tensor of shape (batch, channels, height, width)
+        labels: torch.Tensor
+            optional tensor (batch, label_channels, height, width) warped with nearest sampling
+
+        Returns
+        -------
+        dict with the same keys as __call__, 'p' and 'p_inv' are (batch, 3, 3) tensors
+        """
+        import torch
+        B, _, h, w = images.shape
+        if any(x is None for x in [self.H, self.H_inv]):
+            H, H_inv = self.sample_homographies(B, h, w)
+        else:
+            H = numpy.broadcast_to(self.H, (B, 3, 3))
+            H_inv = numpy.broadcast_to(self.H_inv, (B, 3, 3))
+        H = torch.as_tensor(numpy.ascontiguousarray(H))
+        ones = torch.ones((B, 1, h, w), dtype=images.dtype if images.is_floating_point() else torch.float32,
+                          device=images.device)
+        sample = {'input_img': images,
+                  'template_img': warp_batch(images, H),
+                  'p': H,
+                  'p_inv': torch.as_tensor(numpy.ascontiguousarray(H_inv)),
+                  'mask': warp_batch(ones, H, mode='nearest')}
+        if labels is not None:
+            sample['template_label'] = warp_batch(labels, H, mode='nearest')
         return sample
 
     def find_homography(self, h, w, pts_pert):
@@ -434,13 +1011,15 @@ class HomographySample:
         return H, H_inv
 
     def sample_homography(self, h, w):
+        H, H_inv = self.sample_homographies(1, h, w)
+        return H[0], H_inv[0]
 
-        pts_init = self.pts_init(h, w)
+    def _perturb_points(self, h, w):
         pts_pert = self.pts_init(h, w).transpose()
         if self.beta is not None:
             pts_rand = numpy.random.randint(low=-self.beta,
                                             high=self.beta,
-                                            size=(2, 4)).astype(pts_init.dtype)
+                                            size=(2, 4)).astype(pts_pert.dtype)
             pts_pert = pts_rand + pts_pert
         if self.perspective is not None:
 
@@ -459,7 +1038,7 @@ class HomographySample:
         if self.random_scale_range is not None:
             rs_low, rs_top = self.random_scale_range
             range = (rs_top - rs_low)
-            scale = scale * numpy.random.random() * range + rs_low
+            scale = scale * (numpy.random.random() * range + rs_low)
         pts_pert = (((pts_pert.transpose() - shift) * scale) + shift).transpose()
         if self.theta is not None:
             theta = numpy.random.random() * 2 * self.theta - self.theta
@@ -467,9 +1046,19 @@ class HomographySample:
                  [numpy.sin(theta), numpy.cos(theta)]])
             pts_pert = ((pts_pert.transpose() - shift) @ R + shift).transpose()
 
-        pts_pert = numpy.transpose(pts_pert)
-        H, H_inv = calculate_h(pts_init, pts_pert)
-        return H, H_inv
+        return numpy.transpose(pts_pert)
+
+    def sample_homographies(self, n, h, w):
+        """
+        Sample n homographies for images of size h x w
+
+        Returns
+        -------
+        H, H_inv: numpy.array of shape (n, 3, 3)
+        """
+        pts_init = numpy.broadcast_to(self.pts_init(h, w), (n, 4, 2))
+        pts_pert = numpy.stack([self._perturb_points(h, w) for _ in range(n)])
+        return calculate_h_batch(pts_init, pts_pert)
 
     def perspective_side(self, left, persp, pts_pert):
         if left:
@@ -499,8 +1088,8 @@ class HomographySample:
 
 def unfold_label(points, height, width):
     """
-    generates labels of shape
-    (2, height, width)
+    generates label plane of shape
+    (height, width) with 1 at points
 
     Parameters
     ----------
@@ -510,23 +1099,12 @@ def unfold_label(points, height, width):
 
     Returns
     -------
-    tensor of shape (2, height, width)
+    array of shape (height, width)
     """
     if len(points):
         assert points[:, 0].max() < height
         assert points[:, 1].max() < width
-    tmp = numpy.ones((2, height, width))
-    # (no-point, point), (no-point, point)..
-    idx_no_point = 0
-    idx_point = 1
-    tmp[idx_point, :, :] *= 0
-    # update result for current array
-    h = tuple(min(height - 1, p) for p in numpy.rint(points[:, 0]).astype(numpy.int))
-    w = tuple(min(width - 1, p) for p in numpy.rint(points[:, 1]).astype(numpy.int))
-
-    tmp[idx_no_point, h, w] = 0
-    tmp[idx_point, h, w] = 1
-    return tmp[idx_point]
+    return rasterize_points(points, height, width, dtype=numpy.float64)[0]
 
 
 class UnfoldLabels:
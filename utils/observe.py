@@ -0,0 +1,93 @@
+"""
+Waiting for observations of the game
+
+MCConnector keeps the latest observation of each kind, observeProc()
+fetches them. ObservationHub polls the connector on the calling thread
+until all requested observations are available, as the trainers did
+before, and keeps statistics of the waits.
+
+The connector has no notification of arrived observations and no locking,
+so the hub doesn't run threads of its own. A step doesn't wait for a frame
+which differs from the previous one, the scene may be static.
+"""
+import logging
+import time
+import weakref
+
+
+FRAME = 'getImage'
+POSE = 'getAgentPos'
+
+
+class ObservationHub:
+    """
+    Polling of connector observations with wait statistics
+
+    Not thread-safe, a connector is used from one thread at a time.
+
+    Parameters
+    ----------
+    mc: MCConnector
+    interval: float
+        seconds between polls while an observation is missing
+    log_every: int
+        log statistics every log_every waits, 0 disables logging
+    """
+    def __init__(self, mc, interval=0.05, log_every=500):
+        self.mc = mc
+        self.interval = interval
+        self.log_every = log_every
+        self.waits = 0
+        self.polls = 0
+        self.wait_time = 0.0
+
+    def poll(self, names):
+        """
+        fetch observations, returns their values, None for missing ones
+        """
+        self.mc.observeProc()
+        self.polls += 1
+        return [getattr(self.mc, name)() for name in names]
+
+    def wait(self, names=(FRAME, POSE), check=None):
+        """
+        Poll until all observations names are available, returns their values
+
+        check is called after every poll with missing observations,
+        e.g. to raise if the agent died
+        """
+        start = time.perf_counter()
+        self.waits += 1
+        values = self.poll(names)
+        while any(value is None for value in values):
+            if check is not None:
+                check()
+            time.sleep(self.interval)
+            values = self.poll(names)
+        self.wait_time += time.perf_counter() - start
+        if self.log_every and self.waits % self.log_every == 0:
+            logging.debug('observations: %s', self.stats())
+        return values
+
+    def stats(self):
+        """
+        mean time spent in wait() in milliseconds and mean polls per wait
+        """
+        n = max(self.waits, 1)
+        return dict(waits=self.waits,
+                    wait_ms=self.wait_time * 1000 / n,
+                    polls=self.polls / n)
+
+
+_hubs = weakref.WeakKeyDictionary()
+
+
+def hub_for(mc, **kwargs):
+    """
+    ObservationHub of the connector mc, created on first use
+    """
+    hub = _hubs.get(mc)
+    if hub is None:
+        hub = ObservationHub(mc, **kwargs)
+        _hubs[mc] = hub
+    return hub
@@ -0,0 +1,263 @@
+"""
+Compiler of declarative augmentation pipelines
+
+Pipeline is described by a list of ops or a dict with keys
+'layout', 'dtype', 'input_layout', 'reorder' and 'ops'.
+Each op is a dict with 'name' from utils.noise.mapping (or label_mapping),
+optional probability 'p' and keyword arguments of the transform, e.g.
+
+    ops:
+      - name: resize
+        size: [320, 240]
+        p: 1
+      - name: additive_gaussian
+        var: 30
+      - name: motion_blur
+        max_kernel_size: 5
+
+The compiled pipeline converts input to a single dtype once,
+transposes only in front of ops which require the other layout and
+reports estimated cost of every op. Output has the layout and the number
+of dimensions of input, 2-d images are processed as single channel ones
+by ops which require a layout.
+"""
+import inspect
+import logging
+import random
+from collections import namedtuple
+
+import numpy
+
+from utils import noise
+
+
+CHW = 'CHW'
+HWC = 'HWC'
+
+# layout: layout required by the op, None if op works on any layout
+# cost: rough estimate in milliseconds per megapixel of a float32 image
+# geometric: op changes image size, it's moved in front of the pipeline
+# channel_arg: keyword argument which selects the channel axis
+OpInfo = namedtuple('OpInfo', ['layout', 'cost', 'geometric', 'channel_arg'])
+
+op_info = {'random_brightness': OpInfo(None, 3.1, False, 'channel'),
+           'additive_gaussian': OpInfo(None, 3.0, False, None),
+           'salt_and_pepper': OpInfo(None, 3.8, False, None),
+           'additive_shade': OpInfo(CHW, 11.4, False, None),
+           'speckle': OpInfo(None, 2.4, False, None),
+           'random_contrast': OpInfo(None, 3.6, False, None),
+           'motion_blur': OpInfo(CHW, 32.2, False, None),
+           'blur': OpInfo(None, 47.7, False, None),
+           'resize': OpInfo(HWC, 2.4, True, None),
+           }
+
+label_op_info = {'resize': OpInfo(None, 2.4, True, None)}
+
+
+def transpose(x, src, dst):
+    if src == dst or len(x.shape) != 3:
+        return x
+    if src == CHW:
+        return x.transpose(1, 2, 0)
+    return x.transpose(2, 0, 1)
+
+
+class HWCResize:
+    """
+    noise.Resize which returns single channel images in HWC layout,
+    noise.resize returns them as (1, height, width)
+    """
+    def __init__(self, resize):
+        self.resize = resize
+        self.size = resize.size
+
+    def __call__(self, x):
+        result = self.resize(x)
+        if x.shape[2] == 1:
+            result = result.transpose(1, 2, 0)
+        return result
+
+
+class CompiledOp:
+    def __init__(self, name, transform, info, p, layout):
+        self.name = name
+        self.transform = transform
+        self.info = info
+        self.p = p
+        self.layout = layout
+
+
+class CompiledPipeline:
+    """
+    Callable built by compile_pipeline
+
+    Counts layout and dtype conversions done while running,
+    so hidden conversions are visible in report()
+    """
+    def __init__(self, ops, layout, dtype, input_layout, std_guard=True):
+        self.ops = ops
+        self.layout = layout
+        self.dtype = numpy.dtype(dtype)
+        self.input_layout = input_layout
+        self.std_guard = std_guard
+        self.transposes = 0
+        self.casts = 0
+        # 2-d input gets a channel axis for ops which require a layout
+        self.expand = any(op.layout is not None for op in ops)
+
+    def __call__(self, x):
+        # the only expected conversion
+        x = x.astype(self.dtype, copy=False)
+        flat = self.expand and x.ndim == 2
+        if flat:
+            x = x[:, :, numpy.newaxis] if self.input_layout == HWC else x[numpy.newaxis]
+        current = self.input_layout
+        for op in self.ops:
+            if op.p < 1 and random.random() >= op.p:
+                continue
+            layout = op.layout or self.layout
+            if layout != current:
+                x = self._transpose(x, current, layout)
+                current = layout
+            if self.std_guard and not op.info.geometric:
+                x_std = x.std()
+                if x_std < 0.01:
+                    continue
+                new_x = op.transform(x)
+                if new_x.std() < 0.1 * x_std:
+                    logging.debug("%s decreased std to %f from %f", op.name, new_x.std(), x_std)
+                    continue
+            else:
+                new_x = op.transform(x)
+            x = self._cast(new_x)
+        x = self._transpose(x, current, self.input_layout)
+        if flat:
+            x = x[:, :, 0] if self.input_layout == HWC else x[0]
+        return x
+
+    def _cast(self, x):
+        if x.dtype != self.dtype:
+            self.casts += 1
+            return x.astype(self.dtype)
+        return x
+
+    def _transpose(self, x, src, dst):
+        if src != dst:
+            self.transposes += 1
+        return transpose(x, src, dst)
+
+    def estimate(self, shape):
+        """
+        Estimated cost in milliseconds of every op for image of given shape,
+        weighted by probability of the op. Geometric ops update the shape.
+        """
+        result = []
+        pixels = numpy.prod(shape) / 1e6
+        for op in self.ops:
+            result.append((op.name, op.layout or self.layout, op.info.cost * pixels * op.p))
+            if op.name == 'resize':
+                size = op.transform.size
+                channels = min(shape) if len(shape) == 3 else 1
+                pixels = size[0] * size[1] * channels / 1e6
+        return result
+
+    def report(self, shape):
+        lines = ['{0:20} {1:6} {2:>10}'.format('op', 'layout', 'est ms')]
+        total = 0
+        for name, layout, cost in self.estimate(shape):
+            lines.append('{0:20} {1:6} {2:10.3f}'.format(name, layout, cost))
+            total += cost
+        lines.append('{0:20} {1:6} {2:10.3f}'.format('total', self.layout, total))
+        lines.append('transposes {0} casts {1}'.format(self.transposes, self.casts))
+        return '\n'.join(lines)
+
+
+def choose_layout(ops_info, input_layout):
+    """
+    pick the layout required by most ops, prefer input layout on ties
+    """
+    counts = {CHW: 0, HWC: 0}
+    for info in ops_info:
+        if info.layout is not None:
+            counts[info.layout] += 1
+    other = HWC if input_layout == CHW else CHW
+    if counts[other] > counts[input_layout]:
+        return other
+    return input_layout
+
+
+def compile_pipeline(config, registry=None, infos=None):
+    """
+    Build CompiledPipeline from declarative config
+
+    Parameters
+    ----------
+    config: list or dict
+        list of op dicts or dict with 'ops' and pipeline options
+    registry: dict
+        name -> transform class, default utils.noise.mapping
+    infos: dict
+        name -> OpInfo, default op_info
+    """
+    if registry is None:
+        registry = noise.mapping
+    if infos is None:
+        infos = op_info
+    if isinstance(config, (list, tuple)):
+        config = dict(ops=config)
+    input_layout = config.get('input_layout', HWC)
+    dtype = config.get('dtype', 'float32')
+    ops_config = [dict(item) for item in config['ops']]
+    if config.get('reorder', True):
+        # size changing ops first so the rest of the pipeline processes fewer pixels
+        ops_config.sort(key=lambda item: not infos[item['name']].geometric)
+    layout = config.get('layout') or choose_layout([infos[item['name']] for item in ops_config], input_layout)
+    # noise ops share pregenerated fields, they also keep float32 dtype
+    bank = noise.NoiseBank()
+    ops = []
+    for item in ops_config:
+        name = item.pop('name')
+        info = infos[name]
+        p = item.pop('p', 1 if info.geometric else 0.5)
+        op_layout = info.layout
+        if info.channel_arg is not None and info.channel_arg not in item:
+            item[info.channel_arg] = 0 if layout == CHW else 2
+            op_layout = layout
+        if 'bank' in inspect.signature(registry[name]).parameters:
+            item.setdefault('bank', bank)
+        transform = registry[name](**item)
+        if registry[name] is noise.Resize:
+            transform = HWCResize(transform)
+        ops.append(CompiledOp(name, transform, info, p, op_layout))
+    if config.get('reorder', True):
+        # run ops which need the other layout next to each other
+        ops = group_by_layout(ops, layout)
+    return CompiledPipeline(ops, layout, dtype, input_layout,
+                            std_guard=config.get('std_guard', True))
+
+
+def group_by_layout(ops, layout):
+    """
+    stable reordering: geometric ops, then ops in pipeline layout, then the rest
+    """
+    geometric = [op for op in ops if op.info.geometric]
+    same = [op for op in ops if not op.info.geometric and op.layout in (None, layout)]
+    other = [op for op in ops if not op.info.geometric and op.layout not in (None, layout)]
+    return geometric + same + other
+
+
+def compile_label_pipeline(config):
+    if isinstance(config, (list, tuple)):
+        config = dict(ops=config)
+    config = dict(config)
+    config.setdefault('std_guard', False)
+    return compile_pipeline(config, registry=noise.label_mapping, infos=label_op_info)
+
+
+def load_pipeline(path):
+    """
+    Compile pipeline from yaml file, requires pyyaml
+    """
+    import yaml
+    with open(path) as f:
+        return compile_pipeline(yaml.safe_load(f))
@@ -0,0 +1,200 @@
+"""
+Opt-in profiler of augmentation transforms
+
+Counters live in shared memory allocated before DataLoader starts
+its workers. Each worker writes to the row of its worker id, so rows are
+reused by workers of the next epoch and the main process sees totals of
+all workers. Threads of one process, e.g. augmentation threads of
+utils.replay.ReplayPrefetcher, share its row under a lock.
+"""
+import json
+import logging
+import multiprocessing
+import os
+import threading
+import time
+
+import numpy
+
+
+CALLS = 0
+SKIPPED = 1
+REJECTED = 2
+TIME = 3
+STD = 4
+N_FIELDS = 5
+
+# histogram bin edges for wall time in seconds: 10us .. 100ms
+TIME_BINS = numpy.logspace(-5, -1, 9)
+
+_slot_lock = threading.Lock()
+
+
+def worker_slot():
+    """
+    0 in the main process, 1 + worker id in DataLoader workers
+    """
+    try:
+        from torch.utils.data import get_worker_info
+    except ImportError:
+        return 0
+    info = get_worker_info()
+    if info is None:
+        return 0
+    return info.id + 1
+
+
+class TransformProfiler:
+    """
+    Per-transform call counts, wall time histograms,
+    rejection counts and output std
+
+    Parameters
+    ----------
+    names: list
+        names of profiled transforms, index in this list identifies transform
+    max_workers: int
+        maximal number of DataLoader workers, calls in workers with larger
+        ids are not recorded
+    """
+    def __init__(self, names, max_workers=16):
+        self.names = list(names)
+        self.n_slots = max_workers + 1
+        self.row = N_FIELDS + len(TIME_BINS) + 1
+        self._raw = multiprocessing.RawArray('d', self.n_slots * len(self.names) * self.row)
+        self._init_views()
+
+    @classmethod
+    def for_transformers(cls, transformers, **kwargs):
+        return cls([type(t).__name__ for t in transformers], **kwargs)
+
+    def _init_views(self):
+        self._data = numpy.frombuffer(self._raw, dtype=numpy.float64).reshape(
+            (self.n_slots, len(self.names), self.row))
+        self._pid = None
+        self._slot = 0
+        self._lock = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop('_data')
+        state.pop('_lock')
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._init_views()
+
+    def _process_slot(self):
+        pid = os.getpid()
+        if pid != self._pid:
+            # first record in this process, a forked worker doesn't reuse locks of the parent
+            with _slot_lock:
+                if pid != self._pid:
+                    self._lock = threading.Lock()
+                    self._slot = worker_slot()
+                    self._pid = pid
+                    if self._slot >= self.n_slots:
+                        logging.warning('TransformProfiler: worker %i is not recorded, max_workers is %i',
+                                        self._slot - 1, self.n_slots - 1)
+        return self._slot
+
+    def record(self, idx, seconds=None, skipped=False, rejected=False, std=None):
+        """
+        Record one call of transform idx
+
+        Parameters
+        ----------
+        idx: int
+            index of transform in names
+        seconds: float
+            wall time of the call, None if transform wasn't called
+        skipped: bool
+            transform wasn't called since input std is too low
+        rejected: bool
+            output was discarded by std guard
+        std: float
+            std of transform output
+        """
+        slot = self._process_slot()
+        if slot >= self.n_slots:
+            return
+        with self._lock:
+            row = self._data[slot, idx]
+            row[CALLS] += 1
+            if skipped:
+                row[SKIPPED] += 1
+            if rejected:
+                row[REJECTED] += 1
+            if seconds is not None:
+                row[TIME] += seconds
+                row[N_FIELDS + numpy.searchsorted(TIME_BINS, seconds)] += 1
+            if std is not None:
+                row[STD] += std
+
+    def wrap(self, transform, name=None):
+        """
+        Wrap single transform, e.g. from utils.noise, to record its calls
+        """
+        if name is None:
+            name = type(transform).__name__
+        return ProfiledTransform(transform, self, self.names.index(name))
+
+    def reset(self):
+        self._data[:] = 0
+
+    def summary(self):
+        total = self._data.sum(axis=0)
+        result = dict()
+        for name, row in zip(self.names, total):
+            timed = row[N_FIELDS:].sum()
+            result[name] = dict(calls=int(row[CALLS]),
+                                skipped=int(row[SKIPPED]),
+                                rejected=int(row[REJECTED]),
+                                total_ms=row[TIME] * 1000,
+                                mean_ms=row[TIME] * 1000 / max(timed, 1),
+                                mean_std=row[STD] / max(timed, 1),
+                                time_hist=row[N_FIELDS:].astype(int).tolist())
+        return result
+
+    def table(self):
+        summary = self.summary()
+        total_ms = sum(v['total_ms'] for v in summary.values()) or 1
+        lines = ['{0:20} {1:>8} {2:>8} {3:>8} {4:>10} {5:>8} {6:>6}'.format(
+                 'transform', 'calls', 'skipped', 'rejected', 'total ms', 'mean ms', 'share')]
+        for name, v in sorted(summary.items(), key=lambda x: -x[1]['total_ms']):
+            lines.append('{0:20} {1:8} {2:8} {3:8} {4:10.1f} {5:8.3f} {6:6.1%}'.format(
+                name, v['calls'], v['skipped'], v['rejected'],
+                v['total_ms'], v['mean_ms'], v['total_ms'] / total_ms))
+        return '\n'.join(lines)
+
+    def to_json(self, path=None):
+        data = dict(time_bins_s=TIME_BINS.tolist(), transforms=self.summary())
+        result = json.dumps(data, indent=1)
+        if path is not None:
+            with open(path, 'w') as f:
+                f.write(result)
+        return result
+
+    def log_epoch(self, epoch, path=None, reset=True):
+        """
+        Log table at the end of epoch, optionally dump json and reset counters
+        """
+        logging.info('augmentation profile, epoch %i\n%s', epoch, self.table())
+        if path is not None:
+            self.to_json(path)
+        if reset:
+            self.reset()
+
+
+class ProfiledTransform:
+    def __init__(self, transform, profiler, idx):
+        self.transform = transform
+        self.profiler = profiler
+        self.idx = idx
+
+    def __call__(self, x):
+        start = time.perf_counter()
+        result = self.transform(x)
+        self.profiler.record(self.idx, time.perf_counter() - start)
+        return result
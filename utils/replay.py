@@ -0,0 +1,599 @@
+"""
+Replay memory with frames stored once
+
+States built by Trainer.collect_state hold a stack of frames in 'images'
+with their ids in 'frame_ids'. FrameReplayMemory keeps every frame once,
+quantized to uint8, in a ring of frames, transitions reference frames by id,
+other fields of states live in a structured array. Both arrays are
+memory-mapped files, so persisting the memory is a flush of dirty pages
+and a small json file with positions.
+"""
+import json
+import logging
+import os
+import queue
+import random
+import threading
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy
+import torch
+
+
+Transition = namedtuple('Transition', ('state', 'action', 'next_state', 'reward'))
+
+# fields of states kept in the structured array, other keys are dropped:
+# required fields, their shapes are taken from the first state,
+# and optional scalars, filled with the default if a state lacks them
+REQUIRED_KEYS = ('state', 'frame_ids', 'frame_id')
+SCALAR_DEFAULTS = dict(reward=0.0, ypos=numpy.nan, yaw=numpy.nan, pitch=numpy.nan)
+
+
+class FrameReplayMemory:
+    """
+    Drop-in replacement of DQN replay memory: push(state, action, next_state, reward),
+    sample(batch_size), len() and position
+
+    Only REQUIRED_KEYS and SCALAR_DEFAULTS of states are stored, 'images' and
+    'image' are rebuilt from frames, so states may differ in other keys.
+    Transitions whose frames were overwritten in the ring are not sampled.
+
+    Parameters
+    ----------
+    capacity: int
+        maximal number of transitions
+    path: str
+        directory for memory-mapped files, existing memory is resumed from it,
+        None keeps everything in RAM
+    frames_per_transition: float
+        size of the frame ring relative to capacity,
+        consecutive transitions of an episode add one new frame
+    """
+    def __init__(self, capacity, path=None, frames_per_transition=2):
+        self.capacity = capacity
+        self.path = path
+        self.frame_capacity = int(capacity * frames_per_transition) + 8
+        self.position = 0
+        self.size = 0
+        self.frame_position = 0
+        self._lock = threading.Lock()
+        self._transitions = None
+        self._frames = None
+        self._frame_ids = None
+        self._slots = dict()
+        self._keys = None
+        if path is not None and os.path.exists(self._file('meta.json')):
+            self._resume()
+
+    def _file(self, name):
+        return os.path.join(self.path, name)
+
+    def __len__(self):
+        return self.size
+
+    def _alloc(self, dtype, frame_shape, mode='w+'):
+        if self.path is None:
+            self._transitions = numpy.zeros(self.capacity, dtype=dtype)
+            self._frames = numpy.zeros((self.frame_capacity,) + frame_shape, dtype=numpy.uint8)
+            self._frame_ids = numpy.full(self.frame_capacity, -1, dtype=numpy.int64)
+            return
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+        open_memmap = numpy.lib.format.open_memmap
+        if mode == 'w+':
+            self._transitions = open_memmap(self._file('transitions.npy'), mode, dtype=dtype,
+                                            shape=(self.capacity,))
+            self._frames = open_memmap(self._file('frames.npy'), mode, dtype=numpy.uint8,
+                                       shape=(self.frame_capacity,) + frame_shape)
+            self._frame_ids = open_memmap(self._file('frame_ids.npy'), mode, dtype=numpy.int64,
+                                          shape=(self.frame_capacity,))
+            self._frame_ids[:] = -1
+        else:
+            self._transitions = open_memmap(self._file('transitions.npy'), mode)
+            self._frames = open_memmap(self._file('frames.npy'), mode)
+            self._frame_ids = open_memmap(self._file('frame_ids.npy'), mode)
+
+    def _resume(self):
+        """
+        open persisted memory, returns its meta or None if memory starts empty
+        """
+        with open(self._file('meta.json')) as f:
+            meta = json.load(f)
+        if meta['capacity'] != self.capacity or meta['frame_capacity'] != self.frame_capacity:
+            logging.warning('replay memory in %s has different capacity, starting empty', self.path)
+            return None
+        if [key for key, _, _ in meta['keys']] != list(REQUIRED_KEYS) + list(SCALAR_DEFAULTS):
+            logging.warning('replay memory in %s has different fields, starting empty', self.path)
+            return None
+        self._alloc(None, None, mode='r+')
+        self._keys = meta['keys']
+        self.position = meta['position']
+        self.size = meta['size']
+        self.frame_position = meta['frame_position']
+        self._slots = {int(frame_id): slot for slot, frame_id in enumerate(self._frame_ids)
+                       if frame_id >= 0}
+        logging.info('resumed replay memory with %i transitions from %s', self.size, self.path)
+        return meta
+
+    def _init_layout(self, state, action, reward):
+        """
+        structured dtype from the first transition: a field per stored key,
+        prefixed with s_ for state and n_ for next state
+        """
+        fields = [('action', numpy.int64, numpy.shape(action)),
+                  ('reward', numpy.float32, numpy.shape(reward)),
+                  ('has_next', numpy.bool_)]
+        self._keys = []
+        for key in REQUIRED_KEYS:
+            value = numpy.asarray(state[key])
+            self._keys.append([key, value.dtype.str, list(value.shape)])
+        for key in SCALAR_DEFAULTS:
+            self._keys.append([key, numpy.dtype(numpy.float32).str, []])
+        for prefix in ('s_', 'n_'):
+            for key, dtype, shape in self._keys:
+                fields.append((prefix + key, dtype, tuple(shape)))
+        frame_shape = tuple(state['images'].shape[1:])
+        self._alloc(numpy.dtype(fields), frame_shape)
+
+    @staticmethod
+    def _check(state):
+        missing = [key for key in REQUIRED_KEYS + ('images',) if key not in state]
+        if missing:
+            raise ValueError('FrameReplayMemory requires {0} in states'.format(', '.join(missing)))
+
+    def _store_state(self, record, prefix, state):
+        for key, _, _ in self._keys:
+            value = state.get(key)
+            if value is None:
+                value = SCALAR_DEFAULTS[key]
+            record[prefix + key] = numpy.asarray(value)
+
+    def _store_frames(self, state):
+        for frame_id, frame in zip(state['frame_ids'].tolist(), state['images']):
+            if frame_id in self._slots:
+                continue
+            slot = self.frame_position
+            old_id = self._frame_ids[slot]
+            if old_id >= 0:
+                self._slots.pop(int(old_id), None)
+            self._frames[slot] = (frame * 255).round().clamp(0, 255).to(torch.uint8).cpu().numpy()
+            self._frame_ids[slot] = frame_id
+            self._slots[frame_id] = slot
+            self.frame_position = (slot + 1) % self.frame_capacity
+
+    def push(self, state, action, next_state, reward):
+        with self._lock:
+            self._push(state, action, next_state, reward)
+
+    def _push(self, state, action, next_state, reward):
+        """
+        store transition, returns its index
+        """
+        self._check(state)
+        if next_state is not None:
+            self._check(next_state)
+        if self._transitions is None:
+            self._init_layout(state, action, reward)
+        self._store_frames(state)
+        record = self._transitions[self.position]
+        record['action'] = numpy.asarray(action)
+        record['reward'] = numpy.asarray(reward)
+        record['has_next'] = next_state is not None
+        self._store_state(record, 's_', state)
+        if next_state is not None:
+            self._store_frames(next_state)
+            self._store_state(record, 'n_', next_state)
+        idx = self.position
+        self.position = (self.position + 1) % self.capacity
+        self.size = min(self.size + 1, self.capacity)
+        return idx
+
+    def _valid(self, record):
+        if not all(int(i) in self._slots for i in record['s_frame_ids']):
+            return False
+        return not record['has_next'] or all(int(i) in self._slots for i in record['n_frame_ids'])
+
+    def _state(self, record, prefix, slots):
+        ids = record[prefix + 'frame_ids']
+        slots = [slots[int(i)] for i in ids]
+        images = torch.from_numpy(self._frames[slots]).float() / 255.
+        result = {key: torch.as_tensor(numpy.array(record[prefix + key]))
+                  for key, _, _ in self._keys}
+        result['images'] = images
+        result['image'] = images[0]
+        return result
+
+    def _transition(self, record, slots):
+        next_state = self._state(record, 'n_', slots) if record['has_next'] else None
+        return Transition(self._state(record, 's_', slots),
+                          torch.as_tensor(numpy.array(record['action'])),
+                          next_state,
+                          torch.as_tensor(numpy.array(record['reward'])))
+
+    @staticmethod
+    def _record_frame_ids(record):
+        ids = record['s_frame_ids'].tolist()
+        if record['has_next']:
+            ids += record['n_frame_ids'].tolist()
+        return ids
+
+    def _take(self, indices):
+        """
+        copies of valid records at indices and slots of their frames, called under the lock
+        """
+        if not len(indices):
+            return [], dict()
+        records = self._transitions[indices]
+        slots = {int(i): self._slots[int(i)]
+                 for record in records for i in self._record_frame_ids(record)}
+        return records, slots
+
+    def _build(self, records, slots):
+        """
+        transitions of records taken by _take, frames are read without the lock
+
+        Returns transitions and a mask of those whose frames were
+        not overwritten in the ring while they were read.
+        """
+        transitions = [self._transition(record, slots) for record in records]
+        with self._lock:
+            # a slot is released before it is overwritten
+            kept = set(i for i, slot in slots.items() if self._slots.get(i) == slot)
+        intact = numpy.array([all(int(i) in kept for i in self._record_frame_ids(record))
+                              for record in records], dtype=bool)
+        return transitions, intact
+
+    def sample(self, batch_size):
+        return self.sample_batch(batch_size)[0]
+
+    def sample_batch(self, batch_size):
+        """
+        transitions, their indices and importance weights, uniform sampling has no weights
+        """
+        with self._lock:
+            indices = []
+            for idx in random.sample(range(self.size), min(batch_size * 2, self.size)):
+                if not self._valid(self._transitions[idx]):
+                    continue
+                indices.append(idx)
+                if len(indices) == batch_size:
+                    break
+            indices = numpy.asarray(indices, dtype=numpy.int64)
+            records, slots = self._take(indices)
+        transitions, intact = self._build(records, slots)
+        return [t for t, ok in zip(transitions, intact) if ok], indices[intact], None
+
+    def snapshot(self):
+        """
+        positions and other small state of the memory at the moment of the call,
+        flush(snapshot) persists the memory as of this moment
+        """
+        with self._lock:
+            return self._snapshot()
+
+    def _snapshot(self):
+        return dict(capacity=self.capacity, frame_capacity=self.frame_capacity,
+                    position=self.position, size=self.size,
+                    frame_position=self.frame_position, keys=self._keys)
+
+    def flush(self, snapshot=None):
+        """
+        write dirty pages and positions, no-op for in-memory replay
+
+        Pages are written without holding the lock, so pushes and sampling
+        go on. Transitions pushed after the snapshot may already be on disk
+        and replace older ones of a full ring, positions are those of the snapshot.
+        """
+        if self.path is None or self._transitions is None:
+            return
+        if snapshot is None:
+            snapshot = self.snapshot()
+        for array in (self._transitions, self._frames, self._frame_ids):
+            array.flush()
+        self._write_meta(snapshot)
+
+    def _write_meta(self, snapshot):
+        tmp = self._file('meta.json.tmp')
+        with open(tmp, 'w') as f:
+            json.dump(snapshot, f)
+        os.replace(tmp, self._file('meta.json'))
+
+    def __getstate__(self):
+        # pickling persists the memory instead of copying it
+        self.flush()
+        state = self.__dict__.copy()
+        for key in ('_lock', '_transitions', '_frames', '_frame_ids', '_slots'):
+            state.pop(key)
+        if self.path is None:
+            logging.warning('in-memory FrameReplayMemory is pickled without transitions')
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+        self._transitions = None
+        self._frames = None
+        self._frame_ids = None
+        self._slots = dict()
+        self.position = self.size = self.frame_position = 0
+        if self.path is not None and os.path.exists(self._file('meta.json')):
+            self._resume()
+
+
+class SumTree:
+    """
+    Binary tree of priorities in a flat array, every node holds the sum of its children
+
+    Updates and sampling of a batch take O(batch * log n) vectorized operations.
+    """
+    def __init__(self, capacity):
+        self.leaves = 1
+        while self.leaves < capacity:
+            self.leaves *= 2
+        self.tree = numpy.zeros(2 * self.leaves, dtype=numpy.float64)
+
+    @property
+    def total(self):
+        return self.tree[1]
+
+    def get(self, indices):
+        return self.tree[numpy.asarray(indices) + self.leaves]
+
+    def update(self, indices, priorities):
+        nodes = numpy.asarray(indices, dtype=numpy.int64) + self.leaves
+        self.tree[nodes] = priorities
+        nodes = numpy.unique(nodes // 2)
+        while nodes[0] >= 1:
+            self.tree[nodes] = self.tree[2 * nodes] + self.tree[2 * nodes + 1]
+            if nodes[0] == 1:
+                break
+            nodes = numpy.unique(nodes // 2)
+
+    def find(self, values):
+        """
+        indices of leaves where prefix sums reach values
+        """
+        values = numpy.array(values, dtype=numpy.float64)
+        nodes = numpy.ones(len(values), dtype=numpy.int64)
+        while nodes[0] < self.leaves:
+            left = 2 * nodes
+            left_sum = self.tree[left]
+            right = values > left_sum
+            values -= numpy.where(right, left_sum, 0)
+            nodes = left + right
+        return nodes - self.leaves
+
+
+class PrioritizedReplayMemory(FrameReplayMemory):
+    """
+    FrameReplayMemory with proportional prioritized sampling
+
+    New transitions get the maximal priority seen so far. sample() stores
+    indices and importance weights of the batch in last_indices and
+    last_weights, update_priorities() sets priorities from TD errors.
+    utils.dqn.PrioritizedDQN does both.
+
+    Parameters
+    ----------
+    alpha: float
+        priority exponent, 0 is uniform sampling
+    beta: float
+        initial importance weight exponent, annealed to 1
+    beta_steps: int
+        number of sampled batches to anneal beta over
+    eps: float
+        added to absolute TD errors, so every transition can be sampled
+    """
+    def __init__(self, capacity, path=None, frames_per_transition=2,
+                 alpha=0.6, beta=0.4, beta_steps=100000, eps=0.01):
+        self.alpha = alpha
+        self.beta0 = beta
+        self.beta_steps = beta_steps
+        self.eps = eps
+        self.tree = SumTree(capacity)
+        self.max_priority = 1.0
+        self.n_sampled = 0
+        self.last_indices = None
+        self.last_weights = None
+        super().__init__(capacity, path=path, frames_per_transition=frames_per_transition)
+
+    def _resume(self):
+        meta = super()._resume()
+        if meta is None:
+            return None
+        path = self._file('priorities.npy')
+        if 'max_priority' in meta and os.path.exists(path):
+            self.tree.update(numpy.arange(self.capacity), numpy.load(path))
+            self.max_priority = meta['max_priority']
+            self.n_sampled = meta['n_sampled']
+        elif self.size:
+            # saved without priorities, resumed transitions start equal
+            self.tree.update(numpy.arange(self.size), self.max_priority)
+        return meta
+
+    def _snapshot(self):
+        result = super()._snapshot()
+        result.update(max_priority=float(self.max_priority), n_sampled=self.n_sampled,
+                      priorities=self.tree.get(numpy.arange(self.capacity)))
+        return result
+
+    def _write_meta(self, snapshot):
+        snapshot = dict(snapshot)
+        tmp = self._file('priorities.npy.tmp')
+        with open(tmp, 'wb') as f:
+            numpy.save(f, snapshot.pop('priorities'))
+        os.replace(tmp, self._file('priorities.npy'))
+        super()._write_meta(snapshot)
+
+    @property
+    def beta(self):
+        return min(1.0, self.beta0 + (1 - self.beta0) * self.n_sampled / self.beta_steps)
+
+    def push(self, state, action, next_state, reward):
+        with self._lock:
+            idx = self._push(state, action, next_state, reward)
+            self.tree.update([idx], self.max_priority)
+
+    def sample(self, batch_size):
+        result, self.last_indices, self.last_weights = self.sample_batch(batch_size)
+        return result
+
+    def sample_batch(self, batch_size):
+        with self._lock:
+            indices = numpy.zeros(0, dtype=numpy.int64)
+            for _ in range(3):
+                total = self.tree.total
+                if not total:
+                    break
+                # stratified: one value per segment of the total priority
+                values = (numpy.arange(batch_size) + numpy.random.random(batch_size)) * total / batch_size
+                indices = numpy.minimum(self.tree.find(values), self.size - 1)
+                valid = numpy.array([self._valid(self._transitions[i]) for i in indices])
+                if not valid.all():
+                    # frames of these transitions are gone, never sample them again
+                    self.tree.update(indices[~valid], 0)
+                    indices = indices[valid]
+                if len(indices):
+                    break
+            if not len(indices):
+                return [], indices, None
+            # probabilities of valid transitions, zeroed leaves are out of the total
+            probs = self.tree.get(indices) / self.tree.total
+            size = self.size
+            self.n_sampled += 1
+            records, slots = self._take(indices)
+        transitions, intact = self._build(records, slots)
+        if not intact.any():
+            return [], indices[intact], None
+        weights = (size * probs[intact]) ** -self.beta
+        weights = torch.as_tensor(weights / weights.max(), dtype=torch.float32)
+        return [t for t, ok in zip(transitions, intact) if ok], indices[intact], weights
+
+    def update_priorities(self, indices, td_errors):
+        priorities = (numpy.abs(numpy.asarray(td_errors, dtype=numpy.float64)) + self.eps) ** self.alpha
+        with self._lock:
+            self.tree.update(indices, priorities)
+            self.max_priority = max(self.max_priority, priorities.max())
+
+
+def collate(states):
+    return {key: torch.stack([s[key] for s in states]) for key in states[0]}
+
+
+def augment_frames(transitions, transform, scale=255., pool=None):
+    """
+    Apply transform to every distinct frame of the transitions, in place
+
+    Frames are identified by frame_ids, so a frame shared by several states
+    gets the same augmentation in all of them.
+
+    transform: callable
+        HWC numpy array in range [0, scale] -> HWC array or tensor,
+        e.g. utils.common.make_noisy_transformers()
+    pool: concurrent.futures.Executor
+        optional, distinct frames are augmented in its threads
+    """
+    frames = dict()
+    for t in transitions:
+        for state in (t.state, t.next_state):
+            if state is None:
+                continue
+            for frame_id, frame in zip(state['frame_ids'].tolist(), state['images']):
+                frames.setdefault(frame_id, frame)
+
+    def augment(frame):
+        x = frame.numpy().transpose(1, 2, 0) * scale
+        y = torch.as_tensor(numpy.asarray(transform(x), dtype=numpy.float32))
+        return (y.permute(2, 0, 1) / scale).clamp(0, 1)
+
+    items = list(frames.values())
+    results = list(pool.map(augment, items) if pool is not None else map(augment, items))
+    augmented = dict(zip(frames, results))
+    for t in transitions:
+        for state in (t.state, t.next_state):
+            if state is None:
+                continue
+            state['images'] = torch.stack([augmented[i] for i in state['frame_ids'].tolist()])
+            state['image'] = state['images'][0]
+    return transitions
+
+
+def make_batch(transitions, indices=None, weights=None):
+    """
+    collate sampled transitions for utils.dqn.PrioritizedDQN
+    """
+    has_next = [i for i, t in enumerate(transitions) if t.next_state is not None]
+    return dict(states=collate([t.state for t in transitions]),
+                actions=torch.stack([t.action for t in transitions]).long().view(-1, 1),
+                rewards=torch.stack([t.reward for t in transitions]).float().view(-1),
+                next_states=collate([transitions[i].next_state for i in has_next]) if has_next else None,
+                has_next=has_next,
+                indices=indices,
+                weights=weights)
+
+
+class ReplayPrefetcher:
+    """
+    Keeps up to k collated batches ready in a queue
+
+    A feeder thread samples transitions and augments them in a pool of
+    worker threads, so the learner takes a ready batch on every step.
+    Priorities updated from a batch apply to batches sampled later.
+
+    Parameters
+    ----------
+    memory: FrameReplayMemory
+    batch_size: int
+    transform: callable
+        optional augmentation, see augment_frames
+    k: int
+        number of queued batches
+    workers: int
+        number of augmentation threads
+    """
+    def __init__(self, memory, batch_size, transform=None, k=4, workers=2):
+        self.memory = memory
+        self.batch_size = batch_size
+        self.transform = transform
+        self.workers = workers
+        self.queue = queue.Queue(maxsize=k)
+        self._pool = ThreadPoolExecutor(max_workers=workers)
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._feed, name='ReplayPrefetcher', daemon=True)
+        self._thread.start()
+
+    def _augment(self, transitions):
+        if self.transform is None:
+            return transitions
+        # distinct frames of the whole batch are augmented in the pool
+        return augment_frames(transitions, self.transform, pool=self._pool)
+
+    def _feed(self):
+        try:
+            while not self._stop.is_set():
+                if len(self.memory) < self.batch_size:
+                    self._stop.wait(0.1)
+                    continue
+                transitions, indices, weights = self.memory.sample_batch(self.batch_size)
+                if not transitions:
+                    self._stop.wait(0.1)
+                    continue
+                batch = make_batch(self._augment(transitions), indices, weights)
+                while not self._stop.is_set():
+                    try:
+                        self.queue.put(batch, timeout=0.1)
+                        break
+                    except queue.Full:
+                        pass
+        except Exception:
+            logging.exception('replay prefetcher failed')
+            raise
+
+    def get(self, timeout=None):
+        return self.queue.get(timeout=timeout)
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        self._pool.shutdown()
@@ -0,0 +1,86 @@
+"""
+Adaptive amount of learning per episode
+"""
+import logging
+import math
+import time
+
+
+class UpdateScheduler:
+    """
+    Keep gradient steps close to ratio * environment steps
+    within a wall-clock budget per episode
+
+    Cost of a gradient step is measured while learning, so the number
+    of minibatches follows the actual speed of the host. Steps which
+    didn't fit in the budget are carried to the next episodes, up to max_debt.
+
+    Parameters
+    ----------
+    ratio: float
+        target number of gradient steps per environment step
+    budget: float
+        seconds of learning per episode
+    chunk: int
+        minibatches per call of learn
+    max_debt: int
+        maximal number of postponed gradient steps
+    """
+    def __init__(self, ratio=1.0, budget=20.0, chunk=40, max_debt=2000):
+        self.ratio = ratio
+        self.budget = budget
+        self.chunk = chunk
+        self.max_debt = max_debt
+        self.env_steps = 0
+        self.gradient_steps = 0
+        self.step_cost = None
+
+    @property
+    def debt(self):
+        return self.ratio * self.env_steps - self.gradient_steps
+
+    def state_dict(self):
+        return dict(env_steps=self.env_steps, gradient_steps=self.gradient_steps,
+                    step_cost=self.step_cost)
+
+    def load_state_dict(self, state):
+        self.env_steps = state['env_steps']
+        self.gradient_steps = state['gradient_steps']
+        self.step_cost = state['step_cost']
+
+    def record_env_steps(self, n):
+        self.env_steps += n
+        if self.debt > self.max_debt:
+            # forget steps which can't be caught up with
+            self.gradient_steps = self.ratio * self.env_steps - self.max_debt
+
+    def run(self, learn):
+        """
+        Call learn(n_steps) in chunks until the ratio or the budget is reached,
+        or until learn returns nan, returns list of losses
+        """
+        losses = []
+        done = 0
+        start = time.time()
+        while self.debt >= 1:
+            elapsed = time.time() - start
+            remaining = self.budget - elapsed
+            n_steps = min(self.chunk, int(self.debt))
+            if self.step_cost is not None:
+                n_steps = min(n_steps, int(remaining / self.step_cost))
+            if n_steps < 1 or remaining <= 0:
+                break
+            chunk_start = time.time()
+            loss = learn(n_steps)
+            if loss is None or not math.isfinite(loss):
+                # nothing was learned, e.g. replay memory is smaller than a batch
+                break
+            losses.append(loss)
+            cost = (time.time() - chunk_start) / n_steps
+            self.step_cost = cost if self.step_cost is None else 0.8 * self.step_cost + 0.2 * cost
+            self.gradient_steps += n_steps
+            done += n_steps
+        logging.debug('learned %i steps in %.1f s, %.1f ms per step, debt %.0f',
+                      done, time.time() - start,
+                      (self.step_cost or 0) * 1000, self.debt)
+        return losses
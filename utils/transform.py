@@ -1,7 +1,9 @@
 import numpy
 import torch
 import random
+import time
 import abc
+import cv2
 
 
 class ToTensor:
@@ -18,22 +20,30 @@ def apply_transformers(x, transformers=[]):
     return x
 
 
-def random_transformer(x, transformers=[]):
+def random_transformer(x, transformers=[], profiler=None):
     orig_shape = x.shape
     assert (len(orig_shape) == 3)
     assert (orig_shape[2] <= orig_shape[0])
     assert (orig_shape[2] <= orig_shape[1])
 
     x = x.transpose(2, 0, 1)
-    for transform in transformers:
+    for i, transform in enumerate(transformers):
         assert 'resize' not in str(transform.__class__).lower()
         if random.randint(0, 1):
             x_std = x.std()
             if x_std < 0.01:
+                if profiler is not None:
+                    profiler.record(i, skipped=True)
                 continue
+            start = time.perf_counter()
             new_x = transform(x)
-            if new_x.std() < 0.1 * x_std:
-                print("{0} decreased std to {1} from {2}".format(transform, new_x.std(), x_std))
+            new_std = new_x.std()
+            rejected = new_std < 0.1 * x_std
+            if profiler is not None:
+                profiler.record(i, time.perf_counter() - start,
+                                rejected=rejected, std=new_std)
+            if rejected:
+                print("{0} decreased std to {1} from {2}".format(transform, new_std, x_std))
                 continue
             x = new_x
     x = x.astype(numpy.float32)
@@ -42,11 +52,16 @@ def random_transformer(x, transformers=[]):
 
 
 class RandomTransformer:
-    def __init__(self, transformers):
+    def __init__(self, transformers, profiler=None):
+        """
+        profiler: utils.profiler.TransformProfiler
+            optional, records calls of transformers
+        """
         self.transformers = transformers
+        self.profiler = profiler
 
     def __call__(self, x):
-        return random_transformer(x, self.transformers)
+        return random_transformer(x, self.transformers, profiler=self.profiler)
 
 
 class TransformCompose:
@@ -83,6 +98,159 @@ class FCompose(TransformCompose):
         return data, target
 
 
+def map_target(function, target):
+    """
+    apply function to target, which is None, an array or a tuple of arrays (label, depth, ..)
+    """
+    if target is None:
+        return None
+    if isinstance(target, (tuple, list)):
+        return type(target)(map_target(function, t) for t in target)
+    return function(target)
+
+
+class ImageOnly(TransformCompose):
+    """
+    Photometric transform: applied to data, target is passed through
+    """
+    def __init__(self, transform):
+        self.transform = transform
+
+    def __call__(self, data=None, target=None):
+        return self.transform(data), target
+
+
+class JointTransform(TransformCompose):
+    """
+    Geometric transform with parameters shared by data and targets
+
+    Parameters are sampled once per call from data shape, then the same
+    operation is applied to the image and every target array. Targets
+    (labels, depth) are sampled with nearest neighbour, so class ids are
+    never mixed. Arrays are expected in (height, width) or (height, width, channels) layout.
+    """
+
+    def __call__(self, data=None, target=None):
+        params = self.sample_params(data.shape[:2])
+        data = self.apply(data, params, is_target=False)
+        target = map_target(lambda t: self.apply(t, params, is_target=True), target)
+        return data, target
+
+    @abc.abstractmethod
+    def sample_params(self, shape):
+        pass
+
+    @abc.abstractmethod
+    def apply(self, x, params, is_target=False):
+        pass
+
+
+class JointRandomCrop(JointTransform):
+    def __init__(self, size, beta=0):
+        self.size = size
+        self.beta = beta
+
+    def sample_params(self, shape):
+        size = self.size
+        if self.beta:
+            size = self.size + int(numpy.random.random() * self.beta * 2) - self.beta
+        h, w = shape
+        diff_h = h - size
+        diff_w = w - size
+        top = 0 if (diff_h <= 0) else numpy.random.randint(0, diff_h)
+        left = 0 if (diff_w <= 0) else numpy.random.randint(0, diff_w)
+        return top, left, size
+
+    def apply(self, x, params, is_target=False):
+        top, left, size = params
+        return x[top: top + size, left: left + size]
+
+
+class JointRareClassCrop(JointRandomCrop):
+    """
+    Crop biased towards rare classes, see utils.noise.RareClassCropTransform
+
+    class_map: callable which returns class map (height, width) from target,
+        by default target is expected to be class ids, or first element of target tuple
+    """
+    def __init__(self, size, class_weights, uniform_ratio=0.3, beta=0, class_map=None):
+        from utils.noise import RareClassCropTransform
+        super().__init__(size, beta=beta)
+        self.crop = RareClassCropTransform(size, class_weights,
+                                           uniform_ratio=uniform_ratio, beta=beta)
+        self.class_map = class_map
+
+    def __call__(self, data=None, target=None):
+        label = target[0] if isinstance(target, (tuple, list)) else target
+        classes = label if self.class_map is None else self.class_map(label)
+        params = self.crop.sample_pos(classes, *data.shape[:2])
+        data = self.apply(data, params)
+        target = map_target(lambda t: self.apply(t, params, is_target=True), target)
+        return data, target
+
+
+class JointResize(JointTransform):
+    """
+    Resize to size (width, height) or by scale factor,
+    targets are resized with nearest neighbour
+    """
+    def __init__(self, size=None, scale=None, interpolation=cv2.INTER_AREA):
+        assert (size is None) != (scale is None)
+        self.size = size
+        self.scale = scale
+        self.interpolation = interpolation
+
+    def sample_params(self, shape):
+        if self.size is not None:
+            return tuple(self.size)
+        h, w = shape
+        return round(w * self.scale), round(h * self.scale)
+
+    def apply(self, x, params, is_target=False):
+        interpolation = cv2.INTER_NEAREST if is_target else self.interpolation
+        res = cv2.resize(x, params, interpolation=interpolation)
+        # opencv drops single channel dimension
+        return res.reshape(res.shape[:2] + x.shape[2:])
+
+
+class JointFlip(JointTransform):
+    def __init__(self, p=0.5, horizontal=True):
+        self.p = p
+        self.horizontal = horizontal
+
+    def sample_params(self, shape):
+        return random.random() < self.p
+
+    def apply(self, x, params, is_target=False):
+        if not params:
+            return x
+        if self.horizontal:
+            return x[:, ::-1]
+        return x[::-1]
+
+
+class JointHomography(JointTransform):
+    """
+    Random homography from utils.noise.HomographySample applied to data and targets
+    """
+    def __init__(self, homography_sample):
+        self.homography_sample = homography_sample
+
+    def sample_params(self, shape):
+        h, w = shape
+        if self.homography_sample.H is not None:
+            return self.homography_sample.H
+        H, _ = self.homography_sample.sample_homography(h, w)
+        return H
+
+    def apply(self, x, params, is_target=False):
+        from utils.noise import bilinear_sampling, nearest_sampling
+        h, w = x.shape[:2]
+        if is_target:
+            return nearest_sampling(x, params, w, h)
+        return bilinear_sampling(x, params, w, h)
+
+
 def label_transphormer(x, label_transformers=[], to_torch=None):
     for function, config in label_transformers:
         x = function(x, **config)
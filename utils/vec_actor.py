@@ -0,0 +1,114 @@
+"""
+Acting in several environments with batched policy inference
+
+Environments spend most of a step waiting for the game: sending commands,
+sleeping while the action runs and polling for observations. VecActor runs
+these waits of all environments concurrently in threads and evaluates the
+policy once per tick on the batch of their states.
+"""
+import logging
+import random
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+
+from utils import inference
+from utils.replay import collate
+
+
+# keys of states used by policy networks, other keys are not batched
+STATE_KEYS = ('images', 'image', 'state', 'frame_ids', 'frame_id')
+
+
+class VecActor:
+    """
+    Step N environments with one forward of the policy per tick
+
+    Environment protocol:
+        reset() -> data
+            start a new episode, return the first state
+        step(data, action, commands) -> (next_data, reward, done)
+            store the chosen action in the state history, send commands,
+            return the next state, None if episode ended
+
+    Transitions are pushed to agent.memory.
+
+    Parameters
+    ----------
+    agent: network.DQN
+    envs: list
+        environments, e.g. trainable.dig_v1.DigEnv, one per MCConnector
+    epsilon: float
+        probability of random action
+    state_keys: tuple
+        keys of states which are batched and stored in replay memory
+    """
+    def __init__(self, agent, envs, epsilon=0.1, state_keys=STATE_KEYS):
+        self.agent = agent
+        self.envs = envs
+        self.epsilon = epsilon
+        self.state_keys = state_keys
+        self.pool = ThreadPoolExecutor(max_workers=len(envs))
+        net = agent.policy_net
+        if isinstance(net, inference.InferenceMixin):
+            # frames of all environments stay in the acting cache
+            net.frame_cache_size = max(net.frame_cache_size, 4 * len(envs))
+        self.states = None
+        self.episode_rewards = [0.0] * len(envs)
+        self.finished = []
+
+    def _filter(self, data):
+        return {key: data[key] for key in self.state_keys if key in data}
+
+    def select_actions(self, states):
+        """
+        greedy actions of the policy for the batch of states, epsilon-random per environment
+        """
+        net = self.agent.policy_net
+        with inference.acting(net):
+            q = net(collate([self._filter(s) for s in states]))
+        actions = q.argmax(dim=-1).tolist()
+        n_actions = q.shape[-1]
+        return [random.randrange(n_actions) if random.random() < self.epsilon else a
+                for a in actions]
+
+    def tick(self):
+        """
+        one step in every environment, returns number of finished episodes
+        """
+        if self.states is None:
+            self.states = list(self.pool.map(lambda env: env.reset(), self.envs))
+        actions = self.select_actions(self.states)
+        to_string = self.agent.policy_net.actions[0].to_string
+        futures = [self.pool.submit(env.step, data, torch.as_tensor(action), [to_string(action)])
+                   for env, data, action in zip(self.envs, self.states, actions)]
+        finished = 0
+        for i, future in enumerate(futures):
+            next_data, reward, done = future.result()
+            state = self._filter(self.states[i])
+            action = torch.as_tensor(actions[i])
+            self.episode_rewards[i] += reward
+            if done:
+                self.agent.memory.push(state, action, None, torch.as_tensor(reward))
+                logging.info('env %i: episode reward %f', i, self.episode_rewards[i])
+                self.finished.append(self.episode_rewards[i])
+                self.episode_rewards[i] = 0.0
+                finished += 1
+                self.states[i] = None
+            else:
+                self.agent.memory.push(state, action, self._filter(next_data),
+                                       torch.as_tensor(reward))
+                self.states[i] = next_data
+        restart = [i for i, data in enumerate(self.states) if data is None]
+        for i, data in zip(restart, self.pool.map(lambda i: self.envs[i].reset(), restart)):
+            self.states[i] = data
+        return finished
+
+    def run(self, n_ticks):
+        finished = 0
+        for _ in range(n_ticks):
+            finished += self.tick()
+        return finished
+
+    def close(self):
+        self.pool.shutdown()
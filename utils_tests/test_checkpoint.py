@@ -0,0 +1,80 @@
+import random
+import threading
+
+import numpy
+import pytest
+import torch
+from torch import nn
+
+from utils import replay
+from utils.checkpoint import CheckpointManager
+from utils.noise import NoiseBank
+from utils.schedule import UpdateScheduler
+from test_replay import push_episode
+
+
+def test_resume(tmp_path):
+    net = nn.Linear(3, 2)
+    optimizer = torch.optim.RMSprop(net.parameters(), lr=0.01)
+    net(torch.ones(1, 3)).sum().backward()
+    optimizer.step()
+    scheduler = UpdateScheduler()
+    scheduler.record_env_steps(120)
+    scheduler.gradient_steps = 80
+    bank = NoiseBank(shape=(1, 8, 8), refresh_interval=None)
+    bank.gaussian((8, 8))
+    weights_path = str(tmp_path / 'agent.pth')
+    manager = CheckpointManager(str(tmp_path / 'checkpoints'), keep=2, weights_path=weights_path)
+    for step in range(3):
+        manager.save(step, net.state_dict(), optimizer, eps=0.1 * step,
+                     scheduler=scheduler.state_dict(), noise=bank.get_state())
+    manager.wait()
+    assert len(manager.checkpoints()) == 2
+    expected = (random.random(), numpy.random.random(), torch.rand(1),
+                bank.gaussian((8, 8)).copy())
+
+    restored = nn.Linear(3, 2)
+    restored_optimizer = torch.optim.RMSprop(restored.parameters(), lr=0.01)
+    result = manager.load_latest(restored, restored_optimizer)
+    manager.close()
+    assert result['step'] == 2
+    assert result['extra']['eps'] == pytest.approx(0.2)
+    assert torch.equal(restored.weight, net.weight)
+    assert restored_optimizer.state_dict()['state'][0]['square_avg'].equal(
+        optimizer.state_dict()['state'][0]['square_avg'])
+    resumed_scheduler = UpdateScheduler()
+    resumed_scheduler.load_state_dict(result['extra']['scheduler'])
+    assert resumed_scheduler.debt == scheduler.debt
+    resumed_bank = NoiseBank(shape=(1, 8, 8), refresh_interval=None)
+    resumed_bank.set_state(result['extra']['noise'])
+    assert (random.random(), numpy.random.random()) == expected[:2]
+    assert torch.equal(torch.rand(1), expected[2])
+    assert numpy.array_equal(resumed_bank.gaussian((8, 8)), expected[3])
+    assert torch.load(weights_path)['weight'].equal(net.weight)
+
+
+def test_mismatched_keys(tmp_path):
+    manager = CheckpointManager(str(tmp_path))
+    manager.save(0, nn.Linear(3, 2).state_dict())
+    manager.wait()
+    with pytest.raises(RuntimeError):
+        manager.load_latest(nn.Sequential(nn.Linear(3, 2)))
+    manager.close()
+
+
+def test_memory_flushed_without_lock(tmp_path):
+    memory = replay.FrameReplayMemory(16, str(tmp_path / 'replay'))
+    push_episode(memory, 10, 6)
+    manager = CheckpointManager(str(tmp_path / 'checkpoints'))
+    # the write starts when the memory is locked, e.g. by the actor pushing
+    gate = threading.Event()
+    manager._pool.submit(gate.wait)
+    manager.save(0, nn.Linear(3, 2).state_dict(), memory=memory)
+    with memory._lock:
+        gate.set()
+        manager._pending[-1].result(timeout=10)
+    manager.save(1, nn.Linear(3, 2).state_dict(), memory=memory)
+    manager.save(2, nn.Linear(3, 2).state_dict(), memory=memory)
+    manager.close()
+    assert len(manager.checkpoints()) == 3
+    assert len(replay.FrameReplayMemory(16, str(tmp_path / 'replay'))) == 6
@@ -0,0 +1,41 @@
+import pytest
+import torch
+from torch import nn
+
+pytest.importorskip('mcdemoaux')
+
+from utils import dqn
+from utils import replay
+from test_replay import push_episode
+
+
+class Policy(nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.q = nn.Linear(6, 4)
+
+    def forward(self, data):
+        return self.q(data['state'] / 100 + data['images'].mean(dim=(1, 2, 3, 4)).unsqueeze(1))
+
+
+def test_prioritized_dqn():
+    memory = replay.PrioritizedReplayMemory(32)
+    push_episode(memory, 10, 20)
+    policy, target = Policy(), Policy()
+    agent = dqn.PrioritizedDQN(policy, target, 0.9, 8, 3, memory=memory)
+    optimizer = torch.optim.SGD(policy.parameters(), lr=0.1)
+    priorities = memory.tree.get(range(20)).copy()
+    for step in range(1, 7):
+        optimizer.zero_grad()
+        loss = agent.compute_loss()
+        # target is synced every 3 losses, before the optimizer step
+        assert torch.equal(policy.q.weight, target.q.weight) == (step % 3 == 0)
+        loss.backward()
+        optimizer.step()
+    assert (memory.tree.get(range(20)) != priorities).any()
+    agent.sync_in_loss = False
+    for _ in range(3):
+        optimizer.zero_grad()
+        agent.compute_loss().backward()
+        optimizer.step()
+    assert not torch.equal(policy.q.weight, target.q.weight)
@@ -0,0 +1,35 @@
+import pytest
+import torch
+
+from utils import embed
+
+
+def test_matches_common_embeddings():
+    pytest.importorskip('tagilmo')
+    from utils import common
+    state = torch.rand(5, 10) * 10
+    result = embed.StateEmbed(angles=(0, 3), dists=(3, 6), rest=(6, None))(state)
+    expected = torch.cat([common.angle_embed(state[:, :3]),
+                          common.dist_embed(state[:, 3:6]),
+                          state[:, 6:]], dim=1)
+    assert torch.allclose(result, expected, atol=1e-5)
+
+
+def test_parts_and_shapes():
+    state = torch.rand(4, 7)
+    assert embed.AngleEmbed()(state[:, :3]).shape == (4, 24)
+    assert embed.DistEmbed()(state[:, :3]).shape == (4, 12)
+    module = embed.StateEmbed(angles=(0, 2), rest=(5, None))
+    assert module(state).shape == (4, 16 + 2)
+    assert torch.equal(module(state)[:, 16:], state[:, 5:])
+
+
+def test_state_dict_and_script():
+    module = embed.StateEmbed(angles=(0, 3), dists=(3, 6), rest=(6, None))
+    # buffers are not persistent, checkpoints of networks don't change
+    assert module.state_dict() == {}
+    state = torch.rand(2, 8)
+    copy = state.clone()
+    scripted = torch.jit.script(module)
+    assert torch.allclose(scripted(state), module(state))
+    assert torch.equal(state, copy)
@@ -0,0 +1,44 @@
+import warnings
+
+import cv2
+import numpy
+import torch
+
+from utils.frames import FramePreprocessor, FrameSpec, center_window
+
+
+def test_read_only_frame_without_resize():
+    data = bytearray(numpy.random.randint(0, 256, 24 * 32 * 3, dtype=numpy.uint8).tobytes())
+    src = numpy.frombuffer(bytes(data), dtype=numpy.uint8)
+    preprocess = FramePreprocessor(32, 24, ring=2)
+    with warnings.catch_warnings():
+        warnings.simplefilter('error')
+        out = preprocess(src)
+    expected = torch.from_numpy(src.reshape(24, 32, 3).copy()).permute(2, 0, 1) / 255.
+    assert torch.allclose(out, expected)
+
+
+def test_downscale_and_ring():
+    spec = FrameSpec(32, 24, supersample=4)
+    assert spec.source == (96, 128)
+    preprocess = spec.preprocessor(ring=2)
+    src = numpy.random.randint(0, 256, (96, 128, 3), dtype=numpy.uint8)
+    out = preprocess(src)
+    expected = cv2.resize(src, (32, 24), interpolation=cv2.INTER_LINEAR)
+    assert torch.allclose(out, torch.from_numpy(expected).permute(2, 0, 1) / 255.)
+    second = preprocess(src)
+    assert second.data_ptr() != out.data_ptr()
+    assert preprocess(src).data_ptr() == out.data_ptr()
+
+
+def test_center_window():
+    img = numpy.random.randint(0, 256, (24, 32, 3), dtype=numpy.uint8)
+    big = cv2.resize(img, (128, 96), interpolation=cv2.INTER_NEAREST)
+    assert numpy.array_equal(center_window(img, 5, 4), big[48 - 5:48 + 5, 64 - 5:64 + 5])
+
+
+def test_area_interpolation():
+    src = numpy.random.randint(0, 256, (96, 128, 3), dtype=numpy.uint8)
+    preprocess = FrameSpec(32, 24, supersample=4).preprocessor(interpolation=cv2.INTER_AREA)
+    expected = cv2.resize(src, (32, 24), interpolation=cv2.INTER_AREA)
+    assert torch.allclose(preprocess(src), torch.from_numpy(expected).permute(2, 0, 1) / 255.)
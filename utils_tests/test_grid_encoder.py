@@ -0,0 +1,30 @@
+import numpy
+import pytest
+
+pytest.importorskip('tagilmo')
+
+from utils import common
+
+
+def test_walking_encoder_matches_loops():
+    vocabulary = common.block_id_cliff_walking
+    n_ids = common.max_id_blocks_walking + 1
+    grid = list(vocabulary)[:27]
+    expected = numpy.zeros((27, n_ids))
+    for i, name in enumerate(grid):
+        expected[i][vocabulary[name]] = 1
+    assert numpy.array_equal(common.grid_to_vec_walking(grid), expected)
+    step = 2 / n_ids
+    real = [-1. + vocabulary[name] * step + 0.5 * step for name in grid]
+    assert numpy.allclose(common.grid_to_real_feature_vec_walking(grid), real)
+    batch = common.walking_encoder.one_hot([grid, grid[::-1]])
+    assert batch.shape == (2, 27, n_ids)
+    assert numpy.array_equal(batch[1], expected[::-1])
+
+
+def test_unknown_blocks():
+    encoder = common.GridEncoder(dict(air=0, stone=1))
+    assert list(encoder.ids(['stone', 'lava', 'air'])) == [1, 2, 0]
+    assert encoder.one_hot(numpy.array(['lava', 'air'])).shape == (2, 3)
+    solid = common.GridEncoder(dict(air=0, stone=1), unknown=1)
+    assert list(solid.ids(['lava', 'air'])) == [1, 0]
@@ -0,0 +1,46 @@
+import numpy
+import torch
+
+from utils import noise
+
+
+def test_calculate_h_maps_points():
+    pts_init = numpy.array([[0, 0], [32, 0], [0, 24], [32, 24]], dtype=numpy.float64)
+    pts_pert = pts_init + numpy.array([[2, 1], [-3, 2], [1, -2], [-2, -1]])
+    H, H_inv = noise.calculate_h(pts_init, pts_pert)
+    points = numpy.concatenate([pts_init, numpy.ones((4, 1))], axis=1) @ H.T
+    assert numpy.allclose(points[:, :2] / points[:, 2:], pts_pert)
+    assert numpy.allclose(H @ H_inv, numpy.eye(3))
+
+
+def test_warp_batch_matches_warp_image():
+    numpy.random.seed(0)
+    images = numpy.random.random((2, 3, 24, 32)).astype(numpy.float32)
+    sampler = noise.HomographySample(beta=3, theta=0.1)
+    H, _ = sampler.sample_homographies(2, 24, 32)
+    warped = noise.warp_batch(torch.from_numpy(images), H).numpy()
+    for image, h, result in zip(images, H, warped):
+        expected = noise.bilinear_sampling(image.transpose(1, 2, 0), h, 32, 24)
+        # borders differ by handling of points just outside the image
+        assert numpy.allclose(result.transpose(1, 2, 0)[3:-3, 3:-3], expected[3:-3, 3:-3], atol=1e-4)
+
+
+def test_identity_warp():
+    images = torch.rand(2, 3, 8, 10)
+    assert torch.allclose(noise.warp_batch(images, numpy.tile(numpy.eye(3), (2, 1, 1))),
+                          images, atol=1e-5)
+
+
+def test_labels_are_not_interpolated():
+    numpy.random.seed(0)
+    image = numpy.random.random((24, 32, 3)).astype(numpy.float32)
+    label = numpy.random.choice([0, 3, 7], size=(24, 32)).astype(numpy.uint8)
+    sampler = noise.HomographySample(beta=4, theta=0.2)
+    sample = sampler(image, label=label)
+    assert sample['template_img'].shape == image.shape
+    assert sample['mask'].shape == image.shape
+    assert set(numpy.unique(sample['template_label'])) <= {0, 3, 7}
+    batch = sampler.batch(torch.from_numpy(image.transpose(2, 0, 1)).expand(4, -1, -1, -1),
+                          labels=torch.from_numpy(label).expand(4, 1, -1, -1))
+    assert batch['p'].shape == (4, 3, 3) and batch['template_img'].shape == (4, 3, 24, 32)
+    assert set(batch['template_label'].unique().tolist()) <= {0, 3, 7}
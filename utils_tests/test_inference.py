@@ -0,0 +1,137 @@
+import torch
+from torch import nn
+
+from utils import inference
+
+
+class Net(inference.InferenceMixin, nn.Module):
+    def __init__(self, n_frames=3, n_state=2, n_actions=4):
+        super().__init__()
+        self.vgg = nn.Sequential(nn.Conv2d(3, 4, 3), nn.ReLU())
+        self.pooling = nn.Sequential(nn.AdaptiveAvgPool2d(2), nn.Flatten())
+        self.q_value = nn.Linear(n_frames * 16 + n_state, n_actions)
+        self.init_inference()
+        self.encoded = []
+        self.vgg.register_forward_hook(lambda m, inp, out: self.encoded.append(len(inp[0])))
+
+    def q_forward(self, data):
+        x = data['images']
+        if len(x.shape) == 4:
+            x = x.unsqueeze(0)
+        visual = self.encode_stacked(x, data.get('frame_ids'))
+        state = data['state']
+        if len(state.shape) == 1:
+            state = state.unsqueeze(0)
+        result = self.q_value(torch.cat([visual.flatten(1), state], dim=1))
+        self.nan_check(result)
+        return result
+
+
+def make_data(n_frames=3, batch=None):
+    shape = (n_frames, 3, 8, 8) if batch is None else (batch, n_frames, 3, 8, 8)
+    return dict(images=torch.rand(shape), state=torch.rand(shape[:-4] + (2,)))
+
+
+def test_nan_check():
+    check = inference.NanCheck(every=3)
+    check(torch.zeros(2))
+    check(torch.tensor([0., float('nan')]))
+    assert check.detected == 0
+    check(torch.zeros(2))
+    assert check.detected == 1
+    for _ in range(3):
+        check(torch.zeros(2))
+    assert check.detected == 1
+
+
+def test_acting_cache_encodes_new_frames():
+    torch.manual_seed(0)
+    net = Net()
+    frames = torch.rand(4, 3, 8, 8)
+    state = torch.rand(2)
+    with inference.acting(net):
+        net(dict(images=frames[:3], state=state, frame_ids=torch.tensor([0, 1, 2])))
+        net.encoded.clear()
+        result = net(dict(images=frames[1:], state=state, frame_ids=torch.tensor([1, 2, 3])))
+    assert net.encoded == [1]
+    expected = net(dict(images=frames[1:], state=state))
+    assert torch.allclose(result, expected, atol=1e-6)
+
+
+def test_cache_dropped_on_weight_change():
+    torch.manual_seed(0)
+    net = Net()
+    data = make_data()
+    data['frame_ids'] = torch.tensor([0, 1, 2])
+    with inference.acting(net):
+        before = net(data)
+        with torch.no_grad():
+            net.vgg[0].weight.add_(1)
+        after = net(data)
+    assert not torch.allclose(before, after)
+    assert torch.allclose(after, net(data), atol=1e-6)
+
+
+def test_target_cache():
+    torch.manual_seed(0)
+    net = Net().enable_target_cache(16)
+    data = make_data(batch=2)
+    data['frame_ids'] = torch.tensor([[0, 1, 2], [1, 2, 3]])
+    first = net(data)
+    net.encoded.clear()
+    second = net(data)
+    assert net.encoded == [] and torch.equal(first, second)
+    assert len(net._frame_cache) == 4
+
+
+def test_encode_unique():
+    torch.manual_seed(0)
+    net = Net()
+    frames = torch.rand(3, 3, 8, 8)
+    ids = torch.tensor([0, 1, 0, 2, 1])
+    batch = frames[[0, 1, 0, 2, 1]]
+    unique = net.encode_unique(batch, ids)
+    assert net.encoded == [3]
+    full = net.encode_frames(batch)
+    assert torch.allclose(unique, full, atol=1e-6)
+    # gradient of every copy flows to the encoded frame
+    unique.sum().backward()
+    grad = net.vgg[0].weight.grad.clone()
+    net.zero_grad()
+    full.sum().backward()
+    assert torch.allclose(grad, net.vgg[0].weight.grad, atol=1e-5)
+
+
+def test_channels_last_keeps_training_weights():
+    torch.manual_seed(0)
+    net = Net()
+    data = make_data()
+    expected = net(data)
+    net.configure_inference(channels_last=True)
+    weight = net.vgg[0].weight
+    assert weight.is_contiguous() and not weight.is_contiguous(memory_format=torch.channels_last)
+    assert len(list(net.parameters())) == 4
+    with inference.acting(net):
+        assert torch.allclose(net(data), expected, atol=1e-5)
+    with torch.no_grad():
+        weight.mul_(2)
+    expected = net(data)
+    # acting copy follows updates of the trained weights
+    with inference.acting(net):
+        assert torch.allclose(net(data), expected, atol=1e-5)
+
+
+def test_benchmark_checks_random_images():
+    class Flipped(Net):
+        # bf16 flips actions, but not on all-zeros input of zero-bias network
+        def q_forward(self, data):
+            result = super().q_forward(data)
+            return -result if self.acting and self.bf16 else result
+
+    torch.manual_seed(0)
+    net = Flipped()
+    for module in (net.vgg[0], net.q_value):
+        nn.init.zeros_(module.bias)
+    data = dict(images=torch.zeros(3, 3, 8, 8), state=torch.zeros(2))
+    config = inference.benchmark(net, data, repeats=1)
+    assert not config['bf16']
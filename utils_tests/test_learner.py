@@ -0,0 +1,55 @@
+import time
+
+import pytest
+import torch
+from torch import nn
+
+pytest.importorskip('tagilmo')
+pytest.importorskip('mcdemoaux')
+
+from utils import dqn
+from utils import replay
+from utils.learner import BackgroundLearner
+from test_replay import push_episode
+
+
+class Policy(nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.conv1a = nn.Conv2d(3, 2, 3)
+        self.q_value = nn.ModuleList([nn.Linear(8, 4)])
+
+    def forward(self, data):
+        x = self.conv1a(data['images'][:, 0]).mean(dim=(2, 3))
+        x = torch.cat([x, data['state']], dim=1)
+        return self.q_value[0](x)
+
+
+def test_learner_owns_target_update():
+    memory = replay.PrioritizedReplayMemory(32)
+    push_episode(memory, 10, 20)
+    policy, target = Policy(), Policy()
+    agent = dqn.PrioritizedDQN(policy, target, 0.9, 8, 5, memory=memory)
+    optimizer = torch.optim.SGD(policy.parameters(), lr=0.01)
+    learner = BackgroundLearner(agent, optimizer, steps_per_publish=4, min_memory=10, target_update=8)
+    assert not agent.sync_in_loss and not learner.learner_agent.sync_in_loss
+    learner.start()
+    deadline = time.time() + 20
+    while learner.target_syncs < 2 and time.time() < deadline:
+        time.sleep(0.01)
+    with learner.paused():
+        steps = learner.gradient_steps
+        weight = policy.q_value[0].weight.detach().clone()
+        time.sleep(0.2)
+        assert learner.gradient_steps == steps
+        assert torch.equal(policy.q_value[0].weight, weight)
+    learner.stop()
+    assert learner.target_syncs >= 2
+    assert learner.target_syncs == learner.gradient_steps // 8
+    learner.target_syncs = 0
+    assert learner.sync_target()
+    # the target is a copy of the trained network, not of the acting one
+    acting = agent.policy_net
+    assert acting is not policy
+    assert torch.equal(target.q_value[0].weight, policy.q_value[0].weight)
+    assert not torch.equal(target.q_value[0].weight, acting.q_value[0].weight)
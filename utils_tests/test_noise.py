@@ -0,0 +1,86 @@
+import time
+
+import numpy
+import pytest
+
+from utils import noise
+
+
+def test_snp_with_bank():
+    image = numpy.full((24, 32, 3), 128, dtype=numpy.uint8)
+    bank = noise.NoiseBank(refresh_interval=None)
+    out = noise.snp(image, amount=0.1, bank=bank)
+    assert (image == 128).all()
+    assert out.shape == image.shape and out.dtype == image.dtype
+    salt = (out == 255).mean()
+    pepper = (out == 0).mean()
+    # ceil(0.05 * image.size) pixels each, some may be overwritten by pepper
+    limit = numpy.ceil(0.05 * image.size) / image.size
+    assert 0.04 < salt <= limit and 0.04 < pepper <= limit
+    assert not numpy.array_equal(out, noise.snp(image, amount=0.1, bank=bank))
+
+
+def test_gaussian_fits():
+    bank = noise.NoiseBank(shape=(3, 24, 32), refresh_interval=None)
+    field = bank.gaussian((3, 20, 30))
+    assert field.shape == (3, 20, 30) and field.dtype == numpy.float32
+    assert abs(field.mean()) < 0.2 and abs(field.std() - 1) < 0.2
+    assert bank.gaussian((3, 40, 30)) is None
+
+
+def test_state_restores_streams():
+    bank = noise.NoiseBank(shape=(1, 16, 16), refresh_interval=None)
+    bank.gaussian((16, 16))
+    bank.salt_pepper(100)
+    state = bank.get_state()
+    expected = bank.gaussian((16, 16)).copy(), bank.salt_pepper(100)
+    resumed = noise.NoiseBank(refresh_interval=None)
+    resumed.set_state(state)
+    assert numpy.array_equal(resumed.gaussian((16, 16)), expected[0])
+    salt, pepper = resumed.salt_pepper(100)
+    assert numpy.array_equal(salt, expected[1][0]) and numpy.array_equal(pepper, expected[1][1])
+
+
+def test_salt_pepper_patterns_vary():
+    bank = noise.NoiseBank(n_fields=1, refresh_interval=None)
+    salt = [bank.salt_pepper(1000)[0] for _ in range(2)]
+    # one stored set, distinct patterns up to a shift
+    assert len(salt[0]) == len(salt[1])
+    assert not numpy.array_equal(numpy.diff(numpy.sort(salt[0])),
+                                 numpy.diff(numpy.sort(salt[1])))
+    assert (0 <= salt[0]).all() and (salt[0] < 1000).all()
+
+
+def test_refresh_replaces_index_sets():
+    bank = noise.NoiseBank(shape=(1, 8, 8), n_fields=1, refresh_interval=0.01)
+    bank.gaussian((8, 8))
+    bank.salt_pepper(100)
+    stored = bank._indices[(100, 2, 2)][0]
+    deadline = time.time() + 5
+    while bank._indices[(100, 2, 2)][0] is stored and time.time() < deadline:
+        time.sleep(0.01)
+    bank.close()
+    assert bank._indices[(100, 2, 2)][0] is not stored
+
+
+def test_gaussian_scale():
+    bank = noise.NoiseBank(shape=(1, 32, 32), refresh_interval=None, max_scale=4)
+    fields = [bank.gaussian((32, 32)) for _ in range(20)]
+    assert all(field.shape == (32, 32) and field.dtype == numpy.float32 for field in fields)
+    # enlarged fields repeat neighbouring pixels
+    repeats = [(numpy.diff(field, axis=1) == 0).mean() for field in fields]
+    assert max(repeats) > 0.3
+
+
+def test_rasterize_points():
+    points = [numpy.array([[0, 1], [2.4, 3]]), numpy.array([[3, 0]])]
+    result = noise.rasterize_batch(points, 4, 4, labels_list=[[1, 0], [2]], n_classes=3)
+    assert result.shape == (2, 3, 4, 4) and result.sum() == 3
+    assert result[0, 1, 0, 1] and result[0, 0, 2, 3] and result[1, 2, 3, 0]
+
+
+def test_rasterize_points_outside():
+    with pytest.raises(IndexError):
+        noise.rasterize_points(numpy.array([[0, 0], [4, 1]]), 4, 4)
+    with pytest.raises(IndexError):
+        noise.rasterize_points(numpy.array([[0, -1]]), 4, 4)
@@ -0,0 +1,80 @@
+import numpy
+import pytest
+import torch
+
+from utils.frames import FramePreprocessor
+from utils.observe import ObservationHub, FRAME, POSE, hub_for
+
+
+class FakeConnector:
+    """
+    observations become available after `delay` calls of observeProc
+    """
+    def __init__(self, delay=0):
+        self.delay = delay
+        self.image = numpy.zeros(12, dtype=numpy.uint8)
+        self.pos = [0., 1., 2., 0., 0.]
+        self.observed = 0
+
+    def observeProc(self):
+        self.observed += 1
+
+    def getImage(self):
+        return self.image if self.observed > self.delay else None
+
+    def getAgentPos(self):
+        return self.pos if self.observed > self.delay else None
+
+
+def test_wait_returns_available_observations():
+    mc = FakeConnector()
+    hub = ObservationHub(mc, interval=0.001)
+    # the same frame again, a static scene doesn't block
+    for _ in range(3):
+        image, pos = hub.wait((FRAME, POSE))
+        assert image is mc.image and pos is mc.pos
+    assert mc.observed == 3
+    assert hub.stats()['polls'] == 1
+
+
+def test_wait_polls_until_available():
+    mc = FakeConnector(delay=3)
+    hub = ObservationHub(mc, interval=0.001)
+    checks = []
+    image, pos = hub.wait((FRAME, POSE), check=lambda: checks.append(mc.observed))
+    assert image is mc.image
+    assert checks == [1, 2, 3]
+    stats = hub.stats()
+    assert stats['waits'] == 1 and stats['polls'] == 4
+
+
+def test_hub_per_connector():
+    mc = FakeConnector()
+    assert hub_for(mc) is hub_for(mc)
+    assert hub_for(FakeConnector()) is not hub_for(mc)
+
+
+def test_preprocess_bytes():
+    pixels = numpy.random.randint(0, 256, 4 * 6 * 3, dtype=numpy.uint8)
+    preprocess = FramePreprocessor(6, 4, ring=0)
+    out = preprocess(pixels.tobytes())
+    assert torch.allclose(out, preprocess(pixels))
+
+
+def test_wait_observations():
+    pytest.importorskip('tagilmo')
+    from utils import common
+
+    class Trainer(common.Trainer):
+        def __init__(self, mc):
+            self.mc = mc
+
+    def dead():
+        raise ValueError()
+
+    mc = FakeConnector(delay=1)
+    trainer = Trainer(mc)
+    with pytest.raises(ValueError):
+        trainer.wait_observations(check=dead)
+    pos, image = trainer.wait_observations()
+    assert pos is mc.pos and image is mc.image
@@ -0,0 +1,80 @@
+import numpy
+import pytest
+
+from utils import pipeline
+
+
+PHOTOMETRIC = [dict(name='random_contrast', p=1),
+               dict(name='motion_blur', max_kernel_size=7, p=1),
+               dict(name='random_brightness', p=1),
+               dict(name='additive_shade', kernel_size_range=[5, 9], p=1)]
+
+
+def image(*shape):
+    return numpy.random.randint(0, 256, shape).astype(numpy.uint8)
+
+
+@pytest.mark.parametrize('shape', [(96, 128, 3), (96, 128, 1), (96, 128)])
+def test_resize_keeps_layout(shape):
+    compiled = pipeline.compile_pipeline(PHOTOMETRIC + [dict(name='resize', size=[64, 48])])
+    out = compiled(image(*shape))
+    assert out.shape == (48, 64) + shape[2:]
+    assert out.dtype == numpy.float32
+
+
+def test_chw_input():
+    compiled = pipeline.compile_pipeline(dict(ops=[dict(name='resize', size=[64, 48])] + PHOTOMETRIC,
+                                              input_layout=pipeline.CHW))
+    assert compiled.layout == pipeline.CHW
+    assert compiled(image(3, 96, 128)).shape == (3, 48, 64)
+    assert compiled(image(1, 96, 128)).shape == (1, 48, 64)
+    # resize needs HWC, the rest runs in CHW
+    assert compiled.transposes == 4
+
+
+def test_order_and_conversions():
+    compiled = pipeline.compile_pipeline(PHOTOMETRIC + [dict(name='resize', size=[32, 24])])
+    names = [op.name for op in compiled.ops]
+    # resize first, then ops in the pipeline layout, then the rest
+    assert compiled.layout == pipeline.CHW
+    assert names == ['resize', 'random_contrast', 'motion_blur', 'random_brightness', 'additive_shade']
+    for _ in range(3):
+        compiled(image(96, 128, 3))
+    # HWC -> CHW after resize and back at the end
+    assert compiled.transposes == 6
+    assert compiled.casts == 0
+    brightness = compiled.ops[3].transform
+    assert brightness.channel == 0
+
+
+def test_estimate_after_resize():
+    compiled = pipeline.compile_pipeline([dict(name='resize', size=[64, 48]),
+                                          dict(name='random_contrast', p=0.5)])
+    (_, _, resize_cost), (_, _, contrast_cost) = compiled.estimate((96, 128, 3))
+    info = pipeline.op_info
+    assert resize_cost == pytest.approx(info['resize'].cost * 96 * 128 * 3 / 1e6)
+    assert contrast_cost == pytest.approx(info['random_contrast'].cost * 48 * 64 * 3 / 1e6 * 0.5)
+    assert 'random_contrast' in compiled.report((96, 128, 3))
+
+
+def test_label_pipeline():
+    compiled = pipeline.compile_label_pipeline([dict(name='resize', size=[32, 24])])
+    keypoints = numpy.zeros((96, 128))
+    keypoints[10, 20] = 1
+    out = compiled(keypoints)
+    assert out.shape == (24, 32)
+    assert out.sum() == 1
+
+
+def test_load_pipeline(tmp_path):
+    pytest.importorskip('yaml')
+    path = tmp_path / 'pipeline.yaml'
+    path.write_text('ops:\n'
+                    '  - name: resize\n'
+                    '    size: [64, 48]\n'
+                    '  - name: additive_gaussian\n'
+                    '    var: 30\n')
+    compiled = pipeline.load_pipeline(str(path))
+    assert [op.name for op in compiled.ops] == ['resize', 'additive_gaussian']
+    assert compiled.ops[1].p == 0.5
+    assert compiled(image(96, 128, 3)).shape == (48, 64, 3)
@@ -0,0 +1,109 @@
+import numpy
+import pytest
+import torch
+
+from utils import replay
+from test_replay import make_state, push_episode
+
+
+def test_sum_tree():
+    tree = replay.SumTree(5)
+    priorities = numpy.array([1.0, 0.0, 3.0, 2.0, 4.0])
+    tree.update(numpy.arange(5), priorities)
+    assert tree.total == pytest.approx(10)
+    assert list(tree.find([0.5, 1.5, 3.9, 4.5, 9.9])) == [0, 2, 2, 3, 4]
+    tree.update([2], 0.0)
+    assert tree.total == pytest.approx(7)
+    values = numpy.random.random(20000) * tree.total
+    counts = numpy.bincount(tree.find(values), minlength=5)
+    assert counts[1] == counts[2] == 0
+    assert counts / counts.sum() == pytest.approx([1 / 7, 0, 0, 2 / 7, 4 / 7], abs=0.02)
+
+
+def test_priorities_and_weights():
+    memory = replay.PrioritizedReplayMemory(16, beta=0.5)
+    push_episode(memory, 10, 16)
+    transitions, indices, weights = memory.sample_batch(8)
+    assert len(transitions) == len(indices) == len(weights) == 8
+    # equal priorities, equal weights
+    assert torch.allclose(weights, torch.ones(8))
+    memory.update_priorities(numpy.arange(16), numpy.where(numpy.arange(16) == 3, 100.0, 0.0))
+    _, indices, weights = memory.sample_batch(8)
+    top = torch.as_tensor(indices == 3)
+    assert top.sum() >= 6
+    if not top.all():
+        assert weights[top].max() < weights[~top].min()
+
+
+def test_all_sampled_frames_gone():
+    memory = replay.PrioritizedReplayMemory(8)
+    memory.push(make_state(1), torch.as_tensor(0), None, torch.as_tensor(0.0))
+    memory._slots.clear()
+    transitions, indices, weights = memory.sample_batch(4)
+    assert transitions == [] and len(indices) == 0 and weights is None
+
+
+def test_resume_priorities(tmp_path):
+    path = str(tmp_path / 'replay')
+    memory = replay.PrioritizedReplayMemory(16, path)
+    push_episode(memory, 10, 12)
+    memory.sample_batch(4)
+    memory.update_priorities(numpy.arange(12), numpy.arange(12, dtype=numpy.float64))
+    snapshot = memory.snapshot()
+    # pushed after the snapshot, not part of the saved state
+    push_episode(memory, 40, 2)
+    memory.update_priorities([0], [50.0])
+    memory.flush(snapshot)
+    resumed = replay.PrioritizedReplayMemory(16, path)
+    assert len(resumed) == 12
+    assert resumed.n_sampled == 1
+    assert resumed.max_priority == pytest.approx((11 + memory.eps) ** memory.alpha)
+    assert resumed.tree.get(numpy.arange(12)) == pytest.approx(
+        (numpy.arange(12) + memory.eps) ** memory.alpha)
+    assert resumed.tree.total == pytest.approx(resumed.tree.get(numpy.arange(12)).sum())
+
+
+def test_weights_without_dropped_transitions():
+    memory = replay.PrioritizedReplayMemory(16, beta=0.5)
+    push_episode(memory, 10, 16)
+    memory.update_priorities(numpy.arange(16), numpy.arange(16, dtype=numpy.float64))
+    # frames of the first transitions are gone
+    memory._slots.pop(10)
+    transitions, indices, weights = memory.sample_batch(16)
+    assert len(transitions) == len(indices) == len(weights)
+    assert all(int(t.state['frame_id']) > 12 for t in transitions)
+    probs = memory.tree.get(indices) / memory.tree.total
+    expected = (memory.size * probs) ** -0.5
+    assert weights.numpy() == pytest.approx(expected / expected.max(), rel=1e-5)
+
+
+def test_batch_built_outside_lock():
+    memory = replay.PrioritizedReplayMemory(16)
+    push_episode(memory, 10, 16)
+    locked = []
+    build = memory._transition
+
+    def transition(record, slots):
+        locked.append(memory._lock.locked())
+        return build(record, slots)
+
+    memory._transition = transition
+    transitions, _, _ = memory.sample_batch(8)
+    assert len(transitions) == 8 and not any(locked)
+
+
+def test_frames_overwritten_while_building():
+    memory = replay.PrioritizedReplayMemory(8)
+    push_episode(memory, 10, 8)
+    build = memory._transition
+
+    def transition(record, slots):
+        if len(memory) == 8 and memory.position == 0:
+            # the ring of frames wraps around while the batch is built
+            push_episode(memory, 100, 20)
+        return build(record, slots)
+
+    memory._transition = transition
+    transitions, indices, weights = memory.sample_batch(4)
+    # no sampled transition kept all of its frames
+    assert transitions == [] and len(indices) == 0 and weights is None
@@ -0,0 +1,54 @@
+import threading
+
+from torch.utils.data import DataLoader, Dataset
+
+from utils import profiler as profiler_module
+from utils.profiler import TransformProfiler
+
+
+def record_many(profiler, n):
+    for _ in range(n):
+        profiler.record(0, 1e-4)
+        profiler.record(1, skipped=True)
+
+
+class Profiled(Dataset):
+    def __init__(self, profiler):
+        self.profiler = profiler
+
+    def __len__(self):
+        return 8
+
+    def __getitem__(self, idx):
+        self.profiler.record(0, 1e-4)
+        return idx
+
+
+def test_threads_dont_lose_counts():
+    profiler = TransformProfiler(['a', 'b'], max_workers=4)
+    threads = [threading.Thread(target=record_many, args=(profiler, 2000)) for _ in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    record_many(profiler, 1000)
+    summary = profiler.summary()
+    assert summary['a']['calls'] == 9000
+    assert sum(summary['a']['time_hist']) == 9000
+    assert summary['b']['skipped'] == 9000
+
+
+def test_workers_of_several_epochs():
+    profiler = TransformProfiler(['a'], max_workers=2)
+    loader = DataLoader(Profiled(profiler), batch_size=2, num_workers=2)
+    for epoch in range(4):
+        assert sorted(int(i) for batch in loader for i in batch) == list(range(8))
+    assert profiler.summary()['a']['calls'] == 32
+    assert profiler._data[0].sum() == 0
+
+
+def test_worker_beyond_max_workers(monkeypatch):
+    profiler = TransformProfiler(['a'], max_workers=1)
+    monkeypatch.setattr(profiler_module, 'worker_slot', lambda: 2)
+    profiler.record(0)
+    assert profiler.summary()['a']['calls'] == 0
@@ -0,0 +1,124 @@
+import numpy
+import pytest
+import torch
+
+from utils import replay
+
+
+def make_state(frame_id, n_frames=3, **extra):
+    ids = [frame_id - i for i in range(n_frames)]
+    images = torch.stack([torch.full((3, 4, 5), (i % 256) / 255.) for i in ids])
+    state = dict(state=torch.arange(6, dtype=torch.float32) + frame_id,
+                 images=images,
+                 image=images[0],
+                 frame_ids=torch.as_tensor(ids),
+                 frame_id=torch.as_tensor(frame_id))
+    state.update(extra)
+    return state
+
+
+def push_episode(memory, start, length):
+    for t in range(start, start + length):
+        state = make_state(t, ypos=torch.as_tensor(float(t)))
+        if t % 2:
+            # optional keys come and go, as in dig_v1.collect_state
+            state['visible'] = ['dirt', 1.0, 2.0, 3.0, 4.0]
+            state['action'] = torch.as_tensor(1)
+        next_state = make_state(t + 1) if t + 1 < start + length else None
+        memory.push(state, torch.as_tensor(t % 4), next_state, torch.as_tensor(float(t)))
+
+
+def test_push_states_with_different_keys():
+    memory = replay.FrameReplayMemory(32)
+    push_episode(memory, 10, 20)
+    assert len(memory) == 20
+    transitions, indices, weights = memory.sample_batch(8)
+    assert len(transitions) == 8
+    assert weights is None
+    for t, idx in zip(transitions, indices):
+        frame_id = int(t.state['frame_id'])
+        assert int(t.reward) == frame_id
+        assert torch.equal(t.state['state'], torch.arange(6, dtype=torch.float32) + frame_id)
+        assert torch.allclose(t.state['images'][:, 0, 0, 0],
+                              t.state['frame_ids'].float() / 255., atol=1e-3)
+        assert 'visible' not in t.state
+        assert float(t.state['ypos']) == frame_id
+        if t.next_state is not None:
+            # optional scalar missing in the pushed state
+            assert numpy.isnan(float(t.next_state['ypos']))
+            assert int(t.next_state['frame_id']) == frame_id + 1
+
+
+def test_missing_required_key():
+    memory = replay.FrameReplayMemory(8)
+    state = make_state(1)
+    del state['frame_id']
+    with pytest.raises(ValueError):
+        memory.push(state, torch.as_tensor(0), None, torch.as_tensor(0.0))
+
+
+def test_overwritten_frames_are_not_sampled():
+    memory = replay.FrameReplayMemory(16, frames_per_transition=0.5)
+    push_episode(memory, 100, 16)
+    for _ in range(5):
+        transitions, _, _ = memory.sample_batch(16)
+        for t in transitions:
+            for state in (t.state, t.next_state):
+                if state is not None:
+                    assert all(int(i) in memory._slots for i in state['frame_ids'])
+
+
+def test_resume(tmp_path):
+    path = str(tmp_path / 'replay')
+    memory = replay.FrameReplayMemory(16, path)
+    push_episode(memory, 50, 10)
+    memory.flush()
+    resumed = replay.FrameReplayMemory(16, path)
+    assert len(resumed) == 10
+    assert resumed.position == memory.position
+    transitions, _, _ = resumed.sample_batch(4)
+    assert len(transitions) == 4
+
+
+def random_shift(x):
+    return x + numpy.random.randint(0, 50)
+
+
+def test_shared_frames_get_the_same_augmentation():
+    memory = replay.FrameReplayMemory(32)
+    push_episode(memory, 10, 20)
+    transitions, _, _ = memory.sample_batch(16)
+    pool = replay.ThreadPoolExecutor(max_workers=3)
+    replay.augment_frames(transitions, random_shift, pool=pool)
+    pool.shutdown()
+    seen = dict()
+    for t in transitions:
+        for state in (t.state, t.next_state):
+            if state is None:
+                continue
+            assert torch.equal(state['image'], state['images'][0])
+            for frame_id, frame in zip(state['frame_ids'].tolist(), state['images']):
+                if frame_id in seen:
+                    assert torch.equal(seen[frame_id], frame)
+                seen[frame_id] = frame
+
+
+def test_prefetcher():
+    memory = replay.PrioritizedReplayMemory(32)
+    push_episode(memory, 10, 20)
+    prefetcher = replay.ReplayPrefetcher(memory, 8, random_shift, k=2, workers=2)
+    try:
+        batch = prefetcher.get(timeout=10)
+    finally:
+        prefetcher.stop()
+    assert batch['states']['images'].shape[0] == 8
+    assert batch['actions'].shape == (8, 1)
+    assert len(batch['indices']) == len(batch['weights']) == 8
+    # frames of a state and of the next state are augmented together
+    for i, j in enumerate(batch['has_next']):
+        state_ids = batch['states']['frame_ids'][j].tolist()
+        next_ids = batch['next_states']['frame_ids'][i].tolist()
+        for k, frame_id in enumerate(next_ids):
+            if frame_id in state_ids:
+                assert torch.equal(batch['next_states']['images'][i, k],
+                                   batch['states']['images'][j, state_ids.index(frame_id)])
@@ -0,0 +1,35 @@
+import time
+
+from utils.schedule import UpdateScheduler
+
+
+def test_ratio_and_chunks():
+    scheduler = UpdateScheduler(ratio=0.5, chunk=40)
+    calls = []
+    scheduler.record_env_steps(250)
+    losses = scheduler.run(lambda n: calls.append(n) or 1.0)
+    assert calls == [40, 40, 40, 5]
+    assert losses == [1.0] * 4
+    assert scheduler.debt == 0
+
+
+def test_nan_loss_keeps_debt():
+    scheduler = UpdateScheduler(ratio=1.0, chunk=10)
+    scheduler.record_env_steps(30)
+    calls = []
+    losses = scheduler.run(lambda n: calls.append(n) or float('nan'))
+    assert calls == [10] and losses == []
+    assert scheduler.debt == 30 and scheduler.step_cost is None
+
+
+def test_budget_and_max_debt():
+    scheduler = UpdateScheduler(ratio=1.0, budget=0.05, chunk=5, max_debt=100)
+    scheduler.record_env_steps(1000)
+    assert scheduler.debt == 100
+
+    def learn(n):
+        time.sleep(0.002 * n)
+        return 1.0
+    scheduler.run(learn)
+    assert 0 < scheduler.gradient_steps - 900 < 40
+    assert scheduler.step_cost >= 0.002
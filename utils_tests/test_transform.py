@@ -0,0 +1,92 @@
+import numpy
+
+from utils import noise
+from utils import transform
+
+
+def make_pair(h=24, w=32):
+    # every pixel holds its flat position, in the image and in the label
+    label = numpy.arange(h * w, dtype=numpy.int64).reshape(h, w)
+    image = numpy.stack([label, label, label], axis=2).astype(numpy.float32)
+    return image, label
+
+
+def test_joint_crop():
+    image, label = make_pair()
+    data, target = transform.JointRandomCrop(16, beta=4)(image, label)
+    assert data.shape[:2] == target.shape
+    assert (data[..., 0] == target).all()
+
+
+def test_joint_resize_keeps_label_values():
+    image, label = make_pair()
+    depth = numpy.random.random((24, 32, 1)).astype(numpy.float32)
+    data, (target, depth_target) = transform.JointResize(scale=0.5)(image, (label, depth))
+    assert data.shape == (12, 16, 3) and target.shape == (12, 16)
+    assert depth_target.shape == (12, 16, 1)
+    # nearest neighbour, no new class ids
+    assert numpy.isin(target, label).all()
+    data, target = transform.JointResize(size=(64, 48))(image, label)
+    assert data.shape == (48, 64, 3) and target.shape == (48, 64)
+
+
+def test_joint_flip():
+    image, label = make_pair()
+    data, target = transform.JointFlip(p=1)(image, label)
+    assert (data[..., 0] == target).all() and (target == label[:, ::-1]).all()
+    data, target = transform.JointFlip(p=1, horizontal=False)(image, label)
+    assert (target == label[::-1]).all()
+
+
+def test_joint_homography():
+    image, label = make_pair()
+    sampler = noise.HomographySample(beta=3, theta=0.1)
+    data, target = transform.JointHomography(sampler)(image, label)
+    assert data.shape == image.shape and target.shape == label.shape
+    assert numpy.isin(target, label).all()
+    # shift by whole pixels keeps image and label aligned
+    H = numpy.array([[1, 0, 2], [0, 1, 3], [0, 0, 1]], dtype=numpy.float64)
+    fixed = noise.HomographySample(H=H, H_inv=numpy.linalg.inv(H))
+    data, target = transform.JointHomography(fixed)(image, label)
+    assert (data[:-3, :-2, 0] == target[:-3, :-2]).all()
+    assert (target[:-3, :-2] == label[3:, 2:]).all()
+
+
+def test_compose_with_image_only():
+    image, label = make_pair()
+    depth = label.astype(numpy.float32)
+    compose = transform.FCompose([transform.JointFlip(p=1),
+                                  transform.ImageOnly(lambda x: x + 1),
+                                  transform.JointRandomCrop(16)])
+    data, (target, depth_target) = compose(image, (label, depth))
+    assert (data[..., 0] == target + 1).all()
+    assert (depth_target == target).all()
+    data, target = compose(image)
+    assert target is None and data.shape == (16, 16, 3)
+
+
+def test_rare_class_crop_covers_rare_pixels():
+    numpy.random.seed(0)
+    classes = numpy.zeros((64, 64), dtype=numpy.int64)
+    classes[50:52, 5:7] = 1
+    weights = noise.inverse_frequency_weights(numpy.bincount(classes.ravel()))
+    crop = transform.JointRareClassCrop(16, weights, uniform_ratio=0)
+    image = numpy.random.random((64, 64, 3)).astype(numpy.float32)
+    for _ in range(20):
+        data, target = crop(image, (classes, classes.astype(numpy.float32)))
+        assert data.shape == (16, 16, 3)
+        assert (target[0] == 1).any() and (target[1] == target[0]).all()
+
+
+def test_class_location_index():
+    numpy.random.seed(0)
+    classes = numpy.random.choice(3, size=(20, 30), p=[0.9, 0.1, 0.0])
+    index = noise.ClassLocationIndex(classes, n_classes=3)
+    for _ in range(50):
+        row, col = index.sample([0, 1, 1])
+        assert classes[row, col] == 1
+    assert index.sample([0, 0, 1]) is None
+    sampler = noise.RareClassCropTransform(8, [0, 1, 0], uniform_ratio=0)
+    top, left, size = sampler.sample_pos(index, 20, 30)
+    assert size == 8 and 0 <= top <= 12 and 0 <= left <= 22
+    assert (classes[top: top + size, left: left + size] == 1).any()
@@ -0,0 +1,116 @@
+import multiprocessing
+import time
+
+import numpy
+import pytest
+from torch.utils.data import Dataset
+
+from utils.dataset import VariantCache
+
+
+class Uniform(Dataset):
+    """
+    every call returns an image filled with one random value and a bool mask
+    """
+    def __len__(self):
+        return 3
+
+    def __getitem__(self, idx):
+        value = numpy.random.randint(0, 256) / 255
+        image = numpy.full((2, 16, 16), value, dtype=numpy.float32)
+        return image, numpy.ones((1, 16, 16), dtype=bool)
+
+
+def test_variants_are_stored(tmp_path):
+    cache = VariantCache(Uniform(), str(tmp_path), k=2)
+    for idx in range(3):
+        for _ in range(10):
+            cache[idx]
+    assert (cache._versions == 2).all()
+    image, mask = cache._read(1, 1)
+    assert image.dtype == numpy.float32 and mask.dtype == bool
+    assert mask.all()
+    # stored quantized to uint8
+    assert numpy.allclose(image * 255, numpy.rint(image * 255), atol=1e-4)
+    # read copies, replacing the variant doesn't change it
+    cache._write(1, 1, Uniform()[1])
+    assert cache._read(1, 1)[0] is not image
+
+
+def test_read_skips_variant_being_written(tmp_path):
+    cache = VariantCache(Uniform(), str(tmp_path), k=2)
+    assert cache._read(0, 1) is None
+    cache._versions[0, 0] += 1
+    assert cache._read(0, 0) is None
+
+    class Replaced:
+        # version changes between the two reads of the seqlock
+        def __init__(self):
+            self.values = [2, 4]
+
+        def __getitem__(self, key):
+            return self.values.pop(0)
+
+    cache._versions = Replaced()
+    assert cache._read(0, 0) is None
+
+
+def test_lazy_write_keeps_refreshed_variant(tmp_path):
+    cache = VariantCache(Uniform(), str(tmp_path), k=1)
+    cache._write(2, 0, Uniform()[2])
+    expected = cache._read(2, 0)
+    cache._write(2, 0, Uniform()[2], only_empty=True)
+    assert cache._versions[2, 0] == 2
+    assert numpy.array_equal(cache._read(2, 0)[0], expected[0])
+
+
+@pytest.mark.skipif('fork' not in multiprocessing.get_all_start_methods(), reason='needs fork')
+def test_no_torn_reads_with_refresh(tmp_path):
+    cache = VariantCache(Uniform(), str(tmp_path), k=2)
+    cache.start_refresh(interval=0)
+    try:
+        deadline = time.time() + 1
+        reads = 0
+        while time.time() < deadline:
+            image, mask = cache[numpy.random.randint(3)]
+            assert (image == image.flat[0]).all()
+            reads += 1
+    finally:
+        cache.stop_refresh()
+    assert reads > 0
+    assert (cache._versions % 2 == 0).all()
+    assert cache._versions.max() > 2
+
+
+class Labels(Dataset):
+    def __len__(self):
+        return 2
+
+    def __getitem__(self, idx):
+        return numpy.full((4, 4), 0.5, dtype=numpy.float32), numpy.arange(4, dtype=numpy.int64) * 2
+
+
+def test_integer_output_with_scale(tmp_path):
+    cache = VariantCache(Labels(), str(tmp_path), k=1, scales=(255, 10))
+    image, labels = cache._read(0, 0)
+    assert labels.dtype == numpy.int64
+    assert list(labels) == [0, 2, 4, 6]
+
+
+def test_cache_is_reused(tmp_path):
+    cache = VariantCache(Uniform(), str(tmp_path), k=2)
+    for idx in range(3):
+        cache._write(idx, 1, Uniform()[idx])
+    stored = cache._read(2, 1)[0]
+    # a writer was killed in the middle of a variant
+    cache._versions[1, 0] = 3
+    cache._versions.flush()
+    reused = VariantCache(Uniform(), str(tmp_path), k=2)
+    assert numpy.array_equal(reused._read(2, 1)[0], stored)
+    assert reused._versions[1, 0] == 0
+    # different k, stored variants don't fit
+    other = VariantCache(Uniform(), str(tmp_path), k=3)
+    assert other._read(2, 1) is None
+    other._write(2, 1, Uniform()[2])
+    assert VariantCache(Uniform(), str(tmp_path), k=3)._read(2, 1) is not None
+    assert VariantCache(Uniform(), str(tmp_path), k=3, reset=True)._read(2, 1) is None
@@ -0,0 +1,149 @@
+import pytest
+import torch
+from torch import nn
+
+pytest.importorskip('tagilmo')
+
+from utils import common
+from utils import replay
+from utils.vec_actor import VecActor
+
+
+class Action:
+    def to_string(self, action):
+        return 'move {0}'.format(int(action))
+
+
+class Policy(nn.Module):
+    acting = False
+
+    def __init__(self):
+        super().__init__()
+        self.actions = [Action()]
+        self.q = nn.Linear(6, 4)
+
+    def forward(self, data):
+        return self.q(data['state'])
+
+
+class Agent:
+    def __init__(self, memory):
+        self.policy_net = Policy()
+        self.memory = memory
+
+
+class Trainer(common.Trainer):
+    def __init__(self, index):
+        super().__init__()
+        self.index = index
+
+
+class Env:
+    """
+    frames of env i are filled with i / 255, episodes take 5 steps
+    """
+    def __init__(self, index):
+        self.trainer = Trainer(index)
+        self.history = []
+        self.commands = []
+        self.t = 0
+
+    def _state(self):
+        frame_id = self.trainer.next_frame_id()
+        frame = torch.full((3, 4, 5), self.trainer.index / 255.)
+        self.history = ([frame_id] + self.history)[:3]
+        ids = self.history + [self.history[-1]] * (3 - len(self.history))
+        return dict(state=torch.zeros(6),
+                    images=torch.stack([frame] * 3),
+                    frame_ids=torch.as_tensor(ids),
+                    frame_id=torch.as_tensor(frame_id))
+
+    def reset(self):
+        self.history = []
+        self.t = 0
+        return self._state()
+
+    def step(self, data, action, commands):
+        self.commands.extend(commands)
+        self.t += 1
+        if self.t == 5:
+            return None, float(self.trainer.index), True
+        return self._state(), float(self.trainer.index), False
+
+
+def test_frame_ids_are_unique_across_trainers():
+    trainers = [Trainer(i) for i in range(4)]
+    ids = [t.next_frame_id() for _ in range(500) for t in trainers]
+    assert len(set(ids)) == len(ids)
+
+
+def test_transitions_keep_frames_of_their_env():
+    memory = replay.FrameReplayMemory(200)
+    agent = Agent(memory)
+    envs = [Env(i) for i in range(4)]
+    actor = VecActor(agent, envs, epsilon=0.5)
+    try:
+        finished = actor.run(12)
+    finally:
+        actor.close()
+    assert finished == 8
+    assert len(memory) == 48
+    assert actor.finished == [float(i) * 5 for i in range(4)] * 2
+    assert all(len(env.commands) == 12 for env in envs)
+    transitions, _, _ = memory.sample_batch(48)
+    assert len(transitions) == 48
+    for t in transitions:
+        env = int(t.reward)
+        for state in (t.state, t.next_state):
+            if state is not None:
+                assert torch.allclose(state['images'], torch.full_like(state['images'], env / 255.))
+
+
+class Connector:
+    def __init__(self, source):
+        self.source = source
+        self.commands = []
+        self.life = 20
+        self.isAlive = [True]
+        self.y = 30.0
+
+    def observeProc(self):
+        pass
+
+    def getImage(self):
+        # a new frame on every observation
+        return torch.randint(0, 256, self.source + (3,), dtype=torch.uint8).numpy()
+
+    def getAgentPos(self):
+        return [0.0, self.y, 0.0, 0.0, 0.0]
+
+    def getLineOfSight(self, key):
+        return None
+
+    def getLife(self):
+        return self.life
+
+    def is_mission_running(self):
+        return True
+
+    def sendCommand(self, command):
+        self.commands.append(command)
+
+
+def test_dig_env(monkeypatch):
+    pytest.importorskip('mcdemoaux')
+    from trainable import dig_v1
+    monkeypatch.setattr(dig_v1.time, 'sleep', lambda seconds: None)
+    mc = Connector(dig_v1.Trainer.frame_spec().source)
+    env = dig_v1.DigEnv(dig_v1.Trainer(None, mc, None, 0.1), max_t=3)
+    data = env.reset()
+    assert data['images'].shape[0] == 3
+    assert len(set(data['frame_ids'].tolist())) == 1
+    next_data, reward, done = env.step(data, torch.as_tensor(1), ['move 1'])
+    assert not done
+    # not visible block and a step
+    assert reward == -2
+    assert 'move 1' in mc.commands
+    assert int(next_data['frame_ids'][1]) == int(data['frame_id'])
+    mc.life = 0
+    assert env.step(next_data, torch.as_tensor(0), ['move 0']) == (None, -100, True)